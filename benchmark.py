@@ -0,0 +1,804 @@
+import os
+import io
+import json
+import time
+import platform
+import subprocess
+import contextlib
+import resource
+import multiprocessing as mp
+import datetime
+import warnings
+import tempfile
+import argparse
+import numpy as np
+import pandas as pd
+import xarray as xr
+import plotly.graph_objs as go
+import statsmodels.tsa.seasonal as sts
+from plotly.subplots import make_subplots
+import cyan_extract
+import dashboard
+from utils import (synthetic, sarima, dataprep, schema, lakes, database, spatial, render,
+                   backtest)
+from utils.writer import DatasetWriter
+from utils.decompose import Decomposition
+from statsmodels.tsa.statespace.sarimax import SARIMAX
+
+
+def main():
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "-bench",
+        "--bench",
+        type=str,
+        default="process",
+        choices=["process", "prep", "hab", "load", "db", "spatial", "stream", "render", "decomp", "backtest",
+                 "suite"],
+        help="Benchmark to run",
+    )
+
+    parser.add_argument(
+        "-granule",
+        "--granule",
+        type=str,
+        default=None,
+        help="L3b_DAY_CYAN .nc file to benchmark with (default: synthetic CONUS granule)",
+    )
+
+    parser.add_argument(
+        "-nrows",
+        "--nrows",
+        type=int,
+        default=4320,
+        help="Number of ISIN grid rows of the synthetic granule",
+    )
+
+    parser.add_argument(
+        "-repeat",
+        "--repeat",
+        type=int,
+        default=3,
+        help="Number of timed runs (best run is reported)",
+    )
+
+    parser.add_argument(
+        "-data",
+        "--data",
+        type=str,
+        default=None,
+        help="Extracted CYAN parquet dataset to benchmark with (default: synthetic lake data)",
+    )
+
+    parser.add_argument(
+        "-rows",
+        "--rows",
+        type=int,
+        default=20_000_000,
+        help="Number of CI_cyano values to classify in the hab benchmark",
+    )
+
+    parser.add_argument(
+        "-days",
+        "--days",
+        type=int,
+        default=20,
+        help="Number of days of the synthetic dataset of the load benchmark",
+    )
+
+    parser.add_argument(
+        "-db",
+        "--db",
+        type=str,
+        default=None,
+        help="Database URL of the db benchmark (default: a temporary SQLite file)",
+    )
+
+    parser.add_argument(
+        "-procs",
+        "--procs",
+        type=int,
+        default=4,
+        help="Number of worker processes of the parallel backtest",
+    )
+
+    parser.add_argument(
+        "-scale",
+        "--scale",
+        type=str,
+        default="conus",
+        choices=["conus", "lake"],
+        help="Area of the synthetic granules of the suite: CONUS, or the registered lakes",
+    )
+
+    parser.add_argument(
+        "-json",
+        "--json",
+        type=str,
+        default="data/benchmarks.jsonl",
+        help="File the suite results are appended to (one JSON line per run)",
+    )
+
+    args = parser.parse_args()
+
+    if args.bench == "process":
+        bench_process_L3B_file(granule=args.granule, nrows=args.nrows, repeat=args.repeat)
+    elif args.bench == "prep":
+        bench_prep_data(data=args.data, repeat=args.repeat)
+    elif args.bench == "hab":
+        bench_hab_level(rows=args.rows, repeat=args.repeat)
+    elif args.bench == "load":
+        bench_getdata(data=args.data, days=args.days, nrows=args.nrows)
+    elif args.bench == "db":
+        bench_database(url=args.db, days=args.days, nrows=args.nrows)
+    elif args.bench == "spatial":
+        bench_spatial(days=args.days, nrows=args.nrows, repeat=args.repeat)
+    elif args.bench == "stream":
+        bench_stream(data=args.data, days=args.days, nrows=args.nrows)
+    elif args.bench == "render":
+        bench_render(repeat=args.repeat)
+    elif args.bench == "decomp":
+        bench_decompose(repeat=args.repeat)
+    elif args.bench == "backtest":
+        bench_backtest(data=args.data, processes=args.procs)
+    elif args.bench == "suite":
+        bench_suite(output=args.json, nrows=args.nrows, days=args.days, scale=args.scale,
+                    repeat=args.repeat)
+
+
+def timeit(func, repeat=3, **kwargs):
+    """
+    Run func repeat times, return the output and the best wall time in seconds
+    """
+    best = np.inf
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        out = func(**kwargs)
+        best = min(best, time.perf_counter() - t0)
+
+    return out, best
+
+
+def process_L3B_file_legacy(ds):
+    '''
+    Reference implementation of cyan_extract.process_L3B_file (merge_asof + per-row apply)
+    '''
+    df_BinIndex = pd.DataFrame(ds.BinIndex.values).reset_index()
+
+    df = pd.DataFrame(ds.BinList.values)
+    for k in list(ds.keys())[1:-1]:
+        tmp = pd.DataFrame(ds[k].values)
+        df[k] = tmp['sum']
+
+    out = pd.merge_asof(left=df, right=df_BinIndex, left_on="bin_num",
+                        right_on="start_num", direction='backward')
+
+    nrows = ds.sizes['binIndexDim']
+    latbin = (np.arange(0, nrows, dtype=np.float64) + 0.5) * \
+        (180.0 / nrows) - 90.0
+    out['clat'] = out['index'].apply(lambda x: latbin[x])
+    out['clon'] = (360.0 * (out['bin_num'] -
+                   out['start_num'] + 0.5) / out['max']) - 180.0
+    out['north'] = out['clat'] + (90.0 / nrows)
+    out['south'] = out['clat'] - (90.0 / nrows)
+    out['west'] = out['clon'] - (180.0 / out['max'])
+    out['east'] = out['clon'] + (180.0 / out['max'])
+
+    out_cols = ['bin_num', 'CI_stumpf', 'CI_cyano', 'CI_noncyano', 'MCI_stumpf',
+                'clat', 'clon', 'north', 'south', 'west', 'east']
+
+    return out[out_cols]
+
+
+def bench_process_L3B_file(granule=None, nrows=4320, repeat=3):
+    """
+    Compare rows/sec of process_L3B_file against the legacy implementation, and check
+    both produce exactly the same output
+    """
+    if granule:
+        ds = xr.open_dataset(granule, group="level-3_binned_data").load()
+    else:
+        ds = synthetic.make_l3b_dataset(nrows=nrows)
+    nbins = ds.sizes['binListDim']
+    print(f"Granule: {granule or 'synthetic'}, {nbins:,} bins")
+
+    df_old, t_old = timeit(process_L3B_file_legacy, repeat=repeat, ds=ds)
+    df_new, t_new = timeit(cyan_extract.process_L3B_file, repeat=repeat, ds=ds)
+
+    pd.testing.assert_frame_equal(df_old.reset_index(drop=True), df_new, check_exact=True)
+
+    print(f"  legacy:     {t_old:8.3f}s  {nbins/t_old:14,.0f} rows/sec")
+    print(f"  vectorized: {t_new:8.3f}s  {nbins/t_new:14,.0f} rows/sec")
+    print(f"  speedup:    {t_old/t_new:8.1f}x  (outputs identical)")
+
+
+def prep_data_legacy(df):
+    '''
+    Reference implementation of sarima.prep_data (loop over weeks x years + merge_asof)
+    '''
+    df['date'] = pd.to_datetime(df['date'])
+    df_daily = df.groupby('date').agg(
+        CI_cyano=('CI_cyano', 'mean')).reset_index()
+    df_daily['week'] = df_daily.date.dt.isocalendar().week
+    df_daily['year'] = df_daily.date.dt.isocalendar().year
+    df_weekly = df_daily.groupby(['year', 'week']).agg(
+        date=('date', 'min'), CI_cyano=('CI_cyano', 'mean')).reset_index()
+    df_weekly = df_weekly.sort_values(by='date')
+    df_weekly['year'] = df_weekly['year'].astype(int)
+    df_weekly['week'] = df_weekly['week'].astype(int)
+
+    week_first = df_weekly[df_weekly.date == df_weekly.date.min()].week.values[0]
+    week_last = df_weekly[df_weekly.date == df_weekly.date.max()].week.values[0]
+    years = df_weekly.year.unique()
+
+    df_weekly_imp = df_weekly.copy()
+    append_rows = {'year': [], 'week': [], 'date': []}
+
+    cicyano_mean = df_weekly.groupby('week').CI_cyano.mean().reset_index()
+    cicyano_mean['week'] = cicyano_mean['week'].astype(int)
+
+    for w in range(1, 53):
+        if w < week_first:
+            yy = years[1:]
+        elif w > week_last:
+            yy = years[:-1]
+        else:
+            yy = years
+        tmpdf = df_weekly_imp[df_weekly_imp.week == w]
+        for y in yy:
+            tmpdf2 = tmpdf[tmpdf.year == y]
+            if len(tmpdf2) == 0:
+                append_rows['year'].append(y)
+                append_rows['week'].append(w)
+                append_rows['date'].append(datetime.datetime.strptime(
+                    str(y)+'-W'+str(w)+'-1', '%G-W%V-%u'))
+
+    df_append = pd.DataFrame(append_rows)
+    df_append['week'] = df_append['week'].astype(int)
+
+    df_append = pd.merge_asof(
+        left=df_append, right=cicyano_mean, on='week', direction='nearest')
+    df_weekly_imp = pd.concat(
+        [df_weekly_imp, df_append], axis=0, ignore_index=True)
+    df_weekly_imp = df_weekly_imp.sort_values(by='date').reset_index(drop=True)
+    df_weekly_imp['log_y'] = np.log(df_weekly_imp.CI_cyano)
+
+    return df_weekly_imp
+
+
+def bench_prep_data(data=None, repeat=3, lakes=8):
+    """
+    Compare prep_data against the legacy implementation on one lake, check that both agree on
+    the weeks they have in common, then time the grouped version on several lakes at once
+    """
+    if data:
+        df = pd.read_parquet(data, columns=['date', 'CI_cyano'])
+    else:
+        df = synthetic.make_lake_data()
+    print(f"Data: {data or 'synthetic'}, {len(df):,} rows")
+
+    # the legacy version warns about concatenating an empty frame
+    warnings.simplefilter('ignore', FutureWarning)
+    old, t_old = timeit(lambda: prep_data_legacy(df.copy()), repeat=repeat)
+    new, t_new = timeit(sarima.prep_data, repeat=repeat, df=df)
+
+    both = old.merge(new, on=['year', 'week'], suffixes=('_old', '_new'))
+    # the legacy version skips week 53, and may impute weeks past the last observed week
+    print(f"  weeks: legacy {len(old)}, vectorized {len(new)}, in common {len(both)} "
+          f"(week 53: {(new.week == 53).sum()})")
+    assert (both.date_old == both.date_new).all()
+    assert np.allclose(both.log_y_old, both.log_y_new, rtol=0, atol=1e-9)
+
+    print(f"  legacy:     {t_old:8.3f}s")
+    print(f"  vectorized: {t_new:8.3f}s")
+    print(f"  speedup:    {t_old/t_new:8.1f}x  (common weeks identical)")
+
+    names = [f'lake{i}' for i in range(lakes)]
+    df_lakes = pd.concat([df.assign(lake=name) for name in names], ignore_index=True)
+    _, t_loop = timeit(lambda: [prep_data_legacy(d.copy()) for _, d in df_lakes.groupby('lake')],
+                       repeat=1)
+    _, t_group = timeit(sarima.prep_data, repeat=repeat, df=df_lakes, by='lake')
+    print(f"  {lakes} lakes: legacy loop {t_loop:.3f}s, grouped {t_group:.3f}s "
+          f"({t_loop/t_group:.1f}x)")
+
+
+def hab_level_legacy(df):
+    '''
+    Reference implementation of dataprep.hab_level (Python loop + string comparisons)
+    '''
+    HIGH = 0.016
+    MED = 0.001
+
+    hab_level = []
+    for c in df.CI_cyano.values:
+        if c >= HIGH:
+            level = 'high'
+        elif c >= MED:
+            level = 'medium'
+        else:
+            level = 'low'
+        hab_level.append(level)
+
+    df_out = df.copy()
+    df_out['HAB'] = hab_level
+    df_out['HAB_HIGH'] = (df_out.HAB == 'high')*1
+    df_out['HAB_MEDIUM'] = (df_out.HAB == 'medium')*1
+    df_out['HAB_HIGH_MED'] = df_out['HAB_HIGH']+df_out['HAB_MEDIUM']
+
+    return df_out
+
+
+def bench_hab_level(rows=20_000_000, repeat=3):
+    """
+    Compare rows/sec and memory of hab_level against the legacy implementation, check both
+    classify every value the same way, then time per-lake thresholds
+    """
+    rng = np.random.default_rng(0)
+    ci = rng.lognormal(-8.0, 2.5, rows).astype(np.float32)
+    ci[rng.random(rows) < 0.01] = np.nan
+    df = pd.DataFrame({'CI_cyano': ci,
+                       'lake': pd.Categorical.from_codes(rng.integers(0, 4, rows),
+                                                         ['a', 'b', 'c', 'd'])})
+    print(f"Values: {rows:,}")
+
+    old, t_old = timeit(hab_level_legacy, repeat=1, df=df)
+    new, t_new = timeit(dataprep.hab_level, repeat=repeat, df=df)
+
+    assert (new.HAB.astype(str).values == old.HAB.values).all()
+    for c in ['HAB_HIGH', 'HAB_MEDIUM', 'HAB_HIGH_MED']:
+        assert (new[c].values == old[c].values).all()
+    cols = ['HAB', 'HAB_HIGH', 'HAB_MEDIUM', 'HAB_HIGH_MED']
+    mb_old = old[cols].memory_usage(deep=True).sum() / 1e6
+    mb_new = new[cols].memory_usage(deep=True).sum() / 1e6
+
+    print(f"  legacy:     {t_old:8.3f}s  {rows/t_old:14,.0f} rows/sec  {mb_old:8.0f} MB")
+    print(f"  vectorized: {t_new:8.3f}s  {rows/t_new:14,.0f} rows/sec  {mb_new:8.0f} MB")
+    print(f"  speedup:    {t_old/t_new:8.1f}x  (levels identical)")
+
+    thresholds = {'a': (0.001, 0.016), 'b': (0.002, 0.02), 'c': (0.0005, 0.01)}
+    _, t_lake = timeit(dataprep.hab_level, repeat=repeat, df=df, thresholds=thresholds)
+    print(f"  per-lake:   {t_lake:8.3f}s  {rows/t_lake:14,.0f} rows/sec")
+
+
+def make_dataset(root, days=20, nrows=17280, row_group_size=65536):
+    """
+    Write days of synthetic CONUS granules as an extracted dataset (compact schema)
+    """
+    out = DatasetWriter(root, row_group_size=row_group_size)
+    day_first = datetime.date(2023, 6, 1)
+    for i in range(days):
+        day = day_first + datetime.timedelta(days=i)
+        ds = synthetic.make_l3b_dataset(nrows=nrows, seed=i)
+        df = cyan_extract.process_L3B_file(ds)
+        out.write_day(schema.storage_table(df, day, nrows), day)
+        print(f"  {day}: {len(df):,} rows", end='\r')
+    print()
+
+    return out
+
+
+def dataset_size(root):
+    return sum(os.path.getsize(os.path.join(d, f)) for d, _, files in os.walk(root) for f in files)
+
+
+def bench_getdata(data=None, days=20, nrows=17280, lake='mendota'):
+    """
+    Time loading one lake over one week of an extracted dataset: the whole dataset read and then
+    filtered in pandas, against getdata with the bbox, date range and columns pushed down.
+    Each load runs first in this process, so the first one is the cold start (file metadata not
+    yet cached by Arrow; the OS page cache may still hold recently written files).
+    """
+    tmp = None
+    if data is None:
+        tmp = tempfile.TemporaryDirectory()
+        data = os.path.join(tmp.name, 'cyan.parquet')
+        print(f"Writing {days} synthetic days (nrows={nrows})...")
+        make_dataset(data, days=days, nrows=nrows)
+    print(f"Dataset: {data}, {dataset_size(data)/1e9:.2f} GB")
+
+    bbox = lakes.LAKES[lake]['bbox']
+    columns = ['clat', 'clon', 'date', 'CI_cyano']
+    dates = pd.read_parquet(data, columns=['date'])['date']
+    date_to = pd.Timestamp(dates.max())
+    date_from = date_to - pd.Timedelta(days=6)
+    del dates
+
+    def pushdown():
+        return dataprep.getdata(data, columns=columns, bbox=bbox, date_from=date_from,
+                                date_to=date_to)
+
+    def full_scan():
+        df = dataprep.getdata(data, columns=columns + ['north', 'south', 'west', 'east'])
+        df = df[lakes.in_region(df, {'bbox': bbox}) &
+                (df.date >= date_from).values & (df.date <= date_to).values]
+        return df[columns].reset_index(drop=True)
+
+    new, t_cold = timeit(pushdown, repeat=1)
+    _, t_new = timeit(pushdown, repeat=3)
+    old, t_old = timeit(full_scan, repeat=1)
+
+    print(f"  {lake}, {date_from.date()} - {date_to.date()}: {len(new):,} rows")
+    print(f"  full scan + pandas filter: {t_old:8.3f}s")
+    print(f"  pushdown (cold):           {t_cold:8.3f}s")
+    print(f"  pushdown (warm):           {t_new:8.3f}s")
+    print(f"  speedup:                   {t_old/t_cold:8.1f}x cold")
+    print(f"  rows equal: {len(old) == len(new)}")
+    if tmp is not None:
+        tmp.cleanup()
+
+
+def bench_database(url=None, days=20, nrows=4320, lake='mendota', step=5):
+    """
+    Bulk-load synthetic days into the L3B_CYAN_DAILY table, and every step days report the load
+    rate and the latency of the getdata query of one lake over the last week and of a
+    one-day query over a 5 x 5 degree bbox, as the table grows
+    """
+    tmp = None
+    if url is None:
+        tmp = tempfile.TemporaryDirectory()
+        url = 'sqlite:///' + os.path.join(tmp.name, 'cyan.db')
+    engine = database.get_engine(url)
+    database.cyan_daily.drop(engine, checkfirst=True)
+    database.create_table(engine)
+    print(f"Database: {url}")
+    print(f"  {'days':>5} {'rows':>12} {'load rows/s':>12} {'lake week':>10} {'5x5 deg day':>12}")
+
+    def latency(**kwargs):
+        _, t = timeit(dataprep.getdata, repeat=5, path=url, **kwargs)
+        return t
+
+    day_first = datetime.date(2023, 6, 1)
+    total, t_load = 0, 0.0
+    for i in range(days):
+        day = day_first + datetime.timedelta(days=i)
+        df = cyan_extract.process_L3B_file(synthetic.make_l3b_dataset(nrows=nrows, seed=i))
+        table = schema.storage_table(df, day, nrows)
+        t0 = time.perf_counter()
+        total += database.load_day(engine, table, day)
+        t_load += time.perf_counter() - t0
+
+        if (i + 1) % step == 0 or i == days - 1:
+            database.analyze(engine)
+            t_lake = latency(bbox=lakes.LAKES[lake]['bbox'],
+                             date_from=day - datetime.timedelta(days=6), date_to=day)
+            t_box = latency(bbox=(-100, 35, -95, 40), date_from=day, date_to=day)
+            print(f"  {i+1:>5} {total:>12,} {total/t_load:>12,.0f} {t_lake*1000:>8.1f}ms "
+                  f"{t_box*1000:>10.1f}ms")
+
+    engine.dispose()
+    if tmp is not None:
+        tmp.cleanup()
+
+
+def bench_spatial(days=20, nrows=4320, repeat=3):
+    """
+    Select each registered lake, and a 5 x 5 degree bbox, from decoded days held in memory: a
+    boolean scan of the bounds columns (lakes.in_region) against bin ranges of the spatial index
+    looked up in the bin-sorted rows (sorted once)
+    """
+    df = pd.concat([cyan_extract.process_L3B_file(synthetic.make_l3b_dataset(nrows=nrows, seed=i))
+                    for i in range(days)], ignore_index=True)
+    print(f"Rows: {len(df):,} ({days} days)")
+
+    grid = spatial.BinGrid(nrows)
+    index, t_sort = timeit(spatial.SortedBins, repeat=1, bin_num=df['bin_num'].values)
+    print(f"  index build (sort): {t_sort:.3f}s")
+
+    regions = dict(lakes.LAKES, bbox_5x5={'bbox': [-100, 35, -95, 40]})
+    for name, region in regions.items():
+        mask, t_scan = timeit(lakes.in_region, repeat=repeat, df=df, region=region)
+        pos, t_index = timeit(lambda: index.lookup(grid.ranges(region)), repeat=repeat)
+        assert np.array_equal(np.sort(pos), np.where(mask)[0])
+        print(f"  {name:>13}: {len(pos):>9,} rows  scan {t_scan*1000:8.2f}ms  "
+              f"index {t_index*1000:8.2f}ms  ({t_scan/t_index:.0f}x)")
+
+
+def _weekly_series(conn, data, stream):
+    t0 = time.perf_counter()
+    if stream:
+        df = dataprep.daily_means(data)
+    else:
+        df = dataprep.getdata(data, columns=['date', 'CI_cyano'])
+    weekly = sarima.prep_data(df)
+    # peak resident memory of this process, in MB (ru_maxrss is in KB on Linux)
+    conn.send((weekly, time.perf_counter() - t0,
+               resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+
+
+def bench_stream(data=None, days=20, nrows=17280):
+    """
+    Peak memory and time to build the weekly series of forecast.run from a dataset: loading
+    the pixel rows with getdata, against streaming daily means. Each mode runs in a fresh
+    process.
+    """
+    tmp = None
+    if data is None:
+        tmp = tempfile.TemporaryDirectory()
+        data = os.path.join(tmp.name, 'cyan.parquet')
+        print(f"Writing {days} synthetic days (nrows={nrows})...")
+        make_dataset(data, days=days, nrows=nrows)
+    print(f"Dataset: {data}, {dataset_size(data)/1e9:.2f} GB")
+
+    ctx = mp.get_context('spawn')
+    out = {}
+    for stream in [True, False]:
+        recv, send = ctx.Pipe(duplex=False)
+        proc = ctx.Process(target=_weekly_series, args=(send, data, stream))
+        proc.start()
+        out[stream] = recv.recv()
+        proc.join()
+        weekly, seconds, rss = out[stream]
+        print(f"  {'stream' if stream else 'getdata':>8}: {seconds:7.2f}s  peak RSS {rss:8.0f} MB  "
+              f"({len(weekly)} weeks)")
+
+    assert np.allclose(out[True][0].log_y, out[False][0].log_y, rtol=1e-5)
+    if tmp is not None:
+        tmp.cleanup()
+
+
+def render_figures_legacy(pixels, daily):
+    '''
+    Reference implementation of the dashboard figures (SVG markers, hover text per row, every date)
+    '''
+    fig = make_subplots(rows=1, cols=2)
+    fig.add_trace(go.Scatter(x=pixels['clon'], y=pixels['clat'], mode='markers',
+                             marker=dict(size=9, color=pixels.nobs, coloraxis='coloraxis'),
+                             text=pixels['nobs'].apply(lambda x: f'No. observations: {x:,}'),
+                             hoverinfo='text+x+y'), row=1, col=1)
+    fig.add_trace(go.Scatter(x=pixels.clon, y=pixels.clat, mode='markers',
+                             marker=dict(size=8, color=pixels.CI_cyano, coloraxis='coloraxis2'),
+                             text=pixels['CI_cyano'].apply(lambda x: f'CI_cyano: {x:.6f}'),
+                             hoverinfo='text+x+y'), row=1, col=2)
+    fig2 = go.Figure(data=go.Scatter(x=daily.date, y=daily.CI_cyano, mode='lines',
+                                     text=daily['CI_cyano'].apply(lambda x: f'CI_cyano: {x:.6f}'),
+                                     hoverinfo='text+x'))
+
+    return fig.to_dict(), fig2.to_dict()
+
+
+def render_figures(pixels, daily):
+    fig = make_subplots(rows=1, cols=2)
+    fig.add_trace(render.pixel_trace(pixels.clat, pixels.clon, pixels.nobs,
+                                     'No. observations', ',', 'coloraxis', size=9), row=1, col=1)
+    fig.add_trace(render.pixel_trace(pixels.clat, pixels.clon, pixels.CI_cyano,
+                                     'CI_cyano', '.6f', 'coloraxis2'), row=1, col=2)
+    keep = render.decimate(daily.date.values, daily.CI_cyano.values)
+    fig2 = go.Figure(data=go.Scatter(x=daily.date.values[keep], y=daily.CI_cyano.values[keep],
+                                     mode='lines',
+                                     hovertemplate='CI_cyano: %{y:.6f}<br>%{x}<extra></extra>'))
+
+    return fig.to_dict(), fig2.to_dict()
+
+
+def bench_render(repeat=3, ndays=2900):
+    """
+    Build and serialize the dashboard figures of one date range for lakes of increasing size,
+    with the previous figures and with utils.render: time and payload sent to the browser
+    """
+    rng = np.random.default_rng(0)
+    dates = pd.date_range('2016-05-01', periods=ndays)
+    daily = pd.DataFrame({'date': dates, 'CI_cyano': rng.lognormal(-8.0, 1.5, ndays)})
+    for npix in [2_000, 20_000, 200_000]:
+        # square lake of 300 m pixels, as in synthetic.make_lake_data
+        side = int(np.ceil(np.sqrt(npix)))
+        pixels = pd.DataFrame({'clat': 43.1 + 0.0026 * (np.arange(npix) // side),
+                               'clon': -89.5 + 0.0036 * (np.arange(npix) % side),
+                               'CI_cyano': rng.lognormal(-8.0, 1.5, npix),
+                               'nobs': rng.integers(1, 1000, npix)})
+
+        def build(figures):
+            return render.payload_size(*figures(pixels, daily))
+
+        size_old, t_old = timeit(build, repeat=repeat, figures=render_figures_legacy)
+        size_new, t_new = timeit(build, repeat=repeat, figures=render_figures)
+        print(f"  {len(pixels):>7,} pixels, {ndays} days: legacy {t_old:6.2f}s {size_old/1e6:7.2f} MB"
+              f"  render {t_new:6.2f}s {size_new/1e6:7.2f} MB  ({size_old/size_new:.1f}x smaller)")
+
+
+def bench_decompose(repeat=3, nweeks=416):
+    """
+    Seasonal decomposition of many weekly series (8 years): statsmodels seasonal_decompose on
+    each series, against one batched Decomposition with its trend report and anomalies
+    """
+    rng = np.random.default_rng(0)
+    dates = pd.date_range('2016-05-02', periods=nweeks, freq='7D')
+    season = 1 + np.sin(2 * np.pi * dates.dayofyear.values / 365)
+    for nseries in [10, 100, 1000]:
+        y = rng.lognormal(-8.0, 1.0, (nseries, nweeks)) * season
+
+        def loop():
+            return [sts.seasonal_decompose(pd.Series(row, index=dates), period=52) for row in y]
+
+        def batched():
+            dec = Decomposition(y, dates=dates)
+            dec.trend_report()
+            dec.anomalies()
+            return dec
+
+        res, t_loop = timeit(loop, repeat=repeat)
+        dec, t_batch = timeit(batched, repeat=repeat)
+        assert np.allclose(dec.resid, np.array([r.resid.values for r in res]), equal_nan=True)
+        print(f"  {nseries:>5} series: seasonal_decompose {t_loop*1000:8.1f}ms  "
+              f"batched {t_batch*1000:7.1f}ms  ({t_loop/t_batch:.0f}x)")
+
+
+def bench_backtest(data=None, processes=4, horizon=12, nfits=3, search_weeks=156,
+                   refit_step=4):
+    """
+    Rolling-origin backtest of 12-week forecasts from every week of 8 years of synthetic lake
+    data (or an extracted dataset with data): naive backtest refitting the model at each
+    origin (estimated from sarima.train and nfits SARIMAX fits), against backtest.run extending
+    one fitted model, and re-estimating the parameters every refit_step weeks in one and in
+    processes processes (at most one per CPU). The orders are searched on the first
+    search_weeks weeks, as the search on 8 years of weeks with m=52 takes more memory than most
+    machines have.
+    """
+    if data is None:
+        df = synthetic.make_lake_data(npix=300, ndays=2900)
+    else:
+        df = dataprep.getdata(data, columns=['date', 'CI_cyano'])
+    weekly = sarima.prep_data(df)
+    origins = backtest.cutoffs(len(weekly), horizon)
+    print(f"{len(weekly)} weeks, {len(origins)} forecast origins of {horizon} weeks")
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        t = time.perf_counter()
+        _, smodel = sarima.train(weekly.iloc[:search_weeks], trace=False)
+        t_train = time.perf_counter() - t
+
+        spec = backtest.model_spec(smodel)
+        y = weekly.log_y.values
+        t = time.perf_counter()
+        for c in origins[np.linspace(0, len(origins) - 1, nfits).astype(int)]:
+            SARIMAX(y[:c], **spec).fit(disp=False)
+        t_fit = (time.perf_counter() - t) / nfits
+
+        print(f"  naive, orders search + fit:  {t_train * len(origins):8.1f}s (estimated, "
+              f"{t_train:.1f}s per origin on {search_weeks} weeks)")
+        print(f"  naive, fit only:             {t_fit * len(origins):8.1f}s (estimated, "
+              f"{t_fit:.2f}s per origin)")
+
+        t = time.perf_counter()
+        bt = backtest.run(weekly, smodel, horizon)
+        print(f"  extend:                      {time.perf_counter() - t:8.1f}s")
+
+        cpus = os.cpu_count() or 1
+        timings = {}
+        for procs in sorted({1, min(processes, cpus)}):
+            t = time.perf_counter()
+            refit = backtest.run(weekly, smodel, horizon, step=refit_step, refit=True,
+                                 processes=procs)
+            timings[procs] = time.perf_counter() - t
+            print(f"  refit every {refit_step} weeks, {procs} proc: {timings[procs]:8.1f}s "
+                  f"({refit.origin.nunique()} origins, {timings[1] / timings[procs]:.1f}x)")
+        if cpus < processes:
+            print(f"  ({cpus} CPU(s): refits run in at most {cpus} process(es))")
+
+    print(backtest.evaluate(bt).to_string(float_format="%.4g"))
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def bench_suite(output='data/benchmarks.jsonl', nrows=4320, days=20, scale='conus', repeat=3):
+    """
+    End-to-end benchmark of the pipeline on synthetic data, without the NASA server:
+    decoding L3b granules written as NetCDF (CONUS or lake scale), extract_cyan downloading
+    them from a local HTTP server, getdata on the extracted dataset, then hab_level,
+    data_impute, prep_data, the dashboard date range callback and sarima train/predict on
+    3 years of lake data. The results of each stage (best time of repeat runs, rows, sizes)
+    are printed and appended as one JSON line to output, with the date, commit and
+    parameters of the run, so that runs can be compared over time.
+    """
+    tmp = tempfile.TemporaryDirectory()
+    bbox = synthetic.CONUS if scale == 'conus' else synthetic.lake_bboxes()
+    regions = lakes.get_lakes(list(lakes.LAKES))
+    results = {}
+
+    def stage(name, func, runs=repeat, **kwargs):
+        out, seconds = timeit(func, repeat=runs, **kwargs)
+        info = out if isinstance(out, dict) else {}
+        results[name] = {'seconds': round(seconds, 4), **info}
+        extra = '  '.join(f'{k}={v:,}' if isinstance(v, int) else f'{k}={v}'
+                          for k, v in info.items())
+        print(f"  {name:<24} {seconds:9.3f}s  {extra}")
+        return out
+
+    print(f"Synthetic {scale} granules (nrows={nrows}), {days} days; lake data of 3 years")
+
+    # decode one granule
+    granule = os.path.join(tmp.name, 'granule.nc')
+    synthetic.write_l3b(synthetic.make_l3b_dataset(nrows, bbox), granule)
+
+    def decode(regions=None):
+        with cyan_extract.open_L3B(granule) as ds:
+            return {'rows': len(cyan_extract.process_L3B_file(ds, regions))}
+
+    stage('process_L3B_file', decode)
+    stage('process_L3B_file_lakes', decode, regions=regions)
+
+    # extract the days from a local HTTP server, in a scratch working directory (./data/)
+    first = datetime.date(2023, 6, 1)
+    last = first + datetime.timedelta(days=days - 1)
+    files = synthetic.write_granules(os.path.join(tmp.name, 'server'), first, days, nrows, bbox)
+    server, url = synthetic.serve(os.path.join(tmp.name, 'server'))
+    cwd = os.getcwd()
+    os.chdir(tmp.name)
+    try:
+        def extract():
+            with contextlib.redirect_stdout(io.StringIO()):
+                cyan_extract.extract_cyan(int(first.strftime('%Y%m%d')), int(last.strftime('%Y%m%d')),
+                                          file='suite.parquet', base_url=url, in_memory=True)
+            return {'days': days, 'MB': round(sum(os.path.getsize(f) for f in files) / 1e6, 1)}
+
+        stage('extract_cyan', extract, runs=1)
+        data = os.path.abspath('data/suite.parquet')
+    finally:
+        os.chdir(cwd)
+        server.shutdown()
+
+    def load(**kwargs):
+        return {'rows': len(dataprep.getdata(data, **kwargs))}
+
+    stage('getdata', load)
+    stage('getdata_bbox', load, columns=['clat', 'clon', 'date', 'CI_cyano'],
+          bbox=lakes.region_bbox(regions['mendota']))
+
+    # lake scale: 2000 pixels over 3 years
+    df = synthetic.make_lake_data(npix=2000, ndays=1100)
+    stage('hab_level', lambda: {'rows': len(dataprep.hab_level(df))})
+    stage('data_impute', lambda: {'rows': len(dataprep.data_impute(df))})
+    stage('prep_data', lambda: {'rows': len(sarima.prep_data(df))})
+
+    # dashboard: load the lake (aggregates and preset ranges), then a date range not cached
+    lake_file = os.path.join(tmp.name, 'lake.parquet')
+    df.to_parquet(lake_file)
+    views = []
+
+    def load_view():
+        with contextlib.redirect_stdout(io.StringIO()):
+            views.append(dashboard.LakeView(lake_file, cache_figures=False))
+        return {'pixels': len(views[-1].cube.clat)}
+
+    def callback():
+        with contextlib.redirect_stdout(io.StringIO()):
+            views[-1].update('2017-05-01', '2017-10-31')
+        return {'bytes': views[-1].last_render['bytes']}
+
+    stage('dashboard_load', load_view)
+    stage('dashboard_callback', callback)
+
+    weekly = sarima.prep_data(df)
+    fitted = {}
+
+    def train():
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            fitted['name'], fitted['model'] = sarima.train(weekly, trace=False)
+        return {'model': fitted['name']}
+
+    stage('sarima.train', train, runs=1)
+    stage('sarima.predict', lambda: {'weeks': len(sarima.predict(weekly, fitted['model'], n=12)[1])})
+
+    record = {'date': datetime.datetime.now().isoformat(timespec='seconds'),
+              'commit': git_commit(), 'python': platform.python_version(),
+              'platform': platform.platform(), 'cpus': os.cpu_count(),
+              'params': {'nrows': nrows, 'days': days, 'scale': scale, 'repeat': repeat},
+              'results': results}
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    with open(output, 'a') as f:
+        f.write(json.dumps(record) + '\n')
+    print("Results appended to", output)
+    tmp.cleanup()
+
+
+if __name__ == '__main__':
+    main()
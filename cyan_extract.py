@@ -1,10 +1,20 @@
 import os
+import time
 import datetime
 import argparse
+import multiprocessing as mp
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
 import pandas as pd
 import numpy as np
-import requests
 import xarray as xr
+import netCDF4
+from utils import database, download, isin, metrics, schema, spatial
+from utils import lakes as lake_registry
+from utils.writer import DatasetWriter, IngestState
+
+L3B_URL = 'https://oceandata.sci.gsfc.nasa.gov/cgi/getfile/'
+CI_VARS = ['CI_stumpf', 'CI_cyano', 'CI_noncyano', 'MCI_stumpf']
 
 
 def main():
@@ -23,8 +33,8 @@ def main():
         "-dateto",
         "--dateto",
         type=int,
-        default=20240110,
-        help="Extract data TO date yyyymmdd",
+        default=None,
+        help="Extract data TO date yyyymmdd (default: 20240110, or today with -incremental)",
     )
 
     parser.add_argument(
@@ -32,18 +42,155 @@ def main():
         "--path",
         type=str,
         default='L3B_CYAN_DAILY.parquet',
-        help="Location and file name to save the extracted data (in .parquet format)",
+        help="Name of the parquet dataset folder to save the extracted data in",
+    )
+
+    parser.add_argument(
+        "-workers",
+        "--workers",
+        type=int,
+        default=4,
+        help="Number of concurrent downloads",
+    )
+
+    parser.add_argument(
+        "-retries",
+        "--retries",
+        type=int,
+        default=3,
+        help="Number of retries for a failed download",
+    )
+
+    parser.add_argument(
+        "-baseurl",
+        "--baseurl",
+        type=str,
+        default=L3B_URL,
+        help="Base URL of the L3B files",
+    )
+
+    parser.add_argument(
+        "-lakes",
+        "--lakes",
+        type=str,
+        nargs='+',
+        default=None,
+        help="Only extract the bins of these lakes (names in the lake registry)",
+    )
+
+    parser.add_argument(
+        "-lakefile",
+        "--lakefile",
+        type=str,
+        default=None,
+        help="JSON file of additional lakes {name: {'bbox': [lon_min, lat_min, lon_max, lat_max]} or {'polygon': [[lon, lat], ...]}}",
+    )
+
+    parser.add_argument(
+        "-rowgroup",
+        "--rowgroup",
+        type=int,
+        default=None,
+        help="Maximum number of rows per parquet row group",
+    )
+
+    parser.add_argument(
+        "-compression",
+        "--compression",
+        type=str,
+        default='snappy',
+        choices=['snappy', 'zstd', 'gzip', 'lz4', 'none'],
+        help="Parquet compression codec",
+    )
+
+    parser.add_argument(
+        "-inmemory",
+        "--inmemory",
+        action='store_true',
+        help="Decode downloaded files in memory instead of saving them to ./data/",
+    )
+
+    parser.add_argument(
+        "-cache",
+        "--cache",
+        type=str,
+        default=None,
+        help="Folder of a local cache of the raw .nc files, for reprocessing (implies -inmemory)",
+    )
+
+    parser.add_argument(
+        "-procs",
+        "--procs",
+        type=int,
+        default=1,
+        help="Number of worker processes decoding files",
+    )
+
+    parser.add_argument(
+        "-incremental",
+        "--incremental",
+        action='store_true',
+        help="Only extract days after the latest date of each lake already in the dataset",
+    )
+
+    parser.add_argument(
+        "-db",
+        "--db",
+        type=str,
+        default=None,
+        help="Also bulk-load each day into the L3B_CYAN_DAILY table of a database URL "
+             "(e.g. sqlite:///data/cyan.db)",
+    )
+
+    parser.add_argument(
+        "-metrics",
+        "--metrics",
+        type=str,
+        default=None,
+        help="Append the timings, rows, bytes and peak memory of each stage to this JSON lines file",
+    )
+
+    parser.add_argument(
+        "-profile",
+        "--profile",
+        type=str,
+        default=None,
+        help="Run under cProfile and save the statistics to this file",
+    )
+
+    parser.add_argument(
+        "-tracemem",
+        "--tracemem",
+        action='store_true',
+        help="Also record the peak Python memory of each stage (tracemalloc, slower)",
     )
 
     args = parser.parse_args()
+    if args.dateto is None and not args.incremental:
+        args.dateto = 20240110
+    metrics.configure(args.metrics, trace_memory=args.tracemem)
 
     try:
-        extract_cyan(date_from=args.datefrom,
-                     date_to=args.dateto,
-                     file=args.path)
-
-    except:
-        print("Error with input parameters.")
+        with metrics.profile(args.profile):
+            extract_cyan(date_from=args.datefrom,
+                         date_to=args.dateto,
+                         file=args.path,
+                         workers=args.workers,
+                         retries=args.retries,
+                         base_url=args.baseurl,
+                         lakes=args.lakes,
+                         lakefile=args.lakefile,
+                         row_group_size=args.rowgroup,
+                         compression=args.compression,
+                         in_memory=args.inmemory,
+                         cache_dir=args.cache,
+                         processes=args.procs,
+                         incremental=args.incremental,
+                         db_url=args.db)
+        metrics.report()
+
+    except (ValueError, KeyError) as e:
+        print("Error with input parameters:", e)
 
 
 def convert_int_to_datetime_manual(date_int):
@@ -53,7 +200,7 @@ def convert_int_to_datetime_manual(date_int):
     return datetime.date(year, month, day)
 
 
-def getL3Burl(instr_name, prod_suff, temp_res, target_dt):
+def getL3Burl(instr_name, prod_suff, temp_res, target_dt, base_url=L3B_URL):
     from datetime import timedelta
     satfileurl = ''
     if 'MERIS' in instr_name:
@@ -90,77 +237,252 @@ def getL3Burl(instr_name, prod_suff, temp_res, target_dt):
         print('ERROR - Bad instrument specification:', instr_name)
         return ''
 
-    return 'https://oceandata.sci.gsfc.nasa.gov/cgi/getfile/' + l3filename
+    return base_url + l3filename
 
 
-def process_L3B_file(ds):
+def open_L3B(granule):
     '''
-    Process L3b_DAY_CYAN nc file into pandas dataframe, convert bins to lat/lon location
+    Open the binned data group of a L3b nc file, given its path or its content (bytes)
     '''
-    df_BinIndex = pd.DataFrame(ds.BinIndex.values).reset_index()
+    if isinstance(granule, str):
+        return xr.open_dataset(granule, group="level-3_binned_data")
 
-    df = pd.DataFrame(ds.BinList.values)
-    for k in list(ds.keys())[1:-1]:
-        tmp = pd.DataFrame(ds[k].values)
-        df[k] = tmp['sum']
+    nc = netCDF4.Dataset('L3b.nc', mode='r', memory=bytes(granule))
+    store = xr.backends.NetCDF4DataStore(nc, group="level-3_binned_data")
 
-    out = pd.merge_asof(left=df, right=df_BinIndex, left_on="bin_num",
-                        right_on="start_num", direction='backward')
+    return xr.open_dataset(store)
 
-    nrows = ds.sizes['binIndexDim']
-    latbin = (np.arange(0, nrows, dtype=np.float_) + 0.5) * \
+
+def decode_bins(bin_num, bin_index, nrows, sums):
+    '''
+    Convert ISIN bin numbers to lat/lon bin center and bounds, given the grid rows (BinIndex)
+    and the CI sums of each bin
+    '''
+    # ISIN grid row of each bin: last row whose first bin number is <= bin_num
+    row = np.searchsorted(bin_index['start_num'], bin_num, side='right') - 1
+    start_num = bin_index['start_num'][row]
+    nbins = bin_index['max'][row]
+
+    latbin = (np.arange(0, nrows, dtype=np.float64) + 0.5) * \
         (180.0 / nrows) - 90.0
-    out['clat'] = out['index'].apply(lambda x: latbin[x])
-    out['clon'] = (360.0 * (out['bin_num'] -
-                   out['start_num'] + 0.5) / out['max']) - 180.0
+
+    out = {'bin_num': bin_num}
+    out.update(sums)
+
+    out['clat'] = latbin[row]
+    out['clon'] = (360.0 * (bin_num - start_num + 0.5) / nbins) - 180.0
     out['north'] = out['clat'] + (90.0 / nrows)
     out['south'] = out['clat'] - (90.0 / nrows)
-    out['west'] = out['clon'] - (180.0 / out['max'])
-    out['east'] = out['clon'] + (180.0 / out['max'])
+    out['west'] = out['clon'] - (180.0 / nbins)
+    out['east'] = out['clon'] + (180.0 / nbins)
 
-    out_cols = ['bin_num', 'CI_stumpf', 'CI_cyano', 'CI_noncyano', 'MCI_stumpf',
-                'clat', 'clon', 'north', 'south', 'west', 'east']
+    return pd.DataFrame(out)
 
-    return out[out_cols]
 
+def process_L3B_file(ds, regions=None):
+    '''
+    Process L3b_DAY_CYAN nc file into pandas dataframe, convert bins to lat/lon location.
+    If regions ({lake: region}) is given, only the bins of each lake are read and decoded,
+    and a lake column is added
+    '''
+    bin_index = ds.BinIndex.values
+    nrows = ds.sizes['binIndexDim']
 
-def extract_cyan(date_from: int, date_to: int, file='L3B_CYAN_DAILY.parquet'):
+    if regions is None:
+        sums = {k: ds[k].values['sum'] for k in CI_VARS}
+        return decode_bins(ds.BinList.values['bin_num'], bin_index, nrows, sums)
+
+    # position of each grid row's first bin in BinList
+    extent = bin_index['extent'].astype(np.int64)
+    offset = np.cumsum(extent) - extent
+    has_extent = extent.sum() == ds.sizes['binListDim']
+    grid = spatial.BinGrid(nrows, bin_index['start_num'], bin_index['max'])
+
+    out = []
+    for lake, region in regions.items():
+        # exact bin ranges of the lake: only those bins are read and decoded
+        ranges = grid.ranges(region)
+        if len(ranges) == 0:
+            span = slice(0, 0)
+        elif has_extent:
+            rows = grid.rows(ranges)
+            span = slice(offset[rows.min()], offset[rows.max()] + extent[rows.max()])
+        else:
+            span = slice(None)
+
+        bin_num = ds.BinList[span].values['bin_num']
+        idx = isin.ranges_to_index(bin_num, ranges)
+        sums = {k: ds[k][span].values['sum'][idx] for k in CI_VARS}
+
+        df = decode_bins(bin_num[idx], bin_index, nrows, sums)
+        df['lake'] = lake
+        out.append(df)
+
+    return pd.concat(out, axis=0, ignore_index=True)
+
+
+@metrics.timed('extract.decode')
+def decode_day(day_of, granule, regions=None):
+    '''
+    Decode one day's L3b file (path or content) into an Arrow table in the storage schema
+    (see utils/schema.py). Return the table and the decode time in seconds.
+    '''
+    t0 = time.perf_counter()
+    with open_L3B(granule) as ds:
+        df = process_L3B_file(ds=ds, regions=regions)
+        nrows = ds.sizes['binIndexDim']
+
+    return schema.storage_table(df, day_of, nrows), time.perf_counter() - t0
+
+
+def extract_cyan(date_from: int, date_to: int = None, file='L3B_CYAN_DAILY.parquet',
+                 workers=4, retries=3, base_url=L3B_URL, lakes=None, lakefile=None,
+                 row_group_size=None, compression='snappy', in_memory=False, cache_dir=None,
+                 processes=1, incremental=False, db_url=None):
+    """
+    Download and process L3B daily files from date_from to date_to. Each day is written to a
+    parquet dataset partitioned by year/month (and lake, if lakes are given) as soon as it is
+    processed, so a rerun over later dates appends to the same dataset.
+    Downloads run concurrently; finished days are recorded in a manifest in the dataset
+    folder, so rerunning an interrupted extraction skips the days already done.
+    If lakes (names in the lake registry) is given, only the bins of those lakes are kept.
+    With in_memory=True, files are decoded from the downloaded bytes without touching disk;
+    cache_dir keeps a content-addressed copy of the raw files to reprocess them later
+    (and implies in_memory). With processes > 1, files are decoded in that many worker
+    processes while downloads continue, and timings of each stage are reported.
+    With incremental=True, only the days after the latest date of each lake already in the
+    dataset are extracted; days without a file or without data for a lake are recorded in
+    the dataset's _state.json and not requested again.
+    With db_url, each day is also bulk-loaded into the L3B_CYAN_DAILY table of that database.
+    """
+    regions = None
+    if lakes:
+        regions = lake_registry.get_lakes(lakes, lake_registry.load_registry(lakefile))
 
     day_first = convert_int_to_datetime_manual(date_from)
-    day_last = convert_int_to_datetime_manual(date_to)
+    day_last = convert_int_to_datetime_manual(date_to) if date_to else datetime.date.today()
 
     local = "./data/"
-    df = pd.DataFrame()
-
+    out = DatasetWriter(local + file, partition_by_lake=regions is not None,
+                        row_group_size=row_group_size, compression=compression)
+    manifest = download.Manifest(os.path.join(out.root, '_manifest.json'))
+    cache = download.GranuleCache(cache_dir) if cache_dir else None
+    in_memory = in_memory or cache is not None
+
+    # incremental mode: only days after the latest date of each lake, except known empty days
+    state, last = None, {}
+    if incremental:
+        state = IngestState(os.path.join(out.root, '_state.json'))
+        last = out.max_dates()
+        print("Latest dates in dataset:", {k: str(v) for k, v in last.items()})
+
+    urls, day_regions = {}, {}
     for i in range((day_last - day_first).days+1):
-
         day_of = day_first + datetime.timedelta(days=i)
-        url = getL3Burl(instr_name='OLCI', prod_suff='CYAN',
-                        temp_res='DAY', target_dt=day_of)
-        fn = url.split('/')[-1]
-        print(day_of, ": Processing", url)
-        try:
-            r = requests.get(url)
-            with open(local + fn, 'wb') as f:
-                f.write(r.content)
+        if manifest.status(day_of) == 'written':
+            print(day_of, ": Already extracted")
+            continue
+
+        if incremental:
+            if state.is_nodata(day_of):
+                continue
+            todo = [lake for lake in (regions or [None])
+                    if (lake not in last or day_of > last[lake])
+                    and not state.is_empty(lake, day_of)]
+            if not todo:
+                continue
+            day_regions[day_of] = {lake: regions[lake] for lake in todo} if regions else None
+        else:
+            day_regions[day_of] = regions
 
-            ds = xr.open_dataset(local + fn, group="level-3_binned_data")
+        urls[day_of] = getL3Burl(instr_name='OLCI', prod_suff='CYAN',
+                                 temp_res='DAY', target_dt=day_of, base_url=base_url)
 
-            df_tmp = process_L3B_file(ds=ds)
-            df_tmp['date'] = day_of
+    print(f"Days to extract: {len(urls)}")
 
-            df = pd.concat([df, df_tmp], axis=0)
-            print("  Complete: ", df_tmp.shape)
+    db = None
+    if db_url:
+        db = database.get_engine(db_url)
+        database.create_table(db)
 
-            os.remove(local + fn)
+    stats = {'download_s': 0.0, 'bytes': 0, 'files': 0, 'decode_s': 0.0, 'write_s': 0.0}
+    t_start = time.perf_counter()
 
-        except:
+    def write(day_of, granule, job):
+        try:
+            table, seconds = job.result()
+            stats['decode_s'] += seconds
+            t0 = time.perf_counter()
+            with metrics.stage('extract.write', day=str(day_of), rows_in=table.num_rows):
+                out.write_day(table, day_of)
+                if db is not None:
+                    database.load_day(db, table, day_of)
+            stats['write_s'] += time.perf_counter() - t0
+            manifest.add(day_of, 'written')
+            print(day_of, ": Complete", (table.num_rows, table.num_columns))
+
+            if state is not None:
+                found = set(table.column('lake').unique().to_pylist()) if regions else {None}
+                for lake in set(day_regions[day_of] or [None]) - found:
+                    state.add_empty(lake, day_of)
+
+        except Exception as e:
+            print("No data for", day_of, ":", e)
+
+        finally:
+            if isinstance(granule, str):
+                os.remove(granule)
+
+    # downloads feed a bounded queue of decode jobs, run in worker processes if processes > 1;
+    # decoded tables are written in date order by this process
+    # workers are spawned (not forked) so they start small and do not inherit download threads
+    pool = None
+    if processes > 1:
+        pool = ProcessPoolExecutor(max_workers=processes, mp_context=mp.get_context('spawn'))
+    max_pending = 2 * processes if pool else 1
+    pending = deque()
+
+    granules = download.download_granules(urls, local=local, workers=workers, retries=retries,
+                                          manifest=manifest, in_memory=in_memory, cache=cache,
+                                          stats=stats)
+    for day_of, granule in granules:
+        print(day_of, ": Processing", urls[day_of])
+        if granule is None:
             print("No data for", day_of)
-
-    print("Extraction Completed. Data size:", df.shape)
-
-    df.to_parquet(local + file)
-    print("File saved:", local + file, '\n')
+            if state is not None and manifest.status(day_of) == 'nodata':
+                state.add_nodata(day_of)
+            continue
+
+        if pool is None:
+            job = Future()
+            try:
+                job.set_result(decode_day(day_of, granule, day_regions[day_of]))
+            except Exception as e:
+                job.set_exception(e)
+        else:
+            job = pool.submit(decode_day, day_of, granule, day_regions[day_of])
+
+        pending.append((day_of, granule, job))
+        if len(pending) >= max_pending:
+            write(*pending.popleft())
+
+    while pending:
+        write(*pending.popleft())
+    if pool is not None:
+        pool.shutdown()
+
+    metrics.record('extract_cyan', days=len(urls), rows_out=out.rows, files=stats['files'],
+                   bytes=stats['bytes'], download_s=round(stats['download_s'], 4),
+                   decode_s=round(stats['decode_s'], 4), write_s=round(stats['write_s'], 4),
+                   wall_s=round(time.perf_counter() - t_start, 4),
+                   peak_rss_mb=round(metrics.peak_rss_mb(), 1))
+    print("Extraction Completed. Rows written:", out.rows)
+    print(f"Stage timings: download {stats['download_s']:.1f}s "
+          f"({stats['files']} files, {stats['bytes']/1e6:,.1f} MB), "
+          f"decode {stats['decode_s']:.1f}s, write {stats['write_s']:.1f}s, "
+          f"total {time.perf_counter()-t_start:.1f}s")
+    print("Dataset saved:", out.root, '\n')
+    manifest.remove()
 
 
 if __name__ == '__main__':
@@ -1,13 +1,22 @@
+import time
 import argparse
+import pandas as pd
 import dash
 from dash import dcc, html
 from dash.dependencies import Input, Output
 import plotly.graph_objs as go
 from plotly.subplots import make_subplots
 from utils import dataprep
+from utils import lakes as lake_registry
+from utils import metrics, render
+from utils.cube import PixelCube
+from utils.cache import LRUCache
 
 app = dash.Dash(__name__)
 
+# lakes loaded in memory, the least recently used are evicted (size set in run)
+lakes = LRUCache(maxsize=4)
+
 
 def main():
 
@@ -18,18 +27,83 @@ def main():
         "--path",
         type=str,
         default="data/L3B_CYAN_DAILY_JORDAN.parquet",
-        help="Path of CYAN data file",
+        help="Path of CYAN data file, or of a dataset partitioned by lake",
+    )
+
+    parser.add_argument(
+        "-cachesize",
+        "--cachesize",
+        type=int,
+        default=64,
+        help="Number of date ranges kept in the dashboard caches of each lake",
+    )
+
+    parser.add_argument(
+        "-nofigcache",
+        "--nofigcache",
+        action='store_true',
+        help="Do not cache rendered figures (only the filtered aggregates)",
+    )
+
+    parser.add_argument(
+        "-maxlakes",
+        "--maxlakes",
+        type=int,
+        default=4,
+        help="Maximum number of lakes kept in memory",
+    )
+
+    parser.add_argument(
+        "-datefrom",
+        "--datefrom",
+        type=int,
+        default=None,
+        help="First date to load, e.g. 20220101 (default: all dates)",
+    )
+
+    parser.add_argument(
+        "-maxpoints",
+        "--maxpoints",
+        type=int,
+        default=render.MAX_LINE_POINTS,
+        help="Maximum number of dates drawn in the daily line plot (longer ranges are decimated)",
+    )
+
+    parser.add_argument(
+        "-metrics",
+        "--metrics",
+        type=str,
+        default=None,
+        help="Append the timings, rows, bytes and peak memory of each stage to this JSON lines file",
+    )
+
+    parser.add_argument(
+        "-profile",
+        "--profile",
+        type=str,
+        default=None,
+        help="Run under cProfile (until the server stops) and save the statistics to this file",
+    )
+
+    parser.add_argument(
+        "-tracemem",
+        "--tracemem",
+        action='store_true',
+        help="Also record the peak Python memory of each stage (tracemalloc, slower)",
     )
 
     args = parser.parse_args()
+    metrics.configure(args.metrics, trace_memory=args.tracemem)
 
     try:
-        run(file=args.path)
+        with metrics.profile(args.profile):
+            run(file=args.path, cache_size=args.cachesize, cache_figures=not args.nofigcache,
+                max_lakes=args.maxlakes, date_from=args.datefrom, max_points=args.maxpoints)
 
-        app.run_server(debug=True)
+            app.run_server(debug=True)
 
-    except:
-        print("Data file not found.")
+    except FileNotFoundError as e:
+        print("Data file not found:", e)
 
 
 # file = 'data/L3B_CYAN_DAILY_JORDAN.parquet'
@@ -37,58 +111,279 @@ def main():
 # file = 'data/L3B_CYAN_DAILY_MATT.parquet'
 
 
-def run(file):
-    df = dataprep.getdata(file)
-    df = dataprep.hab_level(df)
-
-    x_range = df.clon.max()-df.clon.min()
-    y_range = df.clat.max()-df.clat.min()
-    pltf = 500
-    pltw = pltf*(x_range/0.1)
-    plth = pltf*(y_range/0.1)
-
-    p1 = df.groupby('date').CI_cyano.mean().reset_index()
-
-    df_day = df.groupby('date').agg(CI_cyano=('CI_cyano', 'mean'),
-                                    nobs=('clat', 'count'),
-                                    hab_high=('HAB_HIGH', 'sum'),
-                                    hab_high_med=('HAB_HIGH_MED', 'sum')).reset_index()
-    df_day['year'] = df_day.date.dt.year
-    df_day['month'] = df_day.date.dt.month
-    df_day['pct_hab_high'] = df_day.hab_high/df_day.nobs
-    df_day['pct_hab_high_med'] = df_day.hab_high_med/df_day.nobs
-
-    p2 = df_day.pivot_table(index='year', columns='month', values='CI_cyano',
-                            aggfunc='mean', margins=True, margins_name='Average')
-    p2.columns = list(p2.columns[:-1])+[13]
-    p2.index = list(p2.index[:-1])+[p2.index[:-1].max()+1]
-    xticks = p2.columns[:-1].tolist()+['Average']
-    yticks = p2.index[:-1].tolist()
-
-    p3 = df_day.pivot_table(index='year', columns='month', values='nobs',
-                            aggfunc='sum', margins=False)
-
-    pltw2 = 1300
-    plth2 = len(p2)*50
-
-    df_loc = df.groupby(['clat', 'clon']).agg(CI_cyano=('CI_cyano', 'mean'),
-                                              CI_cyano_median=(
-        'CI_cyano', 'median'),
-        nobs=('date', 'count'),
-        hab_high=('HAB_HIGH', 'sum'),
-        hab_high_med=('HAB_HIGH_MED', 'sum')).reset_index()
-    df_loc['pct_hab_high'] = df_loc.hab_high/df_loc.nobs
-    df_loc['pct_hab_high_med'] = df_loc.hab_high_med/df_loc.nobs
+def date_key(start_date, end_date):
+    """
+    Normalize a date picker range ('YYYY-MM-DD' or ISO datetime strings) to a cache key
+    """
+    return (pd.Timestamp(start_date).strftime('%Y-%m-%d'),
+            pd.Timestamp(end_date).strftime('%Y-%m-%d'))
+
+
+def preset_ranges(date_min, date_max):
+    """
+    Date ranges requested by most users: the full period, the last 30 days,
+    and the bloom season to date (from May 1st)
+    """
+    season_start = pd.Timestamp(year=date_max.year, month=5, day=1)
+    if season_start > date_max:
+        season_start = pd.Timestamp(year=date_max.year - 1, month=5, day=1)
+
+    return {'all': date_key(date_min, date_max),
+            'last 30 days': date_key(max(date_min, date_max - pd.Timedelta(days=29)), date_max),
+            'season to date': date_key(max(date_min, season_start), date_max)}
+
+
+@app.server.route('/metrics')
+def stage_metrics():
+    """
+    Totals per stage of the dashboard: loads and date range callbacks
+    """
+    summary = metrics.summary()
+    if summary.empty:
+        return {}
+
+    return summary.astype(object).where(summary.notna(), None).to_dict(orient='index')
+
+
+@app.server.route('/cache-stats')
+def cache_stats():
+    """
+    Hit/miss counters of the dashboard caches, and render time and payload size of the last
+    date range shown of each lake
+    """
+    stats = {'lakes': lakes.info()}
+    for name, view in list(lakes.data.items()):
+        stats[name or 'all'] = {'aggregates': view.aggregates.info()}
+        if view.figures is not None:
+            stats[name or 'all']['figures'] = view.figures.info()
+        if view.last_render is not None:
+            stats[name or 'all']['last_render'] = view.last_render
+
+    return stats
+
+
+class LakeView:
+    """
+    Data of one lake shown by the dashboard: daily per-pixel cube, monthly heatmaps, and
+    caches of the date range results. Only the columns used are read, and only the
+    partition of the lake if the data is partitioned by lake.
+    """
+
+    @metrics.timed('dashboard.load')
+    def __init__(self, file, lake=None, cache_size=64, cache_figures=True, date_from=None,
+                 max_points=render.MAX_LINE_POINTS):
+        df = dataprep.getdata(file, lake=lake, columns=['clat', 'clon', 'date', 'CI_cyano'],
+                              date_from=date_from)
+        dataprep.hab_level(df, thresholds=lake_registry.hab_thresholds().get(
+            lake, dataprep.HAB_THRESHOLDS), inplace=True)
+
+        self.name = lake or file
+        self.max_points = max_points
+        self.last_render = None
+        self.date_min = df['date'].min()
+        self.date_max = df['date'].max()
+        self.lon = (df.clon.min(), df.clon.max())
+        self.lat = (df.clat.min(), df.clat.max())
+
+        x_range = df.clon.max()-df.clon.min()
+        y_range = df.clat.max()-df.clat.min()
+        pltf = 500
+        self.pltw = pltf*(x_range/0.1)
+        self.plth = pltf*(y_range/0.1)
+
+        # daily per-pixel aggregates, shared by the summaries and the date range callback
+        self.cube = PixelCube(df)
+        del df
+        self.heatmap_cyano, self.heatmap_obs = self.make_heatmaps()
+
+        # caches keyed by date range, shared by all users: filtered aggregates and figures
+        self.aggregates = LRUCache(maxsize=cache_size)
+        self.figures = LRUCache(maxsize=cache_size) if cache_figures else None
+
+        # warm the caches with the preset ranges
+        for start_date, end_date in preset_ranges(self.date_min, self.date_max).values():
+            self.update(start_date, end_date)
+
+    def make_heatmaps(self):
+        df_day = self.cube.daily.copy()
+        df_day['year'] = df_day.date.dt.year
+        df_day['month'] = df_day.date.dt.month
+        df_day['pct_hab_high'] = df_day.hab_high/df_day.nobs
+        df_day['pct_hab_high_med'] = df_day.hab_high_med/df_day.nobs
+
+        p2 = df_day.pivot_table(index='year', columns='month', values='CI_cyano',
+                                aggfunc='mean', margins=True, margins_name='Average')
+        p2.columns = list(p2.columns[:-1])+[13]
+        p2.index = list(p2.index[:-1])+[p2.index[:-1].max()+1]
+        xticks = p2.columns[:-1].tolist()+['Average']
+        yticks = p2.index[:-1].tolist()
+
+        p3 = df_day.pivot_table(index='year', columns='month', values='nobs',
+                                aggfunc='sum', margins=False)
+
+        pltw2 = 1300
+        plth2 = len(p2)*50
+
+        heatmap_cyano = {
+            'data': [
+                go.Heatmap(
+                    z=p2.values,
+                    x=p2.columns,
+                    y=p2.index,
+                    colorscale='Spectral_r',
+                    zmin=p2.values.min(),
+                    zmax=p2.values.max(),
+                    zhoverformat='.6f',
+                    texttemplate="%{z:.4f}"
+                )
+            ],
+            'layout': go.Layout(
+                title='Average Cyanobacteria Level by month',
+                width=pltw2, height=plth2,
+                xaxis=dict(title='Month', ticktext=xticks),
+                yaxis=dict(title='Year', ticktext=yticks,
+                           autorange='reversed'),
+            )
+        }
+
+        heatmap_obs = {
+            'data': [
+                go.Heatmap(
+                    z=p3.values,
+                    x=p3.columns,
+                    y=p3.index,
+                    colorscale='Spectral_r',
+                    zmin=p3.values.min(),
+                    zmax=p3.values.max(),
+                    zhoverformat=',',
+                    texttemplate="%{z:,}"
+                )
+            ],
+            'layout': go.Layout(
+                title='No. Observations by month',
+                width=pltw2, height=plth2,
+                xaxis=dict(title='Month', ticktext=xticks),
+                yaxis=dict(title='Year', ticktext=yticks,
+                           autorange='reversed'),
+            )
+        }
+
+        return heatmap_cyano, heatmap_obs
+
+    def filter_range(self, start_date, end_date):
+        return self.cube.pixels(start_date, end_date), self.cube.days(start_date, end_date)
+
+    def make_figures(self, start_date, end_date):
+        filtered_df, filtered_df2 = self.aggregates.get_or_set(
+            (start_date, end_date), lambda: self.filter_range(start_date, end_date))
+
+        # Create subplots
+        fig = make_subplots(rows=1, cols=2,
+                            subplot_titles=('No. Observations', 'Average CI_cyano'))
+
+        # pixel maps drawn with WebGL or as a heatmap for large lakes, see utils.render
+        fig.add_trace(render.pixel_trace(filtered_df.clat, filtered_df.clon, filtered_df.nobs,
+                                         'No. observations', ',', 'coloraxis', size=9),
+                      row=1, col=1)
+        fig.add_trace(render.pixel_trace(filtered_df.clat, filtered_df.clon, filtered_df.CI_cyano,
+                                         'CI_cyano', '.6f', 'coloraxis2'),
+                      row=1, col=2)
+
+        # Update subplot layout
+        fig.update_layout(
+            title='Cyanobacteria Levels by Longitude/Latitude locations',
+            width=self.pltw*1.7, height=self.plth,
+            coloraxis=dict(colorscale='Spectral_r', colorbar_x=0.45,
+                           colorbar_thickness=23),
+            coloraxis2=dict(colorscale='Spectral_r',
+                            colorbar_x=1, colorbar_thickness=23)
+        )
+
+        fig.update_xaxes(title_text="Longitude", row=1, col=1)
+        fig.update_yaxes(title_text="Latitude", row=1, col=1)
+        fig.update_xaxes(title_text="Longitude", row=1, col=2)
+        fig.update_yaxes(visible=True, showticklabels=False, row=1, col=2)
+
+        # long ranges are decimated to max_points dates, keeping the shape of the series
+        keep = render.decimate(filtered_df2.date.values, filtered_df2.CI_cyano.values,
+                               self.max_points)
+        fig2 = go.Figure(data=go.Scatter(
+            x=filtered_df2.date.values[keep],
+            y=filtered_df2.CI_cyano.values[keep],
+            mode='lines',
+            name='CI_cyano',
+            hovertemplate='CI_cyano: %{y:.6f}<br>%{x}<extra></extra>'
+        ))
+        title = 'Daily Average Cyanobacteria Level'
+        if len(keep) < len(filtered_df2):
+            title += f' ({len(keep):,} of {len(filtered_df2):,} days shown)'
+        fig2.update_layout(title=title,
+                           xaxis_title='date', yaxis_title='CI_cyano')
+
+        text = f"\nNo. of observations: {filtered_df.nobs.sum():,.0f}" + \
+            f"\nNo. of pixels: {len(filtered_df):,.0f}" + \
+            f"\nCI cyano - average: {filtered_df.CI_cyano.mean():.6f}" + \
+            f"\nCI cyano - minimum: {filtered_df.CI_cyano.min():.6f}" + \
+            f"\nCI cyano - maximum: {filtered_df.CI_cyano.max():.6f}"
+
+        fig, fig2 = fig.to_dict(), fig2.to_dict()
+
+        return fig, fig2, text, render.payload_size(fig, fig2)
+
+    def update(self, start_date, end_date):
+        """
+        Figures and summary of a date range; the render time and payload size are printed and
+        kept for /cache-stats
+        """
+        key = date_key(start_date, end_date)
+        t0 = time.perf_counter()
+        with metrics.stage('dashboard.update', lake=self.name, start=key[0], end=key[1],
+                           cached=self.figures is not None and key in self.figures) as info:
+            if self.figures is None:
+                *out, nbytes = self.make_figures(*key)
+            else:
+                *out, nbytes = self.figures.get_or_set(key, lambda: self.make_figures(*key))
+            info['bytes'] = nbytes
+
+        self.last_render = {'range': key, 'seconds': time.perf_counter() - t0, 'bytes': nbytes}
+        print(f"{self.name} {key[0]} - {key[1]}: {self.last_render['seconds']*1000:.0f} ms, "
+              f"{nbytes/1e3:,.0f} kB")
+
+        return tuple(out)
+
+
+def run(file, cache_size=64, cache_figures=True, max_lakes=4, date_from=None,
+        max_points=render.MAX_LINE_POINTS):
+    lakes.maxsize = max_lakes
+    if date_from is not None:
+        date_from = pd.to_datetime(str(date_from))
+
+    # lakes of a dataset partitioned by lake, or the whole file as a single lake ('')
+    names = dataprep.list_lakes(file) or ['']
+    options = [{'label': name or file, 'value': name} for name in names]
+
+    def get_lake(name):
+        """
+        Lake data, loaded on first access
+        """
+        return lakes.get_or_set(name, lambda: LakeView(file, lake=name or None,
+                                                       cache_size=cache_size,
+                                                       cache_figures=cache_figures,
+                                                       date_from=date_from,
+                                                       max_points=max_points))
+
+    view = get_lake(names[0])
 
     # Define the layout of the app
     app.layout = html.Div([
-        html.H1(file),
+        html.H1(id='title', children=view.name),
+
+        dcc.Dropdown(id='lake', options=options, value=names[0], clearable=False,
+                     style={'width': '50%'}),
 
         # Descriptive statistics
         html.Div([
-            html.H3(
-                (f'Longitude: [{min(df.clon):.4f}, {max(df.clon):.4f}]      Latitude: [{min(df.clat):.4f}, {max(df.clat):.4f}]\n'),
-            )
+            html.H3(id='extent')
         ], style={'width': '100%', 'display': 'inline-block'}),
 
 
@@ -97,8 +392,8 @@ def run(file):
         html.Div([
             dcc.DatePickerRange(
                 id='date-picker-range',
-                start_date=df['date'].min(),
-                end_date=df['date'].max(),
+                start_date=view.date_min,
+                end_date=view.date_max,
                 display_format='YYYY-MM-DD',
                 style={'display': 'inline-block', 'width': '100%'}
             ),
@@ -111,156 +406,42 @@ def run(file):
         ], className='six columns'),
 
         html.Div([
-            dcc.Graph(
-                id='heatmap-cyano',
-                figure={
-                    'data': [
-                        go.Heatmap(
-                            z=p2.values,
-                            x=p2.columns,
-                            y=p2.index,
-                            colorscale='Spectral_r',
-                            zmin=p2.values.min(),
-                            zmax=p2.values.max(),
-                            zhoverformat='.6f',
-                            texttemplate="%{z:.4f}"
-                        )
-                    ],
-                    'layout': go.Layout(
-                        title='Average Cyanobacteria Level by month',
-                        width=pltw2, height=plth2,
-                        xaxis=dict(title='Month', ticktext=xticks),
-                        yaxis=dict(title='Year', ticktext=yticks,
-                                   autorange='reversed'),
-                    )
-                }
-            )
+            dcc.Graph(id='heatmap-cyano')
         ], className='six columns'),
 
         html.Div([
-            dcc.Graph(
-                id='heatmap-obs',
-                figure={
-                    'data': [
-                        go.Heatmap(
-                            z=p3.values,
-                            x=p3.columns,
-                            y=p3.index,
-                            colorscale='Spectral_r',
-                            zmin=p3.values.min(),
-                            zmax=p3.values.max(),
-                            zhoverformat=',',
-                            texttemplate="%{z:,}"
-                        )
-                    ],
-                    'layout': go.Layout(
-                        title='No. Observations by month',
-                        width=pltw2, height=plth2,
-                        xaxis=dict(title='Month', ticktext=xticks),
-                        yaxis=dict(title='Year', ticktext=yticks,
-                                   autorange='reversed'),
-                    )
-                }
-            )
+            dcc.Graph(id='heatmap-obs')
         ], className='six columns'),
 
 
     ], className='row')
 
+    @app.callback(
+        [Output('title', 'children'),
+         Output('extent', 'children'),
+         Output('heatmap-cyano', 'figure'),
+         Output('heatmap-obs', 'figure'),
+         Output('date-picker-range', 'start_date'),
+         Output('date-picker-range', 'end_date')],
+        [Input('lake', 'value')]
+    )
+    def select_lake(name):
+        view = get_lake(name)
+        extent = f'Longitude: [{view.lon[0]:.4f}, {view.lon[1]:.4f}]      Latitude: [{view.lat[0]:.4f}, {view.lat[1]:.4f}]\n'
+
+        return (view.name, extent, view.heatmap_cyano, view.heatmap_obs,
+                view.date_min, view.date_max)
+
     @app.callback(
         [Output('scatter-plot', 'figure'),
          Output('line-plot', 'figure'),
          Output('text', 'children')],
-        [Input('date-picker-range', 'start_date'),
+        [Input('lake', 'value'),
+         Input('date-picker-range', 'start_date'),
          Input('date-picker-range', 'end_date')]
     )
-    def update_scatter_plot(start_date, end_date):
-        df2 = df[(df['date'] >= start_date) & (df['date'] <= end_date)]
-
-        filtered_df = df2.groupby(['clat', 'clon']).agg(
-            CI_cyano=('CI_cyano', 'mean'), nobs=('CI_cyano', 'count')).reset_index()
-        filtered_df2 = df2.groupby('date').CI_cyano.mean().reset_index()
-
-        # Create subplots
-        fig = make_subplots(rows=1, cols=2,
-                            subplot_titles=('No. Observations', 'Average CI_cyano'))
-
-        # Add traces to subplot 1
-        fig.add_trace(
-            go.Scatter(
-                x=filtered_df['clon'],
-                y=filtered_df['clat'],
-                mode='markers',
-                marker=dict(
-                    size=9,
-                    color=filtered_df.nobs,
-                    colorscale='Spectral_r',
-                    showscale=True,
-                    opacity=0.8,
-                    coloraxis='coloraxis'
-                ),
-                text=filtered_df['nobs'].apply(
-                    lambda x: f'No. observations: {x:,}'),
-                hoverinfo='text+x+y'
-            ),
-            row=1, col=1
-        )
-
-        # Add traces to subplot 2
-        fig.add_trace(
-            go.Scatter(
-                x=filtered_df.clon,
-                y=filtered_df.clat,
-                mode='markers',
-                marker=dict(
-                    size=8,
-                    color=filtered_df.CI_cyano,
-                    colorscale='Spectral_r',
-                    showscale=True,
-                    opacity=0.8,
-                    coloraxis='coloraxis2'
-                ),
-                text=filtered_df['CI_cyano'].apply(
-                    lambda x: f'CI_cyano: {x:.6f}'),
-                hoverinfo='text+x+y'
-            ),
-            row=1, col=2
-        )
-
-        # Update subplot layout
-        fig.update_layout(
-            title='Cyanobacteria Levels by Longitude/Latitude locations',
-            width=pltw*1.7, height=plth,
-            coloraxis=dict(colorscale='Spectral_r', colorbar_x=0.45,
-                           colorbar_thickness=23),
-            coloraxis2=dict(colorscale='Spectral_r',
-                            colorbar_x=1, colorbar_thickness=23)
-        )
-
-        fig.update_xaxes(title_text="Longitude", row=1, col=1)
-        fig.update_yaxes(title_text="Latitude", row=1, col=1)
-        fig.update_xaxes(title_text="Longitude", row=1, col=2)
-        fig.update_yaxes(visible=True, showticklabels=False, row=1, col=2)
-
-        fig2 = go.Figure(data=go.Scatter(
-            x=filtered_df2.date,
-            y=filtered_df2.CI_cyano,
-            mode='lines',
-            name='CI_cyano',
-            text=filtered_df2['CI_cyano'].apply(
-                lambda x: f'CI_cyano: {x:.6f}'),
-            hoverinfo='text+x'
-        ))
-        fig2.update_layout(title='Daily Average Cyanobacteria Level',
-                           xaxis_title='date', yaxis_title='CI_cyano')
-
-        text = f"\nNo. of observations: {len(df2):,.0f}" + \
-            f"\nNo. of pixels: {len(filtered_df):,.0f}" + \
-            f"\nCI cyano - average: {filtered_df.CI_cyano.mean():.6f}" + \
-            f"\nCI cyano - minimum: {filtered_df.CI_cyano.min():.6f}" + \
-            f"\nCI cyano - maximum: {filtered_df.CI_cyano.max():.6f}"
-
-        return fig, fig2, text
+    def update_scatter_plot(name, start_date, end_date):
+        return get_lake(name).update(start_date, end_date)
 
 
 if __name__ == '__main__':
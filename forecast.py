@@ -1,6 +1,9 @@
+import os
 import argparse
 import pandas as pd
-from utils import dataprep, sarima
+from utils import dataprep, sarima, batch, metrics, backtest
+from utils.registry import ModelRegistry
+from utils.decompose import Decomposition
 
 
 def main():
@@ -15,19 +18,185 @@ def main():
         help="Path of CYAN data file",
     )
 
+    parser.add_argument(
+        "-batch",
+        "--batch",
+        type=str,
+        default=None,
+        choices=['lake', 'pixel'],
+        help="Forecast many series in parallel: one per lake, or one per cluster of pixels",
+    )
+
+    parser.add_argument(
+        "-procs",
+        "--procs",
+        type=int,
+        default=4,
+        help="Number of worker processes for batch forecasting and -btrefit backtests",
+    )
+
+    parser.add_argument(
+        "-timeout",
+        "--timeout",
+        type=int,
+        default=900,
+        help="Time limit in seconds to fit one series in batch forecasting",
+    )
+
+    parser.add_argument(
+        "-cellsize",
+        "--cellsize",
+        type=float,
+        default=0.02,
+        help="Size in degrees of the pixel clusters for -batch pixel",
+    )
+
+    parser.add_argument(
+        "-output",
+        "--output",
+        type=str,
+        default="data/forecast.parquet",
+        help="Output file of batch forecasting (.parquet or .csv)",
+    )
+
+    parser.add_argument(
+        "-registry",
+        "--registry",
+        type=str,
+        default=None,
+        help="Model registry file (JSON): reuse the SARIMA orders and parameters of previous runs",
+    )
+
+    parser.add_argument(
+        "-maxage",
+        "--maxage",
+        type=int,
+        default=28,
+        help="Days after which the registered SARIMA orders are searched again",
+    )
+
+    parser.add_argument(
+        "-research",
+        "--research",
+        action="store_true",
+        help="Force a full search of the SARIMA orders, and update the registry",
+    )
+
+    parser.add_argument(
+        "-bbox",
+        "--bbox",
+        type=float,
+        nargs=4,
+        default=None,
+        help="Only use the pixels inside a bounding box: lon_min lat_min lon_max lat_max",
+    )
+
+    parser.add_argument(
+        "-datefrom",
+        "--datefrom",
+        type=int,
+        default=None,
+        help="First date of the training data, e.g. 20190101 (default: all dates)",
+    )
+
+    parser.add_argument(
+        "-stream",
+        "--stream",
+        action="store_true",
+        help="Stream the dataset in record batches and keep only daily means (bounded memory)",
+    )
+
+    parser.add_argument(
+        "-backtest",
+        "--backtest",
+        action="store_true",
+        help="Backtest the fitted model: 12-week forecasts from every past week, with their errors",
+    )
+
+    parser.add_argument(
+        "-btstep",
+        "--btstep",
+        type=int,
+        default=1,
+        help="Weeks between two forecast origins of the backtest",
+    )
+
+    parser.add_argument(
+        "-btrefit",
+        "--btrefit",
+        action="store_true",
+        help="Re-estimate the model parameters at each backtest origin (slower)",
+    )
+
+    parser.add_argument(
+        "-metrics",
+        "--metrics",
+        type=str,
+        default=None,
+        help="Append the timings, rows, bytes and peak memory of each stage to this JSON lines file",
+    )
+
+    parser.add_argument(
+        "-profile",
+        "--profile",
+        type=str,
+        default=None,
+        help="Run under cProfile and save the statistics to this file",
+    )
+
+    parser.add_argument(
+        "-tracemem",
+        "--tracemem",
+        action='store_true',
+        help="Also record the peak Python memory of each stage (tracemalloc, slower)",
+    )
+
     args = parser.parse_args()
+    date_from = pd.to_datetime(str(args.datefrom)) if args.datefrom else None
+    metrics.configure(args.metrics, trace_memory=args.tracemem)
 
     try:
-        run(file=args.path)
+        with metrics.profile(args.profile):
+            if args.batch:
+                run_batch(file=args.path, by=args.batch, output=args.output,
+                          processes=args.procs, timeout=args.timeout, cell_size=args.cellsize,
+                          registry=args.registry, max_age_days=args.maxage,
+                          research=args.research, bbox=args.bbox, date_from=date_from,
+                          stream=args.stream)
+            else:
+                run(file=args.path, registry=args.registry, max_age_days=args.maxage,
+                    research=args.research, bbox=args.bbox, date_from=date_from,
+                    stream=args.stream, backtest_step=args.btstep if args.backtest else None,
+                    backtest_refit=args.btrefit, processes=args.procs)
+        metrics.report()
 
-    except:
-        print("Data file not found.")
+    except FileNotFoundError as e:
+        print("Data file not found:", e)
 
 
-def run(file):
+def registry_key(file, bbox=None, date_from=None):
+    """
+    Model registry key of the series of a data file: the file name, with the bbox and first
+    date when the series is limited to them, so that each selection keeps its own model
+    """
+    key = os.path.basename(os.path.normpath(file))
+    if bbox is not None:
+        key += ':bbox=' + ','.join(f'{v:g}' for v in bbox)
+    if date_from is not None:
+        key += ':from=' + pd.Timestamp(date_from).strftime('%Y%m%d')
+
+    return key
+
+
+def run(file, registry=None, max_age_days=28, research=False, bbox=None, date_from=None,
+        stream=False, backtest_step=None, backtest_refit=False, processes=1):
     # extract data
-    print("Extracting data...")
-    df = dataprep.getdata(file)
+    if stream:
+        print("Streaming daily means...")
+        df = dataprep.daily_means(file, bbox=bbox, date_from=date_from)
+    else:
+        print("Extracting data...")
+        df = dataprep.getdata(file, columns=['date', 'CI_cyano'], bbox=bbox, date_from=date_from)
     print("Extracted data size:", df.shape)
 
     # prepare data
@@ -36,9 +205,18 @@ def run(file):
     print("Processed data size:", df_weekly_imp.shape)
 
     # train SARIMA model
-    print("\nOptimizing SARIMA model...")
-    model_name, smodel = sarima.train(df_weekly_imp)
-    print("Final model:", model_name)
+    if registry:
+        print("\nFitting SARIMA model from registry...")
+        models = ModelRegistry(registry)
+        key = registry_key(file, bbox=bbox, date_from=date_from)
+        model_name, smodel, entry, action = sarima.train_cached(
+            df_weekly_imp, models.get(key), max_age_days=max_age_days, research=research)
+        models.put(key, entry)
+        print("Final model:", model_name, f"({action})")
+    else:
+        print("\nOptimizing SARIMA model...")
+        model_name, smodel = sarima.train(df_weekly_imp)
+        print("Final model:", model_name)
 
     # generate predictions
     print("\nGenerating predictions...")
@@ -50,10 +228,75 @@ def run(file):
                                'upper bound': dfcst.yhat_upper.values, }, index=dfcst.date.values)
     print(dfcst_show)
 
+    # backtest the model on the past weeks
+    if backtest_step:
+        print("\nBacktesting...")
+        try:
+            bt = backtest.run(df_weekly_imp, smodel, horizon=nweeks, step=backtest_step,
+                              refit=backtest_refit, processes=processes)
+            print(f"{bt.origin.nunique()} forecast origins, accuracy by week ahead:\n")
+            print(backtest.evaluate(bt).to_string(float_format='%.4g'))
+        except ValueError as e:
+            print("Backtest skipped:", e)
+
     # plot forecast and decomposition
     sarima.decomp_ts(df_weekly_imp.set_index('date').CI_cyano)
     sarima.plot_fcst(dfitted, dfcst, model_name)
 
 
+def run_batch(file, by='lake', output='data/forecast.parquet', processes=4, timeout=900,
+              cell_size=0.02, nweeks=12, registry=None, max_age_days=28, research=False,
+              bbox=None, date_from=None, stream=False):
+    # extract data
+    by_lake = bool(dataprep.list_lakes(file))
+    if stream and by == 'lake':
+        print("Streaming daily means...")
+        df = dataprep.daily_means(file, bbox=bbox, date_from=date_from, by_lake=by_lake)
+    else:
+        if stream:
+            print("Pixel clusters need pixel rows: -stream is ignored")
+        print("Extracting data...")
+        columns = ['date', 'CI_cyano']
+        if by == 'pixel':
+            columns += ['clat', 'clon']
+        if by_lake:
+            columns.append('lake')
+        df = dataprep.getdata(file, columns=columns, bbox=bbox, date_from=date_from)
+    print("Extracted data size:", df.shape)
+
+    if by == 'lake':
+        series = batch.lake_series(df)
+    else:
+        series = batch.pixel_clusters(df, size=cell_size)
+    print(f"\nForecasting {len(series)} series with {processes} processes...")
+
+    models = ModelRegistry(registry) if registry else None
+    dfcst, summary = batch.forecast_batch(series, n=nweeks, processes=processes,
+                                          timeout=timeout, registry=models,
+                                          max_age_days=max_age_days, research=research)
+
+    if output.endswith('.csv'):
+        dfcst.to_csv(output, index=False)
+    else:
+        dfcst.to_parquet(output, index=False)
+    print("Forecasts saved:", output, dfcst.shape)
+    print(summary.status.value_counts().to_string())
+
+    # trend and anomalous weeks of every series, from one batched decomposition
+    weekly = pd.concat([sarima.prep_data(d).assign(series=name) for name, d in series.items()],
+                       ignore_index=True)
+    dec = Decomposition.from_weekly(weekly, by='series')
+    report = dec.trend_report()
+    anomalies = dec.anomalies()
+    report['anomalies'] = report.series.map(anomalies.series.value_counts()).fillna(0).astype(int)
+    root, ext = os.path.splitext(output)
+    if ext == '.csv':
+        report.to_csv(root + '_trend.csv', index=False)
+    else:
+        report.to_parquet(root + '_trend' + ext, index=False)
+    print("Trend report saved:", root + '_trend' + ext,
+          f"({len(anomalies)} anomalous weeks in {(report.anomalies > 0).sum()} series)")
+
+
 if __name__ == '__main__':
     main()
@@ -0,0 +1,42 @@
+import os
+import time
+import pandas as pd
+from utils import batch
+
+
+def series_pid(name, df, n):
+    """
+    Stand-in for batch.forecast_series: one row with the worker process id, and a failure or a
+    long fit for some series
+    """
+    if name == 'bad':
+        raise ValueError('no data')
+    if name == 'slow':
+        time.sleep(60)
+
+    return pd.DataFrame({'series': [name], 'pid': [os.getpid()]}), 'model'
+
+
+def test_forecast_batch_reuses_workers():
+    series = {f's{i}': pd.DataFrame() for i in range(12)}
+
+    dfcst, summary = batch.forecast_batch(series, processes=2, func=series_pid)
+
+    assert (summary.status == 'ok').all() and len(summary) == 12
+    assert sorted(dfcst.series) == sorted(series)
+    assert dfcst.pid.nunique() <= 2
+
+
+def test_forecast_batch_timeout_restarts_one_worker():
+    series = {'slow': pd.DataFrame(), 'bad': pd.DataFrame(),
+              **{f's{i}': pd.DataFrame() for i in range(6)}}
+
+    t = time.perf_counter()
+    dfcst, summary = batch.forecast_batch(series, processes=2, timeout=5, func=series_pid)
+
+    assert time.perf_counter() - t < 60
+    status = summary.set_index('series').status
+    assert status['slow'] == 'timeout' and status['bad'] == 'error'
+    assert (status.drop(['slow', 'bad']) == 'ok').all()
+    # the other worker ran the remaining series
+    assert dfcst.pid.nunique() <= 2
@@ -0,0 +1,45 @@
+import numpy as np
+import pandas as pd
+import pytest
+from utils import dataprep, synthetic
+from utils.cube import PixelCube
+
+
+@pytest.fixture(scope='module')
+def lake():
+    df = synthetic.make_lake_data(npix=300, ndays=120, coverage=0.3)
+    rng = np.random.default_rng(2)
+    df.loc[rng.choice(len(df), 50, replace=False), 'CI_cyano'] = np.nan
+    # a pixel whose only observation in a date range has no value
+    first = df.date == df.date.min()
+    df.loc[first & (df.bin_num == df.bin_num[first].iloc[0]), 'CI_cyano'] = np.nan
+
+    return dataprep.hab_level(df)
+
+
+@pytest.mark.parametrize('start_date, end_date', [('2016-05-01', '2016-05-01'),
+                                                  ('2016-05-10', '2016-07-20'),
+                                                  ('2016-01-01', '2017-01-01')])
+def test_pixels_match_groupby(lake, start_date, end_date):
+    df = lake[(lake['date'] >= start_date) & (lake['date'] <= end_date)]
+    expected = df.groupby(['clat', 'clon']).agg(CI_cyano=('CI_cyano', 'mean'),
+                                                nobs=('CI_cyano', 'count')).reset_index()
+
+    out = PixelCube(lake).pixels(start_date, end_date)
+
+    assert len(out) == len(expected)
+
+    pd.testing.assert_frame_equal(out[['clat', 'clon', 'CI_cyano', 'nobs']].reset_index(drop=True),
+                                  expected, check_dtype=False, rtol=1e-9)
+
+
+def test_days_match_groupby(lake):
+    expected = lake.groupby('date').agg(CI_cyano=('CI_cyano', 'mean'),
+                                        nobs=('clat', 'count'),
+                                        hab_high=('HAB_HIGH', 'sum'),
+                                        hab_high_med=('HAB_HIGH_MED', 'sum')).reset_index()
+
+    out = PixelCube(lake).days('2016-05-01', '2016-08-28')
+
+    assert not out['CI_cyano'].isna().any()
+    pd.testing.assert_frame_equal(out, expected, check_dtype=False, rtol=1e-9)
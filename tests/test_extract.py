@@ -0,0 +1,55 @@
+import numpy as np
+import pandas as pd
+import pytest
+import cyan_extract
+from utils import lakes, synthetic
+
+
+def process_L3B_file_legacy(ds):
+    '''
+    process_L3B_file before vectorization (merge_asof + per-row apply)
+    '''
+    df_BinIndex = pd.DataFrame(ds.BinIndex.values).reset_index()
+
+    df = pd.DataFrame(ds.BinList.values)
+    for k in list(ds.keys())[1:-1]:
+        tmp = pd.DataFrame(ds[k].values)
+        df[k] = tmp['sum']
+
+    out = pd.merge_asof(left=df, right=df_BinIndex, left_on="bin_num",
+                        right_on="start_num", direction='backward')
+
+    nrows = ds.sizes['binIndexDim']
+    latbin = (np.arange(0, nrows, dtype=np.float64) + 0.5) * (180.0 / nrows) - 90.0
+    out['clat'] = out['index'].apply(lambda x: latbin[x])
+    out['clon'] = (360.0 * (out['bin_num'] - out['start_num'] + 0.5) / out['max']) - 180.0
+    out['north'] = out['clat'] + (90.0 / nrows)
+    out['south'] = out['clat'] - (90.0 / nrows)
+    out['west'] = out['clon'] - (180.0 / out['max'])
+    out['east'] = out['clon'] + (180.0 / out['max'])
+
+    out_cols = ['bin_num', 'CI_stumpf', 'CI_cyano', 'CI_noncyano', 'MCI_stumpf',
+                'clat', 'clon', 'north', 'south', 'west', 'east']
+
+    return out[out_cols]
+
+
+@pytest.mark.parametrize('nrows', [2160, 4320])
+def test_process_L3B_file_matches_legacy(nrows):
+    ds = synthetic.make_l3b_dataset(nrows=nrows, bbox=(-95.0, 35.0, -85.0, 45.0), coverage=0.2)
+
+    out = cyan_extract.process_L3B_file(ds)
+
+    pd.testing.assert_frame_equal(out, process_L3B_file_legacy(ds), check_exact=True)
+
+
+def test_process_L3B_file_regions():
+    ds = synthetic.make_l3b_dataset(nrows=4320, bbox=synthetic.lake_bboxes(), coverage=0.8)
+    legacy = process_L3B_file_legacy(ds)
+
+    out = cyan_extract.process_L3B_file(ds, regions=lakes.LAKES)
+
+    expected = pd.concat([legacy[lakes.in_region(legacy, region)].assign(lake=name)
+                          for name, region in lakes.LAKES.items()], ignore_index=True)
+    assert len(expected) > 0
+    pd.testing.assert_frame_equal(out, expected, check_exact=True)
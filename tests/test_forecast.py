@@ -0,0 +1,17 @@
+import pandas as pd
+from forecast import registry_key
+
+
+def test_registry_key_per_selection():
+    path = 'data/L3B_CYAN_DAILY_MENDOTA.parquet/'
+    bbox = [-89.5, 43.1, -89.4, 43.2]
+    keys = [registry_key(path),
+            registry_key(path, bbox=bbox),
+            registry_key(path, bbox=[-89.5, 43.1, -89.4, 43.15]),
+            registry_key(path, date_from=pd.Timestamp('2020-01-01')),
+            registry_key(path, bbox=bbox, date_from=pd.Timestamp('2020-01-01'))]
+
+    # the whole file keeps the key of earlier registries
+    assert keys[0] == 'L3B_CYAN_DAILY_MENDOTA.parquet'
+    assert len(set(keys)) == len(keys)
+    assert registry_key(path, bbox=tuple(bbox)) == keys[1]
@@ -0,0 +1,79 @@
+import datetime
+import numpy as np
+import pandas as pd
+import cyan_extract
+from utils import database, dataprep, schema, synthetic
+from utils.writer import DatasetWriter
+
+NROWS = 4320
+BBOX = (-89.6, 43.0, -89.3, 43.2)
+
+
+def decoded_days(days=3):
+    """
+    Decoded bins of a few synthetic days, as process_L3B_file returns them
+    """
+    out = []
+    for i in range(days):
+        ds = synthetic.make_l3b_dataset(nrows=NROWS, bbox=BBOX, coverage=0.5, seed=i)
+        df = cyan_extract.process_L3B_file(ds)
+        df['date'] = datetime.datetime(2024, 6, 1) + datetime.timedelta(days=i)
+        out.append(df)
+
+    return out
+
+
+def test_getdata_reads_baseline_file(tmp_path):
+    # written like the baseline extract_cyan: concat without ignore_index, then to_parquet,
+    # which stores the index as __index_level_0__
+    df = pd.DataFrame()
+    for day in decoded_days():
+        df = pd.concat([df, day], axis=0)
+    path = tmp_path / 'L3B_CYAN_DAILY.parquet'
+    df.to_parquet(path)
+
+    out = dataprep.getdata(str(path))
+
+    assert list(out.columns) == list(df.columns)
+    expected = df.reset_index(drop=True).astype({'date': 'datetime64[ns]'})
+    pd.testing.assert_frame_equal(out, expected)
+
+
+def test_getdata_compact_dataset(tmp_path):
+    days = decoded_days()
+    writer = DatasetWriter(str(tmp_path / 'cyan'))
+    for day in days:
+        writer.write_day(schema.storage_table(day, day['date'].iloc[0], NROWS),
+                         day['date'].iloc[0])
+    expected = pd.concat(days, ignore_index=True)
+
+    out = dataprep.getdata(str(tmp_path / 'cyan'))
+
+    assert 'year' not in out.columns and 'month' not in out.columns
+    assert list(out.columns) == list(expected.columns)
+    out = out.sort_values(['date', 'bin_num']).reset_index(drop=True)
+    np.testing.assert_array_equal(out['bin_num'], expected['bin_num'])
+    np.testing.assert_allclose(out['CI_cyano'], expected['CI_cyano'], rtol=1e-6)
+    for c in schema.GEOMETRY:
+        assert out[c].dtype == np.float64
+        np.testing.assert_allclose(out[c], expected[c], rtol=1e-12)
+
+
+def test_getdata_same_geometry_as_database(tmp_path):
+    writer = DatasetWriter(str(tmp_path / 'cyan'))
+    for day in decoded_days():
+        writer.write_day(schema.storage_table(day, day['date'].iloc[0], NROWS),
+                         day['date'].iloc[0])
+    url = 'sqlite:///' + str(tmp_path / 'cyan.db')
+    database.load_dataset(database.get_engine(url), str(tmp_path / 'cyan'))
+
+    columns = ['bin_num', 'clat', 'clon', 'date', 'CI_cyano']
+    from_parquet = dataprep.getdata(str(tmp_path / 'cyan'), columns=columns, bbox=BBOX)
+    from_db = dataprep.getdata(url, columns=columns, bbox=BBOX)
+
+    assert len(from_parquet) > 0
+    key = ['date', 'bin_num']
+    pd.testing.assert_frame_equal(from_parquet.sort_values(key).reset_index(drop=True),
+                                  from_db.sort_values(key).reset_index(drop=True),
+                                  check_dtype=False)
+    assert (from_parquet.dtypes[['clat', 'clon']] == from_db.dtypes[['clat', 'clon']]).all()
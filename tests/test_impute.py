@@ -0,0 +1,65 @@
+import numpy as np
+import pandas as pd
+from utils import dataprep, synthetic
+from utils.impute import SparseGrid, UNDER_DETECT
+
+
+def data_impute_baseline(df):
+    """
+    data_impute before SparseGrid: every location x date merged with the observations
+    """
+    locs = df.groupby(['clat', 'clon']).CI_cyano.count().reset_index()
+    dates = df.date.unique()
+
+    df_imp = pd.concat([locs[['clat', 'clon']].assign(date=d) for d in dates], axis=0)
+    df_imp = df_imp.reset_index(drop=True)
+    df_imp = pd.merge(df_imp, df[['clat', 'clon', 'date', 'CI_cyano']], how='left',
+                      on=['clat', 'clon', 'date'])
+    df_imp['CI_cyano'] = df_imp.CI_cyano.fillna(0.00005)
+    df_imp['Year'] = df_imp['date'].dt.year
+    df_imp['Month'] = df_imp['date'].dt.month
+    df_imp['Day'] = df_imp['date'].dt.day
+
+    return df_imp
+
+
+def lake_data(nan=20):
+    df = synthetic.make_lake_data(npix=200, ndays=60, coverage=0.3)
+    df = df.sort_values('date', kind='stable').reset_index(drop=True)
+    df['CI_cyano'] = df['CI_cyano'].astype(np.float64)
+    rng = np.random.default_rng(1)
+    df.loc[rng.choice(len(df), nan, replace=False), 'CI_cyano'] = np.nan
+
+    return df
+
+
+def test_data_impute_matches_baseline():
+    df = lake_data()
+
+    out = dataprep.data_impute(df)
+
+    pd.testing.assert_frame_equal(out, data_impute_baseline(df), check_exact=True)
+    assert out['CI_cyano'].notna().all()
+
+
+def test_data_impute_float32_input():
+    df = lake_data().astype({'CI_cyano': np.float32})
+
+    out = dataprep.data_impute(df)
+
+    assert out['CI_cyano'].dtype == np.float64
+    np.testing.assert_allclose(out['CI_cyano'], data_impute_baseline(df)['CI_cyano'], rtol=1e-6)
+
+
+def test_sparse_grid_means():
+    df = lake_data()
+    grid = SparseGrid(df)
+    dates, dense = grid.dense('2016-05-10', '2016-06-10')
+
+    assert not np.isnan(dense).any()
+    assert (dense[~np.isin(dense, grid.values)] == np.float32(UNDER_DETECT)).all()
+    np.testing.assert_allclose(grid.pixel_mean('2016-05-10', '2016-06-10'),
+                               dense.mean(axis=0, dtype=np.float64), rtol=1e-6)
+    np.testing.assert_allclose(grid.daily_mean('2016-05-10', '2016-06-10').values,
+                               dense.mean(axis=1, dtype=np.float64), rtol=1e-6)
+    assert list(grid.daily_mean('2016-05-10', '2016-06-10').index) == list(dates)
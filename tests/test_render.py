@@ -0,0 +1,39 @@
+import numpy as np
+import pandas as pd
+import pytest
+from utils import isin, render
+
+NROWS = 4320
+
+
+def isin_pixels(bbox, nrows=NROWS):
+    """
+    Centers of every ISIN bin inside bbox, with a distinct value per bin
+    """
+    latbin, numbin, basebin = isin.isin_grid(nrows)
+    rows = np.where((latbin >= bbox[1]) & (latbin <= bbox[3]))[0]
+    bin_num = np.concatenate([np.arange(basebin[r], basebin[r] + numbin[r]) for r in rows])
+    geo = isin.bin_geometry(bin_num, nrows, ['clat', 'clon'])
+    inside = (geo['clon'] >= bbox[0]) & (geo['clon'] <= bbox[2])
+
+    return pd.DataFrame({'clat': geo['clat'][inside], 'clon': geo['clon'][inside],
+                         'value': np.arange(inside.sum(), dtype=np.float64)})
+
+
+@pytest.mark.parametrize('bbox', [(-89.565, 43.075, -89.365, 43.275),
+                                  (-83.5, 41.4, -82.5, 42.0),
+                                  (-100.0, 30.0, -95.0, 35.0)])
+def test_pixel_grid_shows_every_pixel(bbox):
+    pixels = isin_pixels(bbox)
+
+    lon, lat, z = render.pixel_grid(pixels.clat, pixels.clon, pixels.value)
+
+    # cell of each pixel: its row latitude and the nearest column
+    row = np.searchsorted(lat, pixels.clat.values)
+    assert (lat[row] == pixels.clat.values).all()
+    col = np.abs(lon[None, :] - pixels.clon.values[:, None]).argmin(axis=1)
+    cells = pixels.assign(cell=row * len(lon) + col)
+
+    expected = cells.groupby('cell').value.mean()
+    np.testing.assert_allclose(z.ravel()[expected.index], expected.values)
+    assert np.isnan(np.delete(z.ravel(), expected.index)).all()
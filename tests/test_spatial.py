@@ -0,0 +1,55 @@
+import numpy as np
+import pandas as pd
+import pytest
+from utils import isin, lakes
+from utils.spatial import BinGrid, SortedBins
+
+NROWS = 4320
+POLYGON = [[-89.56, 43.08], [-89.40, 43.07], [-89.37, 43.18], [-89.45, 43.27], [-89.52, 43.20],
+           [-89.47, 43.15]]
+
+
+def band_bins(lat_min, lat_max, nrows=NROWS):
+    """
+    Every bin of the grid rows around a latitude band, with its geometry
+    """
+    latbin, numbin, basebin = isin.isin_grid(nrows)
+    rows = np.where((latbin >= lat_min - 1) & (latbin <= lat_max + 1))[0]
+    bin_num = np.concatenate([np.arange(basebin[r], basebin[r] + numbin[r]) for r in rows])
+
+    return pd.DataFrame({'bin_num': bin_num, **isin.bin_geometry(bin_num, nrows)})
+
+
+def range_bins(ranges):
+    return np.concatenate([np.arange(lo, hi + 1) for lo, hi in ranges]) if len(ranges) else \
+        np.array([], dtype=np.int64)
+
+
+@pytest.mark.parametrize('region', [*lakes.LAKES.values(),
+                                    {'bbox': [-100.0, 30.0, -95.0, 35.0]},
+                                    {'bbox': [-0.5, -0.2, 0.5, 0.2]},
+                                    {'bbox': [10.0001, 50.0001, 10.0002, 50.0002]},
+                                    {'polygon': POLYGON}])
+def test_ranges_match_brute_force(region):
+    lon_min, lat_min, lon_max, lat_max = lakes.region_bbox(region)
+    bins = band_bins(lat_min, lat_max)
+
+    expected = bins['bin_num'].values[lakes.in_region(bins, region)]
+    ranges = BinGrid(NROWS).ranges(region)
+
+    np.testing.assert_array_equal(range_bins(ranges), expected)
+
+
+def test_sorted_bins_lookup():
+    rng = np.random.default_rng(0)
+    bins = band_bins(43.0, 43.3)
+    bins = bins[(bins.clon > -90.0) & (bins.clon < -89.0)]
+    bin_num = rng.choice(bins['bin_num'].values, 20_000)
+    region = lakes.LAKES['mendota']
+    ranges = BinGrid(NROWS).ranges(region)
+
+    found = SortedBins(bin_num).lookup(ranges)
+
+    expected = np.isin(bin_num, range_bins(ranges))
+    assert expected.any()
+    np.testing.assert_array_equal(np.sort(found), np.where(expected)[0])
@@ -0,0 +1,142 @@
+import os
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from statsmodels.tsa.statespace.sarimax import SARIMAX
+from utils import metrics
+from utils.dataprep import HAB_THRESHOLDS
+
+
+def model_spec(smodel):
+    """
+    Orders and trend of a fitted SARIMAX model, to build the same model on other data
+    """
+    mod = smodel.model
+
+    return {'order': mod.order, 'seasonal_order': mod.seasonal_order, 'trend': mod.trend}
+
+
+def cutoffs(nobs, horizon=12, min_train=104, step=1):
+    """
+    Forecast origins of a rolling-origin backtest: numbers of weeks used for training, from
+    min_train (two seasons, needed by the seasonal difference) to the last origin with horizon
+    weeks left to compare with, every step weeks
+    """
+    return np.arange(min_train, nobs - horizon + 1, step)
+
+
+def _forecast_origins(y, spec, params, origins, horizon, refit, alpha):
+    """
+    Forecasts of horizon weeks from each origin (number of weeks used). The model is filtered
+    with params up to the first origin, then extended with the weeks up to each next origin:
+    only the new weeks are filtered. With refit, the parameters are re-estimated at each origin,
+    starting from those of the previous origin (params at the first one).
+    """
+    out = []
+    res, prev = None, None
+    for c in origins:
+        if refit:
+            start = res.params if res is not None else params
+            res = SARIMAX(y[:c], **spec).fit(start_params=start, disp=False)
+        elif res is None:
+            res = SARIMAX(y[:c], **spec).filter(params)
+        else:
+            res = res.extend(y[prev:c])
+        prev = c
+
+        fcst = res.get_forecast(horizon).summary_frame(alpha=alpha)
+        out.append(np.column_stack([np.full(horizon, c), np.arange(1, horizon + 1),
+                                    fcst['mean'].values, fcst['mean_ci_lower'].values,
+                                    fcst['mean_ci_upper'].values]))
+
+    return np.concatenate(out)
+
+
+@metrics.timed('backtest.run')
+def run(d_in: pd.DataFrame, smodel, horizon=12, min_train=104, step=1, refit=False,
+        processes=1, alpha=0.05):
+    """
+    Rolling-origin backtest of a SARIMA model on a weekly series (sarima.prep_data): forecasts
+    of horizon weeks from every origin (see cutoffs), compared with the weeks that followed.
+    The orders of the fitted model smodel are kept; its parameters are re-estimated once on the
+    weeks before the first origin (so that no origin sees later data), and the state-space
+    model is then extended week by week instead of being refitted at each origin. With
+    refit=True, the parameters are re-estimated at each origin (warm start, slower).
+    With refit=True, origins are split into consecutive chunks run in processes worker processes
+    (at most one per CPU); extending the model costs less than starting a worker, so the default
+    mode runs in this process.
+    Return one row per origin and horizon step: origin (last week used), step, date,
+    CI_cyano (actual), log_yhat, yhat, yhat_lower, yhat_upper.
+    """
+    df = d_in.reset_index(drop=True)
+    y = df.log_y.values.astype(np.float64)
+    spec = model_spec(smodel)
+    origins = cutoffs(len(y), horizon, min_train, step)
+    if len(origins) == 0:
+        raise ValueError(f"Series of {len(y)} weeks is too short for a backtest "
+                         f"({min_train} training weeks and {horizon} weeks to forecast)")
+
+    params = SARIMAX(y[:origins[0]], **spec).fit(start_params=np.asarray(smodel.params),
+                                                 disp=False).params
+
+    processes = min(processes, len(origins), os.cpu_count() or 1) if refit else 1
+    chunks = np.array_split(origins, max(1, processes))
+    if len(chunks) == 1:
+        out = [_forecast_origins(y, spec, params, chunks[0], horizon, refit, alpha)]
+    else:
+        with ProcessPoolExecutor(max_workers=len(chunks),
+                                 mp_context=mp.get_context('spawn')) as pool:
+            jobs = [pool.submit(_forecast_origins, y, spec, params, c, horizon, refit, alpha)
+                    for c in chunks]
+            out = [job.result() for job in jobs]
+    out = np.concatenate(out)
+
+    origin, step_ahead = out[:, 0].astype(np.int64), out[:, 1].astype(np.int64)
+    target = origin + step_ahead - 1
+
+    return pd.DataFrame({'origin': df.date.values[origin - 1],
+                         'step': step_ahead,
+                         'date': df.date.values[target],
+                         'CI_cyano': df.CI_cyano.values[target],
+                         'log_yhat': out[:, 2],
+                         'yhat': np.exp(out[:, 2]),
+                         'yhat_lower': np.exp(out[:, 3]),
+                         'yhat_upper': np.exp(out[:, 4])})
+
+
+def evaluate(bt: pd.DataFrame, thresholds=HAB_THRESHOLDS):
+    """
+    Accuracy of backtest forecasts by horizon step and overall ('all'):
+    - mae: mean absolute error of CI_cyano, mae_log: of log CI_cyano
+    - coverage: share of actual values within [yhat_lower, yhat_upper]
+    - hab_accuracy: share of weeks whose forecast HAB level (low/medium/high, see
+      dataprep.hab_level) is the actual level
+    - hab_hit_rate: share of actual medium or high weeks forecast medium or high, and
+      hab_false_alarm: share of actual low weeks forecast medium or high
+    """
+    actual = np.digitize(bt.CI_cyano.values, thresholds)
+    forecast = np.digitize(bt.yhat.values, thresholds)
+    df = pd.DataFrame({'step': bt.step.values,
+                       'abs_err': np.abs(bt.yhat.values - bt.CI_cyano.values),
+                       'abs_err_log': np.abs(bt.log_yhat.values - np.log(bt.CI_cyano.values)),
+                       'covered': (bt.CI_cyano.values >= bt.yhat_lower.values) &
+                                  (bt.CI_cyano.values <= bt.yhat_upper.values),
+                       'level_ok': actual == forecast,
+                       'hab': actual > 0,
+                       'hab_hit': (actual > 0) & (forecast > 0),
+                       'false_alarm': (actual == 0) & (forecast > 0)})
+
+    def scores(g):
+        nhab = g.hab.sum()
+        nlow = len(g) - nhab
+        return pd.Series({'n': len(g), 'mae': g.abs_err.mean(), 'mae_log': g.abs_err_log.mean(),
+                          'coverage': g.covered.mean(), 'hab_accuracy': g.level_ok.mean(),
+                          'hab_hit_rate': g.hab_hit.sum() / nhab if nhab else np.nan,
+                          'hab_false_alarm': g.false_alarm.sum() / nlow if nlow else np.nan})
+
+    report = df.groupby('step')[df.columns[1:]].apply(scores)
+    report.loc['all'] = scores(df)
+    report['n'] = report['n'].astype(int)
+
+    return report
@@ -0,0 +1,191 @@
+import time
+import multiprocessing as mp
+from multiprocessing.connection import wait
+import numpy as np
+import pandas as pd
+from utils import metrics, sarima
+
+
+def lake_series(df: pd.DataFrame):
+    """
+    Split raw data into one series per lake ({name: raw rows}); data without a lake column
+    is a single series
+    """
+    if 'lake' not in df.columns:
+        return {'all': df}
+
+    return {str(lake): d.drop(columns='lake')
+            for lake, d in df.groupby('lake', observed=True)}
+
+
+def pixel_clusters(df: pd.DataFrame, size=0.02):
+    """
+    Split raw data into one series per cluster of pixels: square cells of size degrees,
+    named by the lake (if any) and the lat/lon of the cell center
+    """
+    cell_lat = (np.floor(df['clat'].values / size) + 0.5) * size
+    cell_lon = (np.floor(df['clon'].values / size) + 0.5) * size
+    name = pd.Series(cell_lat).map('{:.3f}'.format) + ',' + pd.Series(cell_lon).map('{:.3f}'.format)
+    if 'lake' in df.columns:
+        name = df['lake'].astype(str).values + ':' + name
+
+    return {key: d for key, d in df.groupby(name.values)}
+
+
+def forecast_series(name, df, n=12, cached=False, entry=None, max_age_days=28, research=False):
+    """
+    Prepare, train and forecast one series. Return the forecast, the model name, and with
+    cached=True the new model registry entry and the training action (see sarima.train_cached).
+    """
+    df_weekly_imp = sarima.prep_data(df)
+    if cached:
+        model_name, smodel, entry, action = sarima.train_cached(
+            df_weekly_imp, entry, max_age_days=max_age_days, research=research, trace=False)
+    else:
+        model_name, smodel = sarima.train(df_weekly_imp, trace=False)
+        entry, action = None, 'search'
+    _, dfcst = sarima.predict(df_weekly_imp, smodel, n=n)
+
+    dfcst = dfcst[['date', 'log_yhat', 'yhat', 'yhat_lower', 'yhat_upper']].reset_index(drop=True)
+    dfcst.insert(0, 'series', name)
+    dfcst['model'] = model_name
+
+    if cached:
+        return dfcst, model_name, entry, action
+
+    return dfcst, model_name
+
+
+def _forecast_worker(conn, func):
+    """
+    Worker process loop: run func on each series received on conn, until None is received
+    """
+    while True:
+        task = conn.recv()
+        if task is None:
+            break
+        name, df, n, kwargs = task
+        try:
+            conn.send(('ok', func(name, df, n, **kwargs)))
+        except Exception as e:
+            conn.send(('error', repr(e)))
+    conn.close()
+
+
+class Worker:
+    """
+    Long-lived worker process of forecast_batch, fed one series at a time over a pipe, so that
+    the interpreter start and the imports are paid once per worker and not once per series
+    """
+
+    def __init__(self, ctx, func):
+        self.conn, child = ctx.Pipe()
+        self.proc = ctx.Process(target=_forecast_worker, args=(child, func), daemon=True)
+        self.proc.start()
+        child.close()
+        self.name = None
+        self.started = None
+
+    def submit(self, name, df, n, kwargs):
+        self.conn.send((name, df, n, kwargs))
+        self.name, self.started = name, time.perf_counter()
+
+    def done(self):
+        self.name, self.started = None, None
+
+    def stop(self, kill=False):
+        """
+        Stop the worker: after its current series, or at once with kill=True
+        """
+        if kill:
+            self.proc.terminate()
+        else:
+            try:
+                self.conn.send(None)
+            except OSError:
+                pass
+        self.conn.close()
+        self.proc.join()
+
+
+def forecast_batch(series, n=12, processes=4, timeout=900, registry=None, max_age_days=28,
+                   research=False, func=forecast_series):
+    """
+    Forecast many series ({name: raw rows}) in parallel on a pool of `processes` long-lived
+    worker processes, each series with func (forecast_series). A series still running after
+    timeout seconds is stopped: its worker is killed and replaced by a new one, and the other
+    workers keep running. With a model registry (utils.registry.ModelRegistry), each series
+    starts from its registered model and the registry is updated by this process as series
+    complete.
+    Return all forecasts in one table, and a summary of each series
+    (status: ok / error / timeout, model, action, seconds).
+    """
+    ctx = mp.get_context('spawn')
+    todo = list(series.items())
+    forecasts, summary = [], []
+    t_start = time.perf_counter()
+    workers = [Worker(ctx, func) for _ in range(max(1, min(processes, len(todo))))]
+
+    def finish(worker, status, model=None, error=None, action=None):
+        name = worker.name
+        summary.append({'series': name, 'status': status, 'model': model, 'action': action,
+                        'error': error, 'seconds': time.perf_counter() - worker.started})
+        worker.done()
+        metrics.record('batch.series', series=name, status=status, model=model, action=action,
+                       error=error, wall_s=round(summary[-1]['seconds'], 4))
+        print(f"  {name}: {status} {model or error or ''} {action or ''} "
+              f"({summary[-1]['seconds']:.0f}s)")
+
+    def restart(i):
+        workers[i].stop(kill=True)
+        workers[i] = Worker(ctx, func)
+
+    while todo or any(w.name is not None for w in workers):
+        for w in workers:
+            if w.name is None and todo:
+                name, df = todo.pop(0)
+                kwargs = {}
+                if registry is not None:
+                    kwargs = {'cached': True, 'entry': registry.get(name),
+                              'max_age_days': max_age_days, 'research': research}
+                w.submit(name, df, n, kwargs)
+
+        wait([w.conn for w in workers if w.name is not None], timeout=1.0)
+
+        for i, w in enumerate(workers):
+            if w.name is None:
+                continue
+            if w.conn.poll():
+                try:
+                    status, out = w.conn.recv()
+                except EOFError:
+                    finish(w, 'error', error=f'worker exited with code {w.proc.exitcode}')
+                    restart(i)
+                    continue
+                if status == 'ok':
+                    forecasts.append(out[0])
+                    if registry is not None:
+                        registry.put(w.name, out[2])
+                        finish(w, 'ok', model=out[1], action=out[3])
+                    else:
+                        finish(w, 'ok', model=out[1])
+                else:
+                    finish(w, 'error', error=out)
+            elif time.perf_counter() - w.started > timeout:
+                finish(w, 'timeout')
+                restart(i)
+
+    for w in workers:
+        w.stop()
+
+    elapsed = time.perf_counter() - t_start
+    summary = pd.DataFrame(summary,
+                           columns=['series', 'status', 'model', 'action', 'error', 'seconds'])
+    nfit = (summary.status == 'ok').sum()
+    print(f"Fitted {nfit}/{len(series)} series in {elapsed/60:.1f} min "
+          f"({nfit / (elapsed/60):.1f} series/min, {processes} processes)")
+
+    columns = ['series', 'date', 'log_yhat', 'yhat', 'yhat_lower', 'yhat_upper', 'model']
+    forecasts = pd.concat(forecasts, ignore_index=True) if forecasts else pd.DataFrame(columns=columns)
+
+    return forecasts, summary
@@ -0,0 +1,62 @@
+import threading
+from collections import OrderedDict
+
+
+class LRUCache:
+    """
+    Thread-safe key-value cache holding at most maxsize entries; the least recently used
+    entry is evicted first. Hits, misses and evictions are counted.
+    """
+
+    def __init__(self, maxsize=128, on_evict=None):
+        self.maxsize = maxsize
+        self.on_evict = on_evict
+        self.data = OrderedDict()
+        self.lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __len__(self):
+        return len(self.data)
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key in self.data:
+                self.data.move_to_end(key)
+                self.hits += 1
+                return self.data[key]
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        with self.lock:
+            self.data[key] = value
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                old_key, old_value = self.data.popitem(last=False)
+                self.evictions += 1
+                if self.on_evict is not None:
+                    self.on_evict(old_key, old_value)
+
+    def get_or_set(self, key, func):
+        """
+        Return the cached value of key, or compute it with func() and cache it
+        """
+        with self.lock:
+            if key in self.data:
+                return self.get(key)
+            self.misses += 1
+        value = func()
+        self.put(key, value)
+
+        return value
+
+    def info(self):
+        total = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'size': len(self.data), 'maxsize': self.maxsize,
+                'hit_rate': self.hits / total if total else 0.0}
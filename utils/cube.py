@@ -0,0 +1,99 @@
+import numpy as np
+import pandas as pd
+
+
+class PixelCube:
+    """
+    Daily per-pixel aggregates of CI_cyano (sum, count, HAB high and high/medium counts) on a
+    dates x pixels grid, with cumulative sums along the date axis. The aggregates of any date
+    range are the difference of two rows of the cumulative sums, so a query costs O(pixels)
+    regardless of the number of raw observations or days in the range.
+    Expects the HAB_HIGH and HAB_HIGH_MED columns added by dataprep.hab_level. Like a pandas
+    groupby mean/count, NaN CI_cyano values are left out of the means and of the per-pixel
+    numbers of observations; the daily numbers of observations count every row.
+    """
+
+    def __init__(self, df: pd.DataFrame):
+        pix = df.groupby(['clat', 'clon'], sort=True).ngroup().values
+        dates, day = np.unique(df['date'].values, return_inverse=True)
+        locs = df[['clat', 'clon']].drop_duplicates().sort_values(['clat', 'clon'])
+
+        self.dates = pd.DatetimeIndex(dates)
+        self.clat = locs['clat'].values
+        self.clon = locs['clon'].values
+        ndates, npix = len(dates), len(locs)
+
+        cell = day * npix + pix
+        size = ndates * npix
+
+        def grid(weights=None):
+            return np.bincount(cell, weights=weights, minlength=size).reshape(ndates, npix)
+
+        ci = df['CI_cyano'].values.astype(np.float64)
+        valid = np.isfinite(ci)
+        ci_sum = grid(np.where(valid, ci, 0.0))
+        nobs = grid(valid.view(np.int8)).astype(np.int64)
+        rows = grid() if not valid.all() else nobs
+        hab_high = grid(df['HAB_HIGH'].values)
+        hab_high_med = grid(df['HAB_HIGH_MED'].values)
+
+        # daily totals over all pixels
+        with np.errstate(invalid='ignore'):
+            daily_mean = ci_sum.sum(axis=1) / nobs.sum(axis=1)
+        self.daily = pd.DataFrame({'date': self.dates,
+                                   'CI_cyano': daily_mean,
+                                   'nobs': rows.sum(axis=1),
+                                   'hab_high': hab_high.sum(axis=1),
+                                   'hab_high_med': hab_high_med.sum(axis=1)})
+
+        # prefix sums along the date axis, with a leading row of zeros
+        def cumulative(a, dtype):
+            out = np.zeros((ndates + 1, npix), dtype=dtype)
+            np.cumsum(a, axis=0, out=out[1:])
+            return out
+
+        self.cum_sum = cumulative(ci_sum, np.float64)
+        self.cum_nobs = cumulative(nobs, np.int64)
+        # pixels with rows but no CI_cyano value in a range are listed with a NaN mean
+        self.cum_rows = self.cum_nobs if rows is nobs else cumulative(rows, np.int64)
+        self.cum_hab_high = cumulative(hab_high, np.int64)
+        self.cum_hab_high_med = cumulative(hab_high_med, np.int64)
+
+    def date_range(self, start_date, end_date):
+        """
+        Positions [i0, i1) of the dates within [start_date, end_date]
+        """
+        i0 = self.dates.searchsorted(pd.Timestamp(start_date), side='left')
+        i1 = self.dates.searchsorted(pd.Timestamp(end_date), side='right')
+
+        return i0, max(i0, i1)
+
+    def pixels(self, start_date, end_date):
+        """
+        Per-pixel mean CI_cyano, number of observations and HAB counts between two dates,
+        for the pixels observed in that range
+        """
+        i0, i1 = self.date_range(start_date, end_date)
+        nobs = self.cum_nobs[i1] - self.cum_nobs[i0]
+        seen = (self.cum_rows[i1] - self.cum_rows[i0]) > 0
+
+        with np.errstate(invalid='ignore'):
+            mean = (self.cum_sum[i1] - self.cum_sum[i0])[seen] / nobs[seen]
+
+        out = pd.DataFrame({'clat': self.clat[seen],
+                            'clon': self.clon[seen],
+                            'CI_cyano': mean,
+                            'nobs': nobs[seen],
+                            'hab_high': (self.cum_hab_high[i1] - self.cum_hab_high[i0])[seen],
+                            'hab_high_med': (self.cum_hab_high_med[i1] -
+                                             self.cum_hab_high_med[i0])[seen]})
+
+        return out
+
+    def days(self, start_date, end_date):
+        """
+        Daily mean CI_cyano and totals between two dates
+        """
+        i0, i1 = self.date_range(start_date, end_date)
+
+        return self.daily.iloc[i0:i1].reset_index(drop=True)
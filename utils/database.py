@@ -0,0 +1,151 @@
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as pds
+from sqlalchemy import (MetaData, Table, Column, Index, BigInteger, Float, Double, Date, String,
+                        create_engine, select, delete, and_)
+from utils import schema
+
+# L3B_CYAN_DAILY table: one row per bin and day (and lake, for lake extracts), with the bin
+# geometry stored so that bbox queries run in SQL
+TABLE = 'L3B_CYAN_DAILY'
+
+metadata = MetaData()
+cyan_daily = Table(
+    TABLE, metadata,
+    Column('bin_num', BigInteger, nullable=False),
+    *[Column(k, Float) for k in schema.CI_VARS],
+    *[Column(c, Double) for c in schema.GEOMETRY],
+    Column('date', Date, nullable=False),
+    Column('lake', String(64)),
+    Index('ix_cyan_date_clat_clon', 'date', 'clat', 'clon'),
+    Index('ix_cyan_clat_clon_date', 'clat', 'clon', 'date'),
+    Index('ix_cyan_bin_num_date', 'bin_num', 'date'),
+)
+COLUMNS = [c.name for c in cyan_daily.columns]
+
+# one engine (and connection pool) per database URL
+_engines = {}
+
+
+def get_engine(url, pool_size=5, max_overflow=10):
+    """
+    Engine of a database URL, created once and shared so that connections are pooled
+    """
+    if url not in _engines:
+        kwargs = {}
+        if not url.startswith('sqlite'):
+            kwargs = {'pool_size': pool_size, 'max_overflow': max_overflow, 'pool_recycle': 3600}
+        _engines[url] = create_engine(url, pool_pre_ping=True, **kwargs)
+
+    return _engines[url]
+
+
+def create_table(engine):
+    """
+    Create the L3B_CYAN_DAILY table and its indexes if they do not exist
+    """
+    metadata.create_all(engine)
+
+
+def analyze(engine):
+    """
+    Update the table statistics used by the query planner to choose an index
+    """
+    with engine.begin() as conn:
+        conn.exec_driver_sql('ANALYZE' if engine.dialect.name == 'sqlite' else f'ANALYZE TABLE {TABLE}')
+
+
+def to_records(table, nrows=None):
+    """
+    Rows of a day of data (DataFrame, or Arrow table in the storage schema) as a DataFrame with
+    the table columns; geometry missing from the storage schema is derived from bin_num
+    """
+    if isinstance(table, pa.Table):
+        meta = table.schema.metadata or {}
+        nrows = nrows or int(meta.get(schema.NROWS_KEY, 0))
+        table = table.to_pandas()
+    df = table
+    missing = [c for c in schema.GEOMETRY if c not in df.columns]
+    if missing:
+        df = schema.derive_geometry(df.copy(), nrows, missing)
+    if 'lake' not in df.columns:
+        df = df.assign(lake=None)
+    df = df.assign(date=pd.to_datetime(df['date']).dt.date, lake=df['lake'].astype(object))
+
+    return df[COLUMNS]
+
+
+def load_day(engine, table, day, batch_size=50_000, nrows=None):
+    """
+    Bulk-load one day of data in one transaction: rows of that day (and lakes) already in the
+    table are deleted, then the rows are inserted in batches of batch_size (executemany).
+    Return the number of rows loaded.
+    """
+    df = to_records(table, nrows)
+    if len(df) == 0:
+        return 0
+
+    clause = cyan_daily.c.date == day
+    lakes = [lake for lake in df['lake'].unique() if lake is not None]
+    if lakes:
+        clause = and_(clause, cyan_daily.c.lake.in_(lakes))
+
+    # executemany of the driver, with the INSERT compiled once for the database dialect
+    insert = str(cyan_daily.insert().compile(dialect=engine.dialect))
+    rows = list(zip(*[df[c].tolist() for c in COLUMNS]))
+    with engine.begin() as conn:
+        conn.execute(delete(cyan_daily).where(clause))
+        for i in range(0, len(rows), batch_size):
+            conn.exec_driver_sql(insert, rows[i:i+batch_size])
+
+    return len(df)
+
+
+def load_dataset(engine, path, batch_size=50_000):
+    """
+    Bulk-load every day of an extracted parquet dataset, one file at a time.
+    Return the number of rows loaded.
+    """
+    create_table(engine)
+    dataset = pds.dataset(path, format='parquet', partitioning='hive')
+    nrows = int((dataset.schema.metadata or {}).get(schema.NROWS_KEY, 0))
+
+    rows = 0
+    for fragment in sorted(dataset.get_fragments(), key=lambda f: f.path):
+        df = fragment.to_table().to_pandas()
+        keys = pds.get_partition_keys(fragment.partition_expression)
+        if 'lake' in keys:
+            df['lake'] = keys['lake']
+        if len(df):
+            rows += load_day(engine, df, df['date'].iloc[0], batch_size, nrows)
+    analyze(engine)
+
+    return rows
+
+
+def query(engine, columns=None, lake=None, bbox=None, date_from=None, date_to=None):
+    """
+    Rows of the table within a bbox (bins entirely inside it), date range (inclusive) and lake.
+    The date range and the clat/clon range of the bbox are served by the (date, clat, clon) and
+    (clat, clon, date) indexes: the first for large areas over few days, the second for small
+    areas (lakes) over many days.
+    """
+    columns = columns or ['clat', 'clon', 'date', 'CI_cyano']
+    t = cyan_daily.c
+    where = []
+    if lake:
+        where.append(t.lake == lake)
+    if date_from is not None:
+        where.append(t.date >= pd.Timestamp(date_from).date())
+    if date_to is not None:
+        where.append(t.date <= pd.Timestamp(date_to).date())
+    if bbox is not None:
+        lon_min, lat_min, lon_max, lat_max = bbox
+        where += [t.clat.between(lat_min, lat_max), t.clon.between(lon_min, lon_max),
+                  t.west >= lon_min, t.east <= lon_max, t.south >= lat_min, t.north <= lat_max]
+
+    stmt = select(*[t[c] for c in columns])
+    if where:
+        stmt = stmt.where(and_(*where))
+    with engine.connect() as conn:
+        return pd.read_sql(stmt, conn)
@@ -1,7 +1,16 @@
 
+import os
+import glob
+import operator
+from functools import reduce
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as pds
 from sqlalchemy import create_engine, select, func, text
 from sqlalchemy.orm import sessionmaker
+from utils import database, metrics, schema, spatial
+from utils.impute import SparseGrid
 
 # Database configuration
 db_host = "XXX"
@@ -11,90 +20,226 @@ db_name = "XXX"
 
 # SQLAlchemy engine and session setup
 db_url = f"mysql+pymysql://{db_user}:{db_password}@{db_host}/{db_name}"
-engine = create_engine(db_url)
+engine = create_engine(db_url, pool_size=5, max_overflow=10, pool_pre_ping=True, pool_recycle=3600)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# CI_cyano thresholds (medium, high) of the HAB levels
+HAB_THRESHOLDS = (0.001, 0.016)
+HAB_DTYPE = pd.CategoricalDtype(['low', 'medium', 'high'], ordered=True)
 
-def getdata(path=None):
+# Hive partition keys of the datasets derived from the date (see writer.DatasetWriter)
+DATE_PARTITIONS = ['year', 'month']
+
+
+@metrics.timed('dataprep.getdata')
+def getdata(path=None, lake=None, columns=None, bbox=None, date_from=None, date_to=None):
     """
-    Extract data from mySQL database
+    Extract data from mySQL database (path None, or a database URL such as
+    sqlite:///cyan.db), or from a parquet file or dataset.
+    For a dataset partitioned by lake, only the partition of lake is read;
+    columns limits the columns read. Geometry columns (clat, clon, north, south, west, east)
+    missing from compact files are derived from bin_num, as float64, only if requested.
+    bbox (lon_min, lat_min, lon_max, lat_max) keeps the bins entirely inside it, and
+    date_from/date_to (inclusive) a date range; both are pushed down to the dataset scan
+    (see dataset_filter) so that partitions, files and row groups outside them are skipped.
     """
-    # Connect to the database
-    # db = SessionLocal()
-
-    # # Build the SQL query using text
-    # query = text("""
-    #     SELECT clat, clon, date, CI_cyano
-    #     FROM L3B_CYAN_DAILY
-    #     WHERE west >= :lon_from
-    #         AND east <= :lon_to
-    #         AND south >= :lat_from
-    #         AND north <= :lat_to
-    # """)
-
-    # # Execute the query with bound parameters
-    # result = db.execute(query, {
-    #                     "lon_from": lon_from, "lon_to": lon_to, "lat_from": lat_from, "lat_to": lat_to})
-
-    # # Fetch the data into a pandas DataFrame
-    # df = pd.DataFrame(result.fetchall(), columns=[
-    #                   "clat", "clon", "date", "CI_cyano"])
-
-    # # Close the database connection
-    # db.close()
-
-    if path:
-        df = pd.read_parquet(path)
-    df['date'] = pd.to_datetime(df['date'])
+    if path is None or '://' in str(path):
+        # query the L3B_CYAN_DAILY table, with the pooled engine of the database URL
+        db = engine if path is None else database.get_engine(path)
+        df = database.query(db, columns=columns, lake=lake, bbox=bbox,
+                            date_from=date_from, date_to=date_to)
+    else:
+        dataset = pds.dataset(path, format='parquet', partitioning='hive')
+        stored = dataset.schema
+        nrows = int((stored.metadata or {}).get(schema.NROWS_KEY, 0))
+
+        # geometry not stored is derived from bin_num (compact storage schema)
+        derived = [c for c in schema.GEOMETRY if nrows and c not in stored.names]
+        if columns:
+            wanted = list(columns)
+        else:
+            # all columns, geometry in its decoded place (before date); not the pandas index
+            # of files written with one, nor the year/month partition keys (from the date)
+            names = [c for c in stored.names
+                     if c not in index_columns(stored) and c not in DATE_PARTITIONS]
+            i = names.index('date') if 'date' in names else len(names)
+            wanted = names[:i] + derived + names[i:]
+        derive = [c for c in wanted if c in derived]
+        read = [c for c in wanted if c not in derived]
+        if derive and 'bin_num' not in read:
+            read.append('bin_num')
+
+        filters = dataset_filter(stored, nrows, lake, bbox, date_from, date_to)
+        df = dataset.to_table(columns=read, filter=filters).to_pandas(date_as_object=False)
+
+        if derive:
+            df = schema.derive_geometry(df, nrows, derive)
+        df = df[wanted]
+        if 'lake' in df.columns and df['lake'].dtype == object:
+            df['lake'] = df['lake'].astype('category')
+    if 'date' in df.columns:
+        df['date'] = pd.to_datetime(df['date']).astype('datetime64[ns]')
 
     return df
 
 
-def data_impute(df: pd.DataFrame):
+@metrics.timed('dataprep.daily_means')
+def daily_means(path, lake=None, bbox=None, date_from=None, date_to=None, by_lake=False,
+                batch_size=131072):
     """
-    Impute dataset with "under detect" value (0.00005)
+    Daily mean CI_cyano of a parquet dataset, computed by streaming it in Arrow record batches:
+    only running sums and counts per date (and lake, with by_lake=True) are kept, so memory does
+    not grow with the number of pixels. Filters are pushed down as in getdata.
+    Return one row per date (and lake): date, CI_cyano[, lake], which sarima.prep_data takes
+    like a getdata result.
+    """
+    dataset = pds.dataset(path, format='parquet', partitioning='hive')
+    stored = dataset.schema
+    nrows = int((stored.metadata or {}).get(schema.NROWS_KEY, 0))
+    keys = ['date', 'lake'] if by_lake else ['date']
+
+    filters = dataset_filter(stored, nrows, lake, bbox, date_from, date_to)
+    valid = ~pds.field('CI_cyano').is_nan()
+    filters = valid if filters is None else filters & valid
+
+    # single-threaded: a threaded group_by allocates hash tables per thread, hundreds of MB
+    def combine(parts):
+        table = pa.concat_tables(parts).group_by(keys, use_threads=False).aggregate([('sum', 'sum'), ('count', 'sum')])
+        return table.rename_columns([{'sum_sum': 'sum', 'count_sum': 'count'}.get(c, c)
+                                     for c in table.column_names])
+
+    # one file at a time, a few batches ahead, and no pre-buffering of whole files
+    scan_options = pds.ParquetFragmentScanOptions(pre_buffer=False)
+    parts = []
+    for batch in dataset.to_batches(columns=keys + ['CI_cyano'], filter=filters,
+                                    batch_size=batch_size, batch_readahead=2, fragment_readahead=1,
+                                    fragment_scan_options=scan_options):
+        if batch.num_rows == 0:
+            continue
+        ci = batch.column('CI_cyano').cast(pa.float64())
+        table = pa.table({**{k: batch.column(k) for k in keys},
+                          'sum': ci, 'count': pa.array(np.ones(len(ci), dtype=np.int64))})
+        parts.append(combine([table]))
+        # keep the running totals small
+        if len(parts) >= 64:
+            parts = [combine(parts)]
+
+    if not parts:
+        return pd.DataFrame({'date': pd.Series(dtype='datetime64[ns]'), 'CI_cyano': []} |
+                            ({'lake': []} if by_lake else {}))
+
+    df = combine(parts).to_pandas()
+    df['CI_cyano'] = df['sum'] / df['count']
+    df['date'] = pd.to_datetime(df['date']).astype('datetime64[ns]')
+    df = df[keys[:1] + ['CI_cyano'] + keys[1:]].sort_values(keys[::-1]).reset_index(drop=True)
+    if by_lake:
+        df['lake'] = df['lake'].astype('category')
+
+    return df
+
+
+def index_columns(stored):
+    """
+    Stored pandas index columns of a parquet schema (e.g. __index_level_0__ of files written
+    from a DataFrame without a default index)
+    """
+    pandas_meta = stored.pandas_metadata or {}
+
+    return [c for c in pandas_meta.get('index_columns', []) if isinstance(c, str)]
+
+
+def dataset_filter(stored, nrows=0, lake=None, bbox=None, date_from=None, date_to=None):
+    """
+    Arrow filter expression of a dataset scan, given the dataset schema:
+    - lake partition
+    - date range, on the year/month partitions (skips folders) and on the date column
+      (skips files and row groups by their statistics)
+    - bbox: exact bin_num ranges of the bins inside it (compact schema, see spatial.BinGrid;
+      bin_num is sorted in each file so row group statistics are selective), or the bounds
+      columns if they are stored
+    """
+    names = stored.names
+    filters = []
+    if lake:
+        filters.append(pds.field('lake') == lake)
+
+    for day, op in [(date_from, 'ge'), (date_to, 'le')]:
+        if day is None:
+            continue
+        day = pd.Timestamp(day)
+        if 'year' in names and 'month' in names:
+            year, month = pds.field('year'), pds.field('month')
+            if op == 'ge':
+                filters.append((year > day.year) | ((year == day.year) & (month >= day.month)))
+            else:
+                filters.append((year < day.year) | ((year == day.year) & (month <= day.month)))
+        date = pa.scalar(day.date(), stored.field('date').type
+                         if pa.types.is_date(stored.field('date').type) else pa.date32())
+        date = pds.field('date') >= date if op == 'ge' else pds.field('date') <= date
+        filters.append(date)
+
+    if bbox is not None and nrows and 'west' not in names:
+        filters.append(spatial.ranges_filter(spatial.BinGrid(nrows).bbox_ranges(bbox)))
+    elif bbox is not None:
+        lon_min, lat_min, lon_max, lat_max = bbox
+        filters.append((pds.field('west') >= lon_min) & (pds.field('east') <= lon_max) &
+                       (pds.field('south') >= lat_min) & (pds.field('north') <= lat_max))
+
+    return reduce(operator.and_, filters) if filters else None
+
+
+def list_lakes(path):
+    """
+    Names of the lakes of a parquet dataset partitioned by lake (lake=<name> folders)
     """
+    folders = glob.glob(os.path.join(path, '**', 'lake=*'), recursive=True)
 
-    # get all locations with CI_cyano >= 0.00005
-    locs = df.groupby(['clat', 'clon']).CI_cyano.count().reset_index()
-    # get all dates with CI_cyano >= 0.00005
-    dates = df.date.unique()
+    return sorted({os.path.basename(f)[len('lake='):] for f in folders if os.path.isdir(f)})
 
-    df_list = [locs[['clat', 'clon']].assign(date=d) for d in dates]
-    df_imp = pd.concat(df_list, axis=0)
-    df_imp = df_imp.reset_index(drop=True)
 
-    df_imp = pd.merge(df_imp, df[['clat', 'clon', 'date', 'CI_cyano']], how='left', on=[
-                      'clat', 'clon', 'date'])
-    df_imp['CI_cyano'] = df_imp.CI_cyano.fillna(0.00005)
-    df_imp['Year'] = df_imp['date'].dt.year
-    df_imp['Month'] = df_imp['date'].dt.month
-    df_imp['Day'] = df_imp['date'].dt.day
+@metrics.timed('dataprep.data_impute')
+def data_impute(df: pd.DataFrame):
+    """
+    Impute dataset with "under detect" value (0.00005)
 
-    return df_imp
+    Return every location x date (sorted by date), with the under detect value where a location
+    was not observed or its CI_cyano is NaN. CI_cyano is float64 and Year, Month, Day are int32,
+    as pandas dates give them. This builds the dense table: use impute.SparseGrid directly to get
+    dense arrays by date range or aggregates without materializing the imputed values.
+    """
+    df_imp = SparseGrid(df, dtype=np.float64).frame()
+
+    return df_imp.astype({'Year': np.int32, 'Month': np.int32, 'Day': np.int32})
 
 
-def hab_level(df: pd.DataFrame):
+@metrics.timed('dataprep.hab_level')
+def hab_level(df: pd.DataFrame, thresholds=HAB_THRESHOLDS, by='lake', inplace=False):
     """
     Assign High, Medium, Low HAB levels to CI_cyano values
+
+    thresholds is the (medium, high) pair of CI_cyano thresholds, or a dict {lake: (medium, high)}
+    of per-lake thresholds applied by the by column (lakes not in the dict use HAB_THRESHOLDS).
+    HAB is a categorical column (low < medium < high) and the indicator columns are int8.
+    The columns are added to a shallow copy of df, or to df itself with inplace=True.
     """
-    HIGH = 0.016
-    MED = 0.001
-
-    hab_level = []
-    for c in df.CI_cyano.values:
-        if c >= HIGH:
-            level = 'high'
-        elif c >= MED:
-            level = 'medium'
+    ci = df['CI_cyano'].values
+    if isinstance(thresholds, dict):
+        if isinstance(df[by].dtype, pd.CategoricalDtype):
+            lake, lakes = df[by].cat.codes.values, df[by].cat.categories
         else:
-            level = 'low'
-        hab_level.append(level)
-
-    df_out = df.copy()
-    df_out['HAB'] = hab_level
-    df_out['HAB_HIGH'] = (df_out.HAB == 'high')*1
-    df_out['HAB_MEDIUM'] = (df_out.HAB == 'medium')*1
-    df_out['HAB_HIGH_MED'] = df_out['HAB_HIGH']+df_out['HAB_MEDIUM']
+            lake, lakes = pd.factorize(df[by])
+        table = np.array([thresholds.get(name, HAB_THRESHOLDS) for name in lakes] +
+                         [HAB_THRESHOLDS], dtype=np.float64)
+        med, high = table[lake, 0], table[lake, 1]
+    else:
+        med, high = thresholds
+    # NaN compares False, so it is 'low' like in the original classification
+    codes = (ci >= med).view(np.int8) + (ci >= high).view(np.int8)
+
+    df_out = df if inplace else df.copy(deep=False)
+    df_out['HAB'] = pd.Categorical.from_codes(codes, dtype=HAB_DTYPE)
+    df_out['HAB_HIGH'] = (codes == 2).view(np.int8)
+    df_out['HAB_MEDIUM'] = (codes == 1).view(np.int8)
+    df_out['HAB_HIGH_MED'] = (codes >= 1).view(np.int8)
 
     return df_out
@@ -0,0 +1,175 @@
+import warnings
+import numpy as np
+import pandas as pd
+
+
+def align(df_weekly: pd.DataFrame, by='lake', value='CI_cyano'):
+    """
+    Weekly series of sarima.prep_data(df, by=by) as a 2-D array (series x weeks) on their common
+    weeks, NaN before the first and after the last week of each series. Weeks are dated on their
+    Monday. Return the series names, the dates and the array.
+    """
+    date = pd.to_datetime(df_weekly['date']).dt.normalize()
+    monday = date - pd.to_timedelta(date.dt.weekday, unit='D')
+    table = df_weekly.assign(monday=monday.values).pivot_table(
+        index=by, columns='monday', values=value, observed=True, aggfunc='first')
+    dates = pd.date_range(table.columns.min(), table.columns.max(), freq='7D')
+    table = table.reindex(columns=dates)
+
+    return table.index.astype(str).tolist(), dates, table.values.astype(np.float64)
+
+
+def window_sums(y, before, after):
+    """
+    Sums of y[:, t-before:t+after+1] at every t, NaN where the window is not inside the
+    observed (not NaN) values of the series
+    """
+    nseries, nobs = y.shape
+    missing = np.isnan(y)
+    csum = np.zeros((nseries, nobs + 1))
+    np.cumsum(np.where(missing, 0.0, y), axis=1, out=csum[:, 1:])
+    cmiss = np.zeros((nseries, nobs + 1), dtype=np.int64)
+    np.cumsum(missing, axis=1, out=cmiss[:, 1:])
+
+    out = np.full((nseries, nobs), np.nan)
+    t = np.arange(before, nobs - after)
+    sums = csum[:, t + after + 1] - csum[:, t - before]
+    out[:, t] = np.where(cmiss[:, t + after + 1] - cmiss[:, t - before] > 0, np.nan, sums)
+
+    return out
+
+
+def moving_average(y, period):
+    """
+    Centered moving average of each row of y over one period, as in
+    statsmodels seasonal_decompose: a 2 x period average for an even period
+    """
+    half = period // 2
+    if y.shape[1] <= 2 * half:
+        return np.full_like(y, np.nan)
+    if period % 2:
+        return window_sums(y, half, half) / period
+
+    # period + 1 values, the first and last weighted by 1/2
+    inner = window_sums(y, half - 1, half - 1)
+    ends = np.full_like(y, np.nan)
+    ends[:, half:-half] = y[:, :-2 * half] + y[:, 2 * half:]
+
+    return (inner + 0.5 * ends) / period
+
+
+class Decomposition:
+    """
+    Seasonal decomposition of many aligned series (series x weeks) at once, with the components
+    of statsmodels seasonal_decompose (two-sided moving average trend, seasonal component as the
+    mean detrended value of each position in the period, residual) computed with array
+    operations over all series. Series with fewer than two full periods of observations get
+    NaN components.
+    """
+
+    def __init__(self, y, period=52, model='additive', dates=None, names=None):
+        y = np.atleast_2d(np.asarray(y, dtype=np.float64))
+        nseries, nobs = y.shape
+        self.period = period
+        self.model = model
+        self.dates = dates
+        self.names = names if names is not None else list(range(nseries))
+        self.observed = y
+
+        self.trend = moving_average(y, period)
+        if model == 'additive':
+            detrended = y - self.trend
+        else:
+            detrended = y / self.trend
+
+        # mean of each position in the period over the cycles (positions on the common dates)
+        ncycles = -(-nobs // period)
+        cycles = np.full((nseries, ncycles * period), np.nan)
+        cycles[:, :nobs] = detrended
+        cycles = cycles.reshape(nseries, ncycles, period)
+        count = (~np.isnan(cycles)).sum(axis=1)
+        with np.errstate(invalid='ignore'):
+            means = np.nansum(cycles, axis=1) / count
+        if model == 'additive':
+            means -= means.mean(axis=1, keepdims=True)
+        else:
+            means /= means.mean(axis=1, keepdims=True)
+        self.seasonal = np.where(np.isnan(y), np.nan, np.tile(means, ncycles)[:, :nobs])
+
+        if model == 'additive':
+            self.resid = detrended - self.seasonal
+        else:
+            self.resid = detrended / self.seasonal
+
+        short = (~np.isnan(y)).sum(axis=1) < 2 * period
+        for a in (self.trend, self.seasonal, self.resid):
+            a[short] = np.nan
+
+    @classmethod
+    def from_weekly(cls, df_weekly: pd.DataFrame, by='lake', value='CI_cyano', period=52,
+                    model='additive'):
+        """
+        Decomposition of the weekly series of sarima.prep_data(df, by=by)
+        """
+        names, dates, y = align(df_weekly, by, value)
+
+        return cls(y, period, model, dates, names)
+
+    def frame(self, i=0):
+        """
+        Components of series i (position or name) as a table: date, observed, trend,
+        seasonal, resid, over the weeks of that series
+        """
+        if not isinstance(i, (int, np.integer)):
+            i = self.names.index(i)
+        seen = ~np.isnan(self.observed[i])
+
+        df = pd.DataFrame({'date': self.dates, 'observed': self.observed[i], 'trend': self.trend[i],
+                           'seasonal': self.seasonal[i], 'resid': self.resid[i]})
+
+        return df[seen].reset_index(drop=True)
+
+    def trend_report(self):
+        """
+        Trend of each series: first and last trend values, and least-squares slope of the trend
+        per year
+        """
+        ok = ~np.isnan(self.trend)
+        years = (np.asarray(self.dates, dtype='datetime64[D]').astype(np.float64) / 365.25)
+        t = np.where(ok, years, 0.0)
+        n = ok.sum(axis=1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            t_mean = t.sum(axis=1) / n
+            y_mean = np.where(ok, self.trend, 0.0).sum(axis=1) / n
+            dt = np.where(ok, years - t_mean[:, None], 0.0)
+            dy = np.where(ok, self.trend - y_mean[:, None], 0.0)
+            slope = (dt * dy).sum(axis=1) / (dt * dt).sum(axis=1)
+
+        first = np.where(ok.any(axis=1), ok.argmax(axis=1), 0)
+        last = self.trend.shape[1] - 1 - np.where(ok.any(axis=1), ok[:, ::-1].argmax(axis=1), 0)
+        rows = np.arange(len(self.names))
+
+        return pd.DataFrame({'series': self.names,
+                             'weeks': (~np.isnan(self.observed)).sum(axis=1),
+                             'trend_first': np.where(n > 0, self.trend[rows, first], np.nan),
+                             'trend_last': np.where(n > 0, self.trend[rows, last], np.nan),
+                             'slope_per_year': slope})
+
+    def anomalies(self, threshold=3.5):
+        """
+        Weeks whose residual is far from the usual residuals of their series: robust z-score
+        0.6745 * (resid - median) / MAD above threshold in absolute value
+        """
+        # series without residuals (too short) have no median and no anomalies
+        with warnings.catch_warnings(), np.errstate(invalid='ignore', divide='ignore'):
+            warnings.simplefilter('ignore', RuntimeWarning)
+            med = np.nanmedian(self.resid, axis=1, keepdims=True)
+            mad = np.nanmedian(np.abs(self.resid - med), axis=1, keepdims=True)
+            score = 0.6745 * (self.resid - med) / mad
+            s, w = np.nonzero(np.abs(score) > threshold)
+
+        return pd.DataFrame({'series': np.asarray(self.names, dtype=object)[s],
+                             'date': np.asarray(self.dates)[w],
+                             'observed': self.observed[s, w],
+                             'resid': self.resid[s, w],
+                             'score': score[s, w]})
@@ -0,0 +1,243 @@
+import io
+import os
+import json
+import hashlib
+import time
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
+from utils import metrics
+
+# HTTP status codes worth retrying (server busy or temporarily unavailable)
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+
+def make_session(workers=4):
+    """
+    Create a shared HTTP session whose connection pool is sized for the download workers
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=workers, pool_maxsize=workers)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    return session
+
+
+class Manifest:
+    """
+    On-disk record of finished days, so an interrupted extraction can resume.
+    Each entry maps an ISO date to {'status': 'downloaded' | 'nodata' | 'written', 'file': path}.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.entries = json.load(f)
+
+    def status(self, day):
+        return self.entries.get(day.isoformat(), {}).get('status')
+
+    def file(self, day):
+        return self.entries.get(day.isoformat(), {}).get('file')
+
+    def done(self, day):
+        """
+        True if the day needs no download: it has no data, is already written,
+        or its downloaded file is still on disk
+        """
+        status = self.status(day)
+        if status == 'downloaded':
+            return os.path.exists(self.file(day))
+        return status in ('nodata', 'written')
+
+    def add(self, day, status, file=None):
+        with self.lock:
+            self.entries[day.isoformat()] = {'status': status, 'file': file}
+            tmp = self.path + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(self.entries, f, indent=1, sort_keys=True)
+            os.replace(tmp, self.path)
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.entries = {}
+
+
+class GranuleCache:
+    """
+    Content-addressed local cache of raw granules: <cache_dir>/<sha256[:2]>/<sha256>.nc,
+    with an index mapping each file name to the digest of its content
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.lock = threading.Lock()
+        self.index_path = os.path.join(cache_dir, 'index.json')
+        self.index = {}
+        os.makedirs(cache_dir, exist_ok=True)
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as f:
+                self.index = json.load(f)
+
+    def blob_path(self, digest):
+        return os.path.join(self.cache_dir, digest[:2], digest + '.nc')
+
+    def get(self, fn):
+        """
+        Content of a cached file, or None if it is not cached
+        """
+        digest = self.index.get(fn)
+        if digest is None or not os.path.exists(self.blob_path(digest)):
+            return None
+        with open(self.blob_path(digest), 'rb') as f:
+            return f.read()
+
+    def put(self, fn, content):
+        digest = hashlib.sha256(content).hexdigest()
+        path = self.blob_path(digest)
+
+        with self.lock:
+            if not os.path.exists(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path + '.part', 'wb') as f:
+                    f.write(content)
+                os.replace(path + '.part', path)
+
+            self.index[fn] = digest
+            with open(self.index_path + '.tmp', 'w') as f:
+                json.dump(self.index, f, indent=1, sort_keys=True)
+            os.replace(self.index_path + '.tmp', self.index_path)
+
+
+def with_retry(request, retries=3, backoff=1.0):
+    """
+    Call request(), retrying connection errors and busy responses with exponential backoff
+    """
+    for attempt in range(retries + 1):
+        try:
+            return request()
+
+        except requests.HTTPError as e:
+            if e.response.status_code not in RETRY_STATUS or attempt == retries:
+                raise
+        except (requests.ConnectionError, requests.Timeout):
+            if attempt == retries:
+                raise
+        time.sleep(backoff * 2**attempt)
+
+
+def fetch(session, url, dest, retries=3, backoff=1.0, timeout=120):
+    """
+    Stream url to the file dest. Return the number of bytes written,
+    or None if the file does not exist on the server (404).
+    """
+    def request():
+        with session.get(url, stream=True, timeout=timeout) as r:
+            if r.status_code == 404:
+                return None
+            r.raise_for_status()
+
+            nbytes = 0
+            tmp = dest + '.part'
+            with open(tmp, 'wb') as f:
+                for chunk in r.iter_content(chunk_size=1 << 20):
+                    f.write(chunk)
+                    nbytes += len(chunk)
+            os.replace(tmp, dest)
+            return nbytes
+
+    return with_retry(request, retries=retries, backoff=backoff)
+
+
+def fetch_bytes(session, url, retries=3, backoff=1.0, timeout=120):
+    """
+    Download url into memory. Return the content,
+    or None if the file does not exist on the server (404).
+    """
+    def request():
+        with session.get(url, stream=True, timeout=timeout) as r:
+            if r.status_code == 404:
+                return None
+            r.raise_for_status()
+
+            buf = io.BytesIO()
+            for chunk in r.iter_content(chunk_size=1 << 20):
+                buf.write(chunk)
+            return buf.getvalue()
+
+    return with_retry(request, retries=retries, backoff=backoff)
+
+
+def download_granules(urls, local='./data/', workers=4, retries=3, backoff=1.0,
+                      manifest=None, session=None, in_memory=False, cache=None, stats=None):
+    """
+    Download {day: url} with a bounded pool of worker threads sharing one HTTP session.
+    Yield (day, granule) in date order as soon as each day is available, where granule is
+    the path of the downloaded file, or its content if in_memory is True (files found in the
+    GranuleCache are read from the cache). granule is None if the day has no data or the
+    download failed. Days already recorded in the manifest are not downloaded again.
+    If a stats dict is given, download time ('download_s'), 'bytes' and 'files' are added to it.
+    """
+    if not in_memory:
+        os.makedirs(local, exist_ok=True)
+    session = session or make_session(workers)
+    lock = threading.Lock()
+
+    def task(day, url):
+        if manifest is not None and manifest.done(day):
+            return day, manifest.file(day)
+
+        fn = url.split('/')[-1]
+        t0 = time.perf_counter()
+        try:
+            if in_memory:
+                granule = cache.get(fn) if cache is not None else None
+                if granule is None:
+                    granule = fetch_bytes(session, url, retries=retries, backoff=backoff)
+                    if granule is not None and cache is not None:
+                        cache.put(fn, granule)
+            else:
+                granule = os.path.join(local, fn)
+                if fetch(session, url, granule, retries=retries, backoff=backoff) is None:
+                    granule = None
+
+        except requests.RequestException as e:
+            print("Download failed for", day, ":", e)
+            metrics.record('download.fetch', day=str(day), status='error', error=repr(e),
+                           wall_s=round(time.perf_counter() - t0, 4))
+            return day, None
+
+        nbytes = 0
+        if granule is not None:
+            nbytes = os.path.getsize(granule) if isinstance(granule, str) else len(granule)
+        metrics.record('download.fetch', day=str(day), status='ok' if granule else 'nodata',
+                       wall_s=round(time.perf_counter() - t0, 4), bytes=nbytes)
+        if stats is not None and granule is not None:
+            with lock:
+                stats['download_s'] += time.perf_counter() - t0
+                stats['files'] += 1
+                stats['bytes'] += nbytes
+
+        if manifest is not None:
+            if granule is None:
+                manifest.add(day, 'nodata')
+            elif not in_memory:
+                manifest.add(day, 'downloaded', granule)
+        return day, granule
+
+    # keep at most 2 x workers days in flight, so downloads never run far ahead of processing
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        for day, url in sorted(urls.items()):
+            pending.append(pool.submit(task, day, url))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
@@ -0,0 +1,116 @@
+import numpy as np
+import pandas as pd
+
+# CI_cyano value of a pixel without detection on a day
+UNDER_DETECT = 0.00005
+
+
+class SparseGrid:
+    """
+    CI_cyano observations on a pixels x dates grid, kept sparse: one value (float32 by default)
+    per observed (date, pixel) with integer date and pixel indexes. Every other cell of the grid
+    takes the fill value ("under detect"), which is never stored: dense arrays are built on demand
+    for a date range or in chunks of dates, and the aggregates account for the fill value
+    directly. Observations without a value (NaN) take the fill value too. Pixels are all
+    locations observed at least once (sorted by clat, clon), dates all observed dates (sorted).
+    """
+
+    def __init__(self, df: pd.DataFrame, fill=UNDER_DETECT, dtype=np.float32):
+        pix = df.groupby(['clat', 'clon'], sort=True).ngroup().values.astype(np.int32)
+        dates, day = np.unique(pd.to_datetime(df['date']).values, return_inverse=True)
+        locs = df[['clat', 'clon']].drop_duplicates().sort_values(['clat', 'clon'])
+
+        self.fill = np.dtype(dtype).type(fill)
+        self.dates = pd.DatetimeIndex(dates)
+        self.clat = locs['clat'].values
+        self.clon = locs['clon'].values
+
+        # observations sorted by date then pixel, with the position of the first one of each date
+        order = np.lexsort((pix, day))
+        self.day = day[order].astype(np.int32)
+        self.pix = pix[order]
+        values = df['CI_cyano'].values[order]
+        self.values = np.where(np.isnan(values), fill, values).astype(dtype)
+        self.day_start = np.searchsorted(self.day, np.arange(len(dates) + 1))
+
+    @property
+    def shape(self):
+        return len(self.dates), len(self.clat)
+
+    def date_range(self, start_date=None, end_date=None):
+        """
+        Positions [i0, i1) of the dates within [start_date, end_date] (all dates by default)
+        """
+        i0 = 0 if start_date is None else self.dates.searchsorted(pd.Timestamp(start_date), 'left')
+        i1 = len(self.dates) if end_date is None else \
+            self.dates.searchsorted(pd.Timestamp(end_date), 'right')
+
+        return i0, max(i0, i1)
+
+    def dense(self, start_date=None, end_date=None):
+        """
+        Dense matrix (dates x pixels) of a date range, with the fill value where there is
+        no observation. Return the dates and the matrix.
+        """
+        i0, i1 = self.date_range(start_date, end_date)
+        k0, k1 = self.day_start[i0], self.day_start[i1]
+
+        out = np.full((i1 - i0, len(self.clat)), self.fill, dtype=self.values.dtype)
+        out[self.day[k0:k1] - i0, self.pix[k0:k1]] = self.values[k0:k1]
+
+        return self.dates[i0:i1], out
+
+    def chunks(self, days=30, start_date=None, end_date=None):
+        """
+        Dense matrices of consecutive chunks of at most days dates, as (dates, matrix) pairs
+        """
+        i0, i1 = self.date_range(start_date, end_date)
+        for i in range(i0, i1, days):
+            yield self.dense(self.dates[i], self.dates[min(i + days, i1) - 1])
+
+    def frame(self, start_date=None, end_date=None):
+        """
+        Long table of the dense grid of a date range (clat, clon, date, CI_cyano, Year, Month, Day),
+        with compact int16/int8 Year, Month and Day
+        """
+        dates, values = self.dense(start_date, end_date)
+        ndates, npix = values.shape
+
+        df = pd.DataFrame({'clat': np.tile(self.clat, ndates),
+                           'clon': np.tile(self.clon, ndates),
+                           'date': dates.repeat(npix),
+                           'CI_cyano': values.ravel()})
+        df['Year'] = df['date'].dt.year.astype(np.int16)
+        df['Month'] = df['date'].dt.month.astype(np.int8)
+        df['Day'] = df['date'].dt.day.astype(np.int8)
+
+        return df
+
+    def pixel_mean(self, start_date=None, end_date=None):
+        """
+        Mean CI_cyano of each pixel over a date range, unobserved days counting as the fill value
+        """
+        i0, i1 = self.date_range(start_date, end_date)
+        k0, k1 = self.day_start[i0], self.day_start[i1]
+        npix = len(self.clat)
+
+        total = np.bincount(self.pix[k0:k1], weights=self.values[k0:k1], minlength=npix)
+        nobs = np.bincount(self.pix[k0:k1], minlength=npix)
+        total += self.fill * ((i1 - i0) - nobs)
+
+        return total / max(i1 - i0, 1)
+
+    def daily_mean(self, start_date=None, end_date=None):
+        """
+        Mean CI_cyano of each date of a date range over all pixels, unobserved pixels counting as
+        the fill value
+        """
+        i0, i1 = self.date_range(start_date, end_date)
+        k0, k1 = self.day_start[i0], self.day_start[i1]
+        npix = len(self.clat)
+
+        total = np.bincount(self.day[k0:k1] - i0, weights=self.values[k0:k1], minlength=i1 - i0)
+        nobs = np.diff(self.day_start[i0:i1 + 1])
+        total += self.fill * (npix - nobs)
+
+        return pd.Series(total / npix, index=self.dates[i0:i1], name='CI_cyano')
@@ -0,0 +1,63 @@
+import numpy as np
+
+
+def isin_grid(nrows):
+    """
+    ISIN grid definition: center latitude, number of bins and first bin number of each row
+    """
+    latbin = (np.arange(0, nrows, dtype=np.float64) + 0.5) * (180.0 / nrows) - 90.0
+    numbin = (2 * nrows * np.cos(np.deg2rad(latbin)) + 0.5).astype(np.int64)
+    basebin = np.concatenate([[1], 1 + np.cumsum(numbin)[:-1]])
+
+    return latbin, numbin, basebin
+
+
+def bin_geometry(bin_num, nrows, columns=('clat', 'clon', 'north', 'south', 'west', 'east'),
+                 dtype=np.float64):
+    """
+    Center and bounds of ISIN bins from their bin numbers: {column: values} for the requested
+    columns among clat, clon, north, south, west, east
+    """
+    latbin, numbin, basebin = isin_grid(nrows)
+    row = np.searchsorted(basebin, bin_num, side='right') - 1
+    nbins = numbin[row]
+
+    clat = latbin[row]
+    clon = (360.0 * (bin_num - basebin[row] + 0.5) / nbins) - 180.0
+    derive = {'clat': lambda: clat,
+              'clon': lambda: clon,
+              'north': lambda: clat + (90.0 / nrows),
+              'south': lambda: clat - (90.0 / nrows),
+              'west': lambda: clon - (180.0 / nbins),
+              'east': lambda: clon + (180.0 / nbins)}
+
+    return {c: derive[c]().astype(dtype, copy=False) for c in columns}
+
+
+def ranges_to_index(bin_num, ranges):
+    """
+    Positions in the sorted array bin_num of the bins that fall in any of the [first, last] ranges
+    """
+    lo = np.searchsorted(bin_num, ranges[:, 0], side='left')
+    hi = np.searchsorted(bin_num, ranges[:, 1], side='right')
+    count = np.maximum(hi - lo, 0)
+
+    # lo[i], lo[i]+1, ..., hi[i]-1 for every range, without a Python loop
+    start = np.cumsum(count) - count
+
+    return np.repeat(lo - start, count) + np.arange(count.sum(), dtype=np.int64)
+
+
+def points_in_polygon(x, y, polygon):
+    """
+    Ray-casting test of points (x, y) against a polygon given as a list of (x, y) vertices
+    """
+    poly = np.asarray(polygon, dtype=np.float64)
+    inside = np.zeros(len(x), dtype=bool)
+    for (x1, y1), (x2, y2) in zip(poly, np.roll(poly, -1, axis=0)):
+        crosses = (y1 > y) != (y2 > y)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            x_cross = x1 + (y - y1) * (x2 - x1) / (y2 - y1)
+        inside ^= crosses & (x < x_cross)
+
+    return inside
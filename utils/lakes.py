@@ -0,0 +1,68 @@
+import json
+import numpy as np
+from utils import isin
+
+# Lake registry: name -> region, given either as a bounding box
+# [lon_min, lat_min, lon_max, lat_max] or as a polygon [[lon, lat], ...],
+# optionally with lake-specific HAB thresholds "hab": [medium, high]
+LAKES = {
+    'jordan': {'bbox': [-79.07959, 35.676263, -78.95462, 35.885728]},
+    'mendota': {'bbox': [-89.565, 43.075, -89.365, 43.275]},
+    'mattamuskeet': {'bbox': [-76.3, 35.4, -76.1, 35.6]},
+}
+
+
+def load_registry(path=None):
+    """
+    Return the lake registry, extended with (or overridden by) the lakes in a JSON file
+    """
+    registry = dict(LAKES)
+    if path:
+        with open(path) as f:
+            registry.update(json.load(f))
+
+    return registry
+
+
+def get_lakes(names, registry=None):
+    """
+    Look up lakes by name, return {name: region}
+    """
+    registry = registry or LAKES
+    unknown = [n for n in names if n not in registry]
+    if unknown:
+        raise KeyError(f"Unknown lakes: {unknown}. Known lakes: {sorted(registry)}")
+
+    return {n: registry[n] for n in names}
+
+
+def hab_thresholds(registry=None):
+    """
+    Lake-specific HAB thresholds of the registry, {name: (medium, high)}
+    """
+    registry = registry or LAKES
+
+    return {name: tuple(region['hab']) for name, region in registry.items() if 'hab' in region}
+
+
+def region_bbox(region):
+    """
+    Bounding box (lon_min, lat_min, lon_max, lat_max) of a bbox or polygon region
+    """
+    if 'bbox' in region:
+        return tuple(region['bbox'])
+    poly = np.asarray(region['polygon'], dtype=np.float64)
+
+    return (poly[:, 0].min(), poly[:, 1].min(), poly[:, 0].max(), poly[:, 1].max())
+
+
+def in_region(df, region):
+    """
+    Mask of bins in a region: bins entirely inside a bbox, or bins whose center is inside a polygon
+    """
+    if 'bbox' in region:
+        lon_min, lat_min, lon_max, lat_max = region['bbox']
+        return ((df['west'] >= lon_min) & (df['east'] <= lon_max) &
+                (df['south'] >= lat_min) & (df['north'] <= lat_max)).values
+
+    return isin.points_in_polygon(df['clon'].values, df['clat'].values, region['polygon'])
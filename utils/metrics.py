@@ -0,0 +1,218 @@
+import os
+import io
+import json
+import time
+import pstats
+import cProfile
+import datetime
+import functools
+import resource
+import threading
+import tracemalloc
+from collections import deque
+from contextlib import contextmanager
+import pandas as pd
+
+# JSON lines file of the metrics; set by configure and inherited by spawned worker processes
+ENV_PATH = 'CYAN_METRICS'
+
+
+def peak_rss_mb():
+    """
+    Peak resident memory of this process so far, in MB (ru_maxrss is in KB on Linux)
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def nrows(obj):
+    """
+    Number of rows of a DataFrame or Arrow table, None for anything else
+    """
+    if isinstance(obj, pd.DataFrame):
+        return len(obj)
+
+    return getattr(obj, 'num_rows', None)
+
+
+class Metrics:
+    """
+    Recorder of pipeline stages: wall and CPU time, peak RSS, rows in/out, bytes and any other
+    counters of each stage, kept in memory (the last maxlen stages) and appended as one JSON
+    line per stage to a metrics file if a path is set. With trace_memory=True, the peak memory
+    allocated by Python during each stage (tracemalloc) is recorded too.
+    """
+
+    def __init__(self, path=None, trace_memory=False, maxlen=10_000):
+        self.path = path
+        self.trace_memory = trace_memory
+        self.records = deque(maxlen=maxlen)
+        self.lock = threading.Lock()
+        self.started = datetime.datetime.now().isoformat(timespec='milliseconds')
+
+    def record(self, stage, **fields):
+        """
+        Record a stage measured by the caller (e.g. in a worker process)
+        """
+        entry = {'time': datetime.datetime.now().isoformat(timespec='milliseconds'),
+                 'stage': stage, 'pid': os.getpid(), **fields}
+        with self.lock:
+            self.records.append(entry)
+            if self.path:
+                with open(self.path, 'a') as f:
+                    f.write(json.dumps(entry, default=str) + '\n')
+
+        return entry
+
+    @contextmanager
+    def stage(self, name, **fields):
+        """
+        Time the enclosed block as stage name. The yielded dict takes counters found while
+        running (rows_out, bytes, ...). A stage that raises is recorded with status 'error'
+        and the error, then the exception propagates.
+        """
+        info = dict(fields)
+        if self.trace_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+        wall, cpu = time.perf_counter(), time.process_time()
+        status, error = 'ok', None
+        try:
+            yield info
+        except BaseException as e:
+            status, error = 'error', repr(e)
+            raise
+        finally:
+            out = {'status': status, 'wall_s': round(time.perf_counter() - wall, 4),
+                   'cpu_s': round(time.process_time() - cpu, 4),
+                   'peak_rss_mb': round(peak_rss_mb(), 1)}
+            if self.trace_memory:
+                out['traced_peak_mb'] = round(tracemalloc.get_traced_memory()[1] / 2**20, 1)
+            if error is not None:
+                out['error'] = error
+            self.record(name, **out, **info)
+
+    def timed(self, name=None):
+        """
+        Decorator recording each call of a function as a stage, with the rows of its first
+        argument (rows_in) and of its result (rows_out) when they are tables
+        """
+        def decorator(func):
+            stage_name = name or f'{func.__module__}.{func.__name__}'
+
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                fields = {}
+                if args and nrows(args[0]) is not None:
+                    fields['rows_in'] = nrows(args[0])
+                with self.stage(stage_name, **fields) as info:
+                    out = func(*args, **kwargs)
+                    first = out[0] if isinstance(out, tuple) and out else out
+                    if nrows(first) is not None:
+                        info['rows_out'] = nrows(first)
+                return out
+
+            return wrapper
+
+        return decorator
+
+    def summary(self, records=None):
+        """
+        Totals per stage of the recorded stages (or of records): calls, errors, wall and CPU
+        time, rows, bytes and the highest peak RSS
+        """
+        df = pd.DataFrame(list(self.records) if records is None else records)
+        if df.empty:
+            return df
+        for c in ['wall_s', 'cpu_s', 'peak_rss_mb', 'rows_in', 'rows_out', 'bytes']:
+            if c not in df.columns:
+                df[c] = float('nan')
+        df['errors'] = (df.get('status') == 'error').astype(int)
+
+        # NaN where no record of the stage has the counter
+        groups = df.groupby('stage', sort=False)
+        out = groups[['wall_s', 'cpu_s', 'rows_in', 'rows_out', 'bytes']].sum(min_count=1)
+        out.insert(0, 'errors', groups['errors'].sum())
+        out.insert(0, 'calls', groups.size())
+        out['peak_rss_mb'] = groups['peak_rss_mb'].max()
+
+        return out
+
+
+# metrics of this process, used through the functions below by the pipeline modules; worker
+# processes started after configure() append to the same file
+recorder = Metrics(path=os.environ.get(ENV_PATH))
+
+
+def record(stage, **fields):
+    return recorder.record(stage, **fields)
+
+
+def stage(name, **fields):
+    return recorder.stage(name, **fields)
+
+
+def timed(name=None):
+    return recorder.timed(name)
+
+
+def summary():
+    return recorder.summary()
+
+
+def configure(path=None, trace_memory=False):
+    """
+    Write the metrics of this process, and of the worker processes it starts, to path
+    (JSON lines); with trace_memory, also record the traced Python memory of each stage
+    """
+    recorder.path = path
+    recorder.trace_memory = trace_memory
+    recorder.started = datetime.datetime.now().isoformat(timespec='milliseconds')
+    if path:
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        os.environ[ENV_PATH] = path
+
+
+@contextmanager
+def profile(path=None, top=25):
+    """
+    Run the enclosed block under cProfile if path is given: the statistics are saved to path
+    (open with pstats or snakeviz) and the top functions by cumulative time are printed
+    """
+    if not path:
+        yield
+        return
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(path)
+        out = io.StringIO()
+        pstats.Stats(profiler, stream=out).sort_stats('cumulative').print_stats(top)
+        print(out.getvalue())
+        print("Profile saved:", path)
+
+
+def load(path, since=None):
+    """
+    Records of a metrics file, those written since a time (ISO string) if given
+    """
+    with open(path) as f:
+        records = [json.loads(line) for line in f if line.strip()]
+
+    return [r for r in records if since is None or r['time'] >= since]
+
+
+def report():
+    """
+    Print the totals per stage of this run (this process and its workers) if metrics are
+    written to a file
+    """
+    if recorder.path and os.path.exists(recorder.path):
+        records = load(recorder.path, since=recorder.started)
+        if records:
+            print("\nStage metrics (also in", recorder.path + "):")
+            print(recorder.summary(records).to_string())
@@ -0,0 +1,31 @@
+import os
+import json
+import threading
+
+
+class ModelRegistry:
+    """
+    Persistent registry of SARIMA models, one entry per series (lake): selected orders,
+    fitted parameters, fingerprint of the training data, dates of the last order search and
+    fit, and fit diagnostics. Stored as a JSON file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.entries = json.load(f)
+
+    def get(self, key):
+        return self.entries.get(key)
+
+    def put(self, key, entry):
+        with self.lock:
+            self.entries[key] = entry
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            tmp = self.path + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(self.entries, f, indent=1, sort_keys=True)
+            os.replace(tmp, self.path)
@@ -0,0 +1,154 @@
+import numpy as np
+import pandas as pd
+import plotly.graph_objs as go
+from plotly.io.json import to_json_plotly
+
+# pixel maps: SVG markers up to WEBGL_POINTS pixels, WebGL markers up to HEATMAP_POINTS pixels,
+# and a heatmap on the grid of the pixels above
+WEBGL_POINTS = 5_000
+HEATMAP_POINTS = 50_000
+
+# most points of a time series sent to the browser
+MAX_LINE_POINTS = 2_000
+
+# decimals of the pixel coordinates sent to the browser (about 1 m)
+COORD_DECIMALS = 5
+
+
+def hover(label, value, fmt):
+    """
+    Hover template showing "label: value" and the x/y position; the browser formats the values
+    already sent for the plot, so no hover text is sent
+    """
+    return f'{label}: %{{{value}:{fmt}}}<br>(%{{x}}, %{{y}})<extra></extra>'
+
+
+def pixel_grid(clat, clon, values):
+    """
+    Pixels on a regular lat/lon grid for a heatmap: one grid row per ISIN row (latitude), and
+    columns spaced by the widest pixel spacing of the rows, so that every row is drawn without
+    gaps. Rows further from the equator have a few more bins than columns, so neighbouring
+    bins can share a cell: the cell takes their mean, and every pixel is shown. Return the
+    column longitudes, row latitudes and the values (NaN where no pixel).
+    """
+    clat, clon = np.asarray(clat), np.asarray(clon)
+    values = np.asarray(values, dtype=np.float64)
+    lat, row = np.unique(clat, return_inverse=True)
+
+    order = np.lexsort((clon, row))
+    same_row = row[order][1:] == row[order][:-1]
+    gaps = np.diff(clon[order])[same_row]
+    if len(gaps):
+        step = pd.Series(gaps).groupby(row[order][1:][same_row]).min().max()
+    else:
+        step = 1.0
+    col = np.rint((clon - clon.min()) / step).astype(np.int64)
+    ncols = col.max() + 1
+
+    # mean of the pixels of each cell, NaN values left out
+    cell = row * ncols + col
+    valid = np.isfinite(values)
+    total = np.bincount(cell[valid], weights=values[valid], minlength=len(lat) * ncols)
+    count = np.bincount(cell[valid], minlength=len(lat) * ncols)
+    with np.errstate(invalid='ignore'):
+        z = (total / count).reshape(len(lat), ncols)
+    lon = clon.min() + step * np.arange(ncols)
+
+    return lon, lat, z
+
+
+def pixel_trace(clat, clon, values, label, fmt, coloraxis, size=8):
+    """
+    Trace of a pixel map: SVG markers for small lakes, WebGL markers (Scattergl) for larger
+    ones, and a heatmap on the pixel grid above HEATMAP_POINTS pixels
+    """
+    npix = len(values)
+    clat = np.round(np.asarray(clat, dtype=np.float64), COORD_DECIMALS)
+    clon = np.round(np.asarray(clon, dtype=np.float64), COORD_DECIMALS)
+    if npix > HEATMAP_POINTS:
+        lon, lat, z = pixel_grid(clat, clon, values)
+        return go.Heatmap(x=lon, y=lat, z=z, coloraxis=coloraxis,
+                          hovertemplate=hover(label, 'z', fmt))
+
+    scatter = go.Scattergl if npix > WEBGL_POINTS else go.Scatter
+    return scatter(x=clon, y=clat, mode='markers',
+                   marker=dict(size=size, color=values, opacity=0.8, coloraxis=coloraxis),
+                   hovertemplate=hover(label, 'marker.color', fmt))
+
+
+def lttb(x, y, n):
+    """
+    Largest-Triangle-Three-Buckets decimation: positions of n points of the series (x, y)
+    keeping its visual shape. The first and last points are kept; in each of the n - 2 buckets
+    in between, the point forming the largest triangle with the point kept in the previous
+    bucket and the average of the next bucket is kept.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    size = len(x)
+    if n >= size or n < 3:
+        return np.arange(size)
+
+    edges = np.linspace(1, size - 1, n - 1).astype(np.int64)
+    # average of each bucket, and of the last point as the bucket after the last one
+    sums_x = np.add.reduceat(x[:-1], edges[:-1])
+    sums_y = np.add.reduceat(y[:-1], edges[:-1])
+    counts = np.diff(edges)
+    avg_x = np.append(sums_x / counts, x[-1])
+    avg_y = np.append(sums_y / counts, y[-1])
+
+    out = np.empty(n, dtype=np.int64)
+    out[0], out[-1] = 0, size - 1
+    a = 0
+    for i in range(n - 2):
+        lo, hi = edges[i], edges[i + 1]
+        area = np.abs((x[a] - avg_x[i + 1]) * (y[lo:hi] - y[a]) -
+                      (x[a] - x[lo:hi]) * (avg_y[i + 1] - y[a]))
+        a = lo + area.argmax()
+        out[i + 1] = a
+
+    return out
+
+
+def minmax(y, n):
+    """
+    Min/max-per-bucket decimation: positions of the minimum and maximum of each of n // 2
+    buckets of the series, in order, so that every peak and trough is kept
+    """
+    y = np.asarray(y, dtype=np.float64)
+    size = len(y)
+    nbuckets = n // 2
+    if n >= size or nbuckets < 1:
+        return np.arange(size)
+
+    edges = np.linspace(0, size, nbuckets + 1).astype(np.int64)
+    bucket = np.repeat(np.arange(nbuckets), np.diff(edges))
+    # position of the first minimum and maximum of each bucket
+    order = np.lexsort((y, bucket))
+    first = edges[:-1]
+    last = edges[1:] - 1
+
+    return np.unique(np.concatenate([order[first], order[last]]))
+
+
+def decimate(x, y, n=MAX_LINE_POINTS, method='lttb'):
+    """
+    Positions of at most n points of a time series (x: dates or numbers), all points if fewer
+    """
+    if len(y) <= n:
+        return np.arange(len(y))
+    if method == 'minmax':
+        return minmax(y, n)
+
+    x = np.asarray(x)
+    if np.issubdtype(x.dtype, np.datetime64):
+        x = x.astype('datetime64[ns]').astype(np.int64)
+
+    return lttb(x, y, n)
+
+
+def payload_size(*figures):
+    """
+    Size in bytes of figures as sent to the browser (plotly JSON)
+    """
+    return sum(len(to_json_plotly(fig)) for fig in figures)
@@ -1,69 +1,77 @@
 import datetime
+import hashlib
 import pandas as pd
 import numpy as np
 import pmdarima as pm
 from statsmodels.tsa.statespace.sarimax import SARIMAX
-import statsmodels.tsa.seasonal as sts
 import plotly.express as px
 from plotly.subplots import make_subplots
+from utils import metrics
+from utils.decompose import Decomposition
 
 
-def prep_data(df: pd.DataFrame):
+@metrics.timed('sarima.prep_data')
+def prep_data(df: pd.DataFrame, by=None):
     """
     Prepare data for time-series model: transform to weekly, impute missing week, log-transform ci values
-    """
 
-    # aggreate data to daily then weekly
-    df['date'] = pd.to_datetime(df['date'])
-    df_daily = df.groupby('date').agg(
-        CI_cyano=('CI_cyano', 'mean')).reset_index()
-    df_daily['month'] = df_daily.date.dt.month
-    df_daily['week'] = df_daily.date.dt.isocalendar().week
-    df_daily['year'] = df_daily.date.dt.isocalendar().year
-    df_weekly = df_daily.groupby(['year', 'week']).agg(
+    Weeks are ISO weeks (including week 53). Every week between the first and the last observed
+    week is kept; missing weeks are dated on their Monday and imputed with the mean CI_cyano of
+    the same week of the year (nearest observed week of the year if that week was never observed).
+    With by (e.g. 'lake'), each group is a separate series and the group column is kept.
+    The input DataFrame is not modified.
+    """
+    group = by if by is not None else '_series'
+    dates = df['date']
+    if not pd.api.types.is_datetime64_any_dtype(dates):
+        dates = pd.to_datetime(dates)
+    keys = df[by].values if by is not None else np.zeros(len(df), dtype=np.int8)
+
+    # aggregate data to daily then weekly
+    df_daily = pd.DataFrame({group: keys, 'date': dates.values, 'CI_cyano': df['CI_cyano'].values})
+    df_daily = df_daily.groupby([group, 'date'], observed=True, sort=False).CI_cyano.mean().reset_index()
+    iso = df_daily.date.dt.isocalendar()
+    df_daily['year'] = iso.year.astype(int).values
+    df_daily['week'] = iso.week.astype(int).values
+    df_weekly = df_daily.groupby([group, 'year', 'week'], observed=True).agg(
         date=('date', 'min'), CI_cyano=('CI_cyano', 'mean')).reset_index()
-    df_weekly = df_weekly.sort_values(by='date')
-    df_weekly['year'] = df_weekly['year'].astype(int)
-    df_weekly['week'] = df_weekly['week'].astype(int)
-
-    # impute missing weeks with mean
-    week_first = df_weekly[df_weekly.date ==
-                           df_weekly.date.min()].week.values[0]
-    week_last = df_weekly[df_weekly.date ==
-                          df_weekly.date.max()].week.values[0]
-    years = df_weekly.year.unique()
-
-    df_weekly_imp = df_weekly.copy()
-    append_rows = {'year': [], 'week': [], 'date': []}
-
-    cicyano_mean = df_weekly.groupby('week').CI_cyano.mean().reset_index()
-    cicyano_mean['week'] = cicyano_mean['week'].astype(int)
-
-    for w in range(1, 53):
-        if w < week_first:
-            yy = years[1:]
-        elif w > week_last:
-            yy = years[:-1]
-        else:
-            yy = years
-        tmpdf = df_weekly_imp[df_weekly_imp.week == w]
-        y_avg = tmpdf.CI_cyano.mean()
-        for y in yy:
-            tmpdf2 = tmpdf[tmpdf.year == y]
-            if len(tmpdf2) == 0:
-                append_rows['year'].append(y)
-                append_rows['week'].append(w)
-                append_rows['date'].append(datetime.datetime.strptime(
-                    str(y)+'-W'+str(w)+'-1', '%G-W%V-%u'))
-
-    df_append = pd.DataFrame(append_rows)
-    df_append['week'] = df_append['week'].astype(int)
-
-    df_append = pd.merge_asof(
-        left=df_append, right=cicyano_mean, on='week', direction='nearest')
-    df_weekly_imp = pd.concat(
-        [df_weekly_imp, df_append], axis=0, ignore_index=True)
-    df_weekly_imp = df_weekly_imp.sort_values(by='date').reset_index(drop=True)
+    df_weekly['monday'] = df_weekly.date.dt.normalize() - \
+        pd.to_timedelta(df_weekly.date.dt.weekday, unit='D')
+
+    # complete grid of weeks from the first to the last observed week of each series
+    span = df_weekly.groupby(group, observed=True).monday.agg(['min', 'max'])
+    nweeks = ((span['max'] - span['min']).dt.days.values // 7 + 1).astype(np.int64)
+    offset = np.arange(nweeks.sum()) - np.repeat(np.cumsum(nweeks) - nweeks, nweeks)
+    mondays = np.repeat(span['min'].values, nweeks) + offset * np.timedelta64(7, 'D')
+    grid = pd.MultiIndex.from_arrays([span.index.repeat(nweeks), mondays],
+                                     names=[group, 'monday'])
+    df_weekly_imp = df_weekly.set_index([group, 'monday']).reindex(grid).reset_index()
+    iso = df_weekly_imp.monday.dt.isocalendar()
+    df_weekly_imp['year'] = iso.year.astype(int).values
+    df_weekly_imp['week'] = iso.week.astype(int).values
+
+    # impute missing weeks with the week-of-year mean, nearest observed week if never observed
+    clim = df_weekly.pivot_table(index=group, columns='week', values='CI_cyano', aggfunc='mean',
+                                 observed=True).reindex(index=span.index, columns=range(1, 54))
+    clim = clim.values
+    pos = np.arange(53)
+    seen = ~np.isnan(clim)
+    lo = np.maximum.accumulate(np.where(seen, pos, -1), axis=1)
+    hi = np.minimum.accumulate(np.where(seen, pos, 53)[:, ::-1], axis=1)[:, ::-1]
+    nearest = np.where((lo >= 0) & ((hi == 53) | (pos - lo <= hi - pos)), lo, hi)
+    clim = np.take_along_axis(clim, nearest, axis=1)
+
+    missing = df_weekly_imp.CI_cyano.isna().values
+    series = np.repeat(np.arange(len(span)), nweeks)
+    df_weekly_imp.loc[missing, 'CI_cyano'] = \
+        clim[series[missing], df_weekly_imp.week.values[missing] - 1]
+    df_weekly_imp['date'] = df_weekly_imp.date.fillna(df_weekly_imp.monday)
+
+    columns = ['year', 'week', 'date', 'CI_cyano']
+    if by is not None:
+        columns = [by] + columns
+    df_weekly_imp = df_weekly_imp[columns].sort_values(
+        by=columns[:1] + ['date'] if by is not None else 'date').reset_index(drop=True)
 
     # log-transform ci cyano values
     df_weekly_imp['log_y'] = np.log(df_weekly_imp.CI_cyano)
@@ -73,16 +81,29 @@ def prep_data(df: pd.DataFrame):
 
 # Seasonality & Trend Decomposition
 def decomp_ts(ts, period=52, model='additive'):
-    res = sts.seasonal_decompose(ts, period=period, model=model)
+    """
+    Decompose one weekly series (indexed by date) and show the plot of its components
+    """
+    dec = Decomposition(ts.values, period=period, model=model, dates=ts.index, names=[ts.name])
+    plot_decomp(dec).show()
+
+    return dec
+
+
+def plot_decomp(dec: Decomposition, i=0):
+    """
+    Figure of the components of series i (position or name) of a decomposition
+    """
+    res = dec.frame(i)
 
     # Create separate line plots for trend, seasonal, and residual components
-    fig1 = px.line(x=ts.index, y=ts, labels={
+    fig1 = px.line(x=res.date, y=res.observed, labels={
                    'x': 'Date', 'y': 'CI_cyano'}, title='CI_cyano')
-    fig2 = px.line(x=ts.index, y=res.trend, labels={
+    fig2 = px.line(x=res.date, y=res.trend, labels={
                    'x': 'Date', 'y': 'Trend'}, title='Trend')
-    fig3 = px.line(x=ts.index, y=res.seasonal, labels={
+    fig3 = px.line(x=res.date, y=res.seasonal, labels={
                    'x': 'Date', 'y': 'Seasonal'}, title='Seasonal')
-    fig4 = px.scatter(x=ts.index, y=res.resid, labels={
+    fig4 = px.scatter(x=res.date, y=res.resid, labels={
                       'x': 'Date', 'y': 'Residual'}, title='Residual')
 
     # Combine fig1-4 as subplots
@@ -109,24 +130,22 @@ def decomp_ts(ts, period=52, model='additive'):
     fig.update_xaxes(title_text="Date", row=4, col=1)
     fig.update_yaxes(title_text="Residual", row=4, col=1)
     fig.add_hline(y=0, row=4, col=1)
-    fig.show()
 
+    return fig
 
-# Train SARIMA model
-def train(d_in: pd.DataFrame):
+
+# Search SARIMA orders
+@metrics.timed('sarima.search_orders')
+def search_orders(d_in: pd.DataFrame, trace=True):
     """
-    Predict CI_cyano each coordinate of the area for the next n days
-    Return data: actual data, df_fcst: forecasted output
+    Stepwise search of the SARIMA orders minimizing BIC.
+    Return the (p, d, q) order, the seasonal order and the trend ('c' or None)
     """
-    # Prepare dataset for model fitting
-    df = d_in.copy()
-
-    # tune the hyperparameters of the SARIMA model
-    best_model = pm.auto_arima(df.log_y,
+    best_model = pm.auto_arima(d_in.log_y,
                                max_p=2, max_q=2,
                                max_P=2, max_Q=2,
                                m=52, seasonal=True,
-                               d=0, D=1, trace=True,
+                               d=0, D=1, trace=trace,
                                information_criterion='bic',
                                error_action='ignore',
                                suppress_warnings=True,
@@ -138,15 +157,117 @@ def train(d_in: pd.DataFrame):
     if best_model.get_params()['with_intercept']:
         c_trend = 'c'
 
-    model_name = 'SARIMA'+str(a_order)+'x'+str(s_order)
+    return a_order, s_order, c_trend
+
+
+def model_name(a_order, s_order):
+    return 'SARIMA'+str(tuple(a_order))+'x'+str(tuple(s_order))
+
+
+# Train SARIMA model
+@metrics.timed('sarima.train')
+def train(d_in: pd.DataFrame, trace=True):
+    """
+    Predict CI_cyano each coordinate of the area for the next n days
+    Return data: actual data, df_fcst: forecasted output
+    """
+    # Prepare dataset for model fitting
+    df = d_in.copy()
+
+    # tune the hyperparameters of the SARIMA model
+    a_order, s_order, c_trend = search_orders(df, trace=trace)
 
     smodel = SARIMAX(df.log_y, order=a_order,
                      seasonal_order=s_order, trend=c_trend).fit(disp=False)
 
-    return model_name, smodel
+    return model_name(a_order, s_order), smodel
+
+
+def fingerprint(d_in: pd.DataFrame):
+    """
+    Hash of the weekly series (dates and log values), to detect new or revised data
+    """
+    h = hashlib.sha1(d_in.date.values.astype('datetime64[ns]').tobytes())
+    h.update(np.round(d_in.log_y.values.astype(np.float64), 8).tobytes())
+
+    return h.hexdigest()
+
+
+def diagnostics(smodel):
+    """
+    Fit quality used to decide when a new order search is needed:
+    BIC per observation, and p-value of the Ljung-Box test on the residuals (10 lags)
+    """
+    lb = smodel.test_serial_correlation('ljungbox', lags=[10])
+
+    return {'bic_per_obs': float(smodel.bic / smodel.nobs),
+            'ljungbox_p': float(lb[0, 1, -1])}
+
+
+def degraded(new, old, bic_tol=0.05, alpha=0.01):
+    """
+    True if the fit got worse than the registered one: BIC per observation up by more than
+    bic_tol (relative), or residuals that became autocorrelated
+    """
+    worse_bic = new['bic_per_obs'] > old['bic_per_obs'] + bic_tol * abs(old['bic_per_obs'])
+    autocorrelated = new['ljungbox_p'] < alpha <= old['ljungbox_p']
+
+    return worse_bic or autocorrelated
+
+
+@metrics.timed('sarima.train_cached')
+def train_cached(d_in: pd.DataFrame, entry=None, max_age_days=28, research=False, trace=True):
+    """
+    Train a SARIMA model reusing a model registry entry (see utils/registry.py):
+    - same data fingerprint: registered parameters are reused as is, nothing is fitted
+    - new data: the model is refitted with the registered orders, starting from the
+      registered parameters
+    - no entry, order search older than max_age_days, research=True, or a refit whose
+      diagnostics degraded: full order search
+    Return the model name, the fitted model, the new registry entry and the action taken.
+    """
+    df = d_in.copy()
+    fp = fingerprint(df)
+    today = datetime.date.today()
+
+    smodel, action = None, 'search'
+    if entry is not None and not research:
+        age = (today - datetime.date.fromisoformat(entry['searched'])).days
+        if age <= max_age_days:
+            mod = SARIMAX(df.log_y, order=entry['order'],
+                          seasonal_order=entry['seasonal_order'], trend=entry['trend'])
+            params = np.array(entry['params'])
+            if entry['fingerprint'] == fp:
+                smodel, action = mod.filter(params), 'reused'
+            else:
+                smodel, action = mod.fit(start_params=params, disp=False), 'refit'
+                if degraded(diagnostics(smodel), entry['diagnostics']):
+                    smodel, action = None, 'search'
+
+    if smodel is None:
+        a_order, s_order, c_trend = search_orders(df, trace=trace)
+        smodel = SARIMAX(df.log_y, order=a_order,
+                         seasonal_order=s_order, trend=c_trend).fit(disp=False)
+        searched = today.isoformat()
+    else:
+        a_order, s_order, c_trend = entry['order'], entry['seasonal_order'], entry['trend']
+        searched = entry['searched']
+
+    new_entry = {'order': list(a_order),
+                 'seasonal_order': list(s_order),
+                 'trend': c_trend,
+                 'params': [float(x) for x in smodel.params],
+                 'param_names': list(smodel.model.param_names),
+                 'fingerprint': fp,
+                 'searched': searched,
+                 'fitted': today.isoformat(),
+                 'diagnostics': diagnostics(smodel)}
+
+    return model_name(a_order, s_order), smodel, new_entry, action
 
 
 # make predictions with SARIMA model
+@metrics.timed('sarima.predict')
 def predict(d_in: pd.DataFrame, mod, n=12):
     sfitted = mod.get_prediction(
         start=d_in.index[0], end=d_in.index[-1], dynamic=False).conf_int()
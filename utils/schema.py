@@ -0,0 +1,39 @@
+import numpy as np
+import pyarrow as pa
+from utils import isin
+
+# Columns of the stored CYAN tables: the bin number is the key, the bin geometry is derived from
+# it at read time with the number of ISIN grid rows kept in the file metadata (all the files of
+# a dataset are expected to be on the same grid)
+CI_VARS = ['CI_stumpf', 'CI_cyano', 'CI_noncyano', 'MCI_stumpf']
+GEOMETRY = ['clat', 'clon', 'north', 'south', 'west', 'east']
+NROWS_KEY = b'isin_nrows'
+
+
+def storage_table(df, day, nrows):
+    """
+    Arrow table of one day of decoded bins in the storage schema: int64 bin_num, float32 CI
+    values, date32 date, dictionary-encoded lake (if any); geometry columns are dropped
+    """
+    n = len(df)
+    arrays = {'bin_num': pa.array(df['bin_num'].values.astype(np.int64))}
+    for k in CI_VARS:
+        arrays[k] = pa.array(df[k].values.astype(np.float32))
+    arrays['date'] = pa.array(np.full(n, np.datetime64(day, 'D')))
+    if 'lake' in df.columns:
+        arrays['lake'] = pa.array(df['lake'].values.astype(str)).dictionary_encode()
+
+    return pa.table(arrays).replace_schema_metadata({NROWS_KEY: str(nrows).encode()})
+
+
+def derive_geometry(df, nrows, columns=GEOMETRY, dtype=np.float64):
+    """
+    Add the geometry columns to a table read from storage (needs bin_num)
+    """
+    _, numbin, _ = isin.isin_grid(nrows)
+    if len(df) and df['bin_num'].max() > numbin.sum():
+        raise ValueError(f"Bin numbers beyond the {nrows}-row ISIN grid of the dataset metadata")
+    for c, values in isin.bin_geometry(df['bin_num'].values, nrows, columns, dtype).items():
+        df[c] = values
+
+    return df
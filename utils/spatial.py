@@ -0,0 +1,146 @@
+import operator
+from functools import reduce
+import numpy as np
+import pyarrow.dataset as pds
+from utils import isin
+
+
+class BinGrid:
+    """
+    Spatial index of the ISIN grid: maps a region to the exact bin-number ranges it selects, one
+    or more [first, last] ranges per grid row. A bbox selects the bins entirely inside it, a
+    polygon the bins whose center is inside it (same rules as lakes.in_region, with the geometry
+    computed as by process_L3B_file), so a lookup over sorted bin numbers returns exactly the
+    region's bins without testing any other bin.
+    """
+
+    def __init__(self, nrows, start_num=None, nbins=None):
+        """
+        Grid of nrows rows; start_num and nbins (BinIndex start_num/max of a file) override
+        the first bin number and number of bins of each row
+        """
+        self.nrows = nrows
+        self.latbin, self.numbin, self.basebin = isin.isin_grid(nrows)
+        if start_num is not None:
+            self.basebin = np.asarray(start_num).astype(np.int64)
+            self.numbin = np.asarray(nbins).astype(np.int64)
+
+    def clon(self, rows, cols):
+        return (360.0 * (cols + 0.5) / self.numbin[rows]) - 180.0
+
+    def first_col(self, rows, approx, ok):
+        """
+        First column of each row, near approx, for which ok(rows, cols) holds; ok is monotonic
+        in the column (False then True)
+        """
+        window = approx[:, None] + np.arange(-2, 3)
+        window = np.clip(window, 0, self.numbin[rows][:, None])
+        good = ok(rows[:, None], window) & (window < self.numbin[rows][:, None])
+        first = np.where(good.any(axis=1), window[np.arange(len(rows)), good.argmax(axis=1)],
+                         self.numbin[rows])
+
+        return first
+
+    def to_ranges(self, rows, col_from, col_to):
+        keep = col_from <= col_to
+        first = self.basebin[rows[keep]] + col_from[keep]
+
+        return np.column_stack([first, first + col_to[keep] - col_from[keep]]).astype(np.int64)
+
+    def bbox_ranges(self, bbox):
+        """
+        Bin ranges of the bins entirely inside bbox (lon_min, lat_min, lon_max, lat_max)
+        """
+        lon_min, lat_min, lon_max, lat_max = bbox
+        rows = np.where((self.latbin - (90.0 / self.nrows) >= lat_min) &
+                        (self.latbin + (90.0 / self.nrows) <= lat_max))[0]
+        n = self.numbin[rows]
+
+        def west_ok(r, c):
+            return self.clon(r, c) - (180.0 / self.numbin[r]) >= lon_min
+
+        def east_out(r, c):
+            return self.clon(r, c) + (180.0 / self.numbin[r]) > lon_max
+
+        col_from = self.first_col(rows, np.floor((lon_min + 180.0) / 360.0 * n).astype(np.int64),
+                                  west_ok)
+        col_to = self.first_col(rows, np.floor((lon_max + 180.0) / 360.0 * n).astype(np.int64),
+                                east_out) - 1
+
+        return self.to_ranges(rows, col_from, col_to)
+
+    def polygon_ranges(self, polygon):
+        """
+        Bin ranges of the bins whose center is inside polygon [[lon, lat], ...]: each row's center
+        line crosses the polygon edges at sorted longitudes X0 < X1 < ..., and the centers in
+        [X0, X1), [X2, X3), ... are inside (even-odd rule of isin.points_in_polygon)
+        """
+        poly = np.asarray(polygon, dtype=np.float64)
+        x1, y1 = poly[:, 0], poly[:, 1]
+        x2, y2 = np.roll(x1, -1), np.roll(y1, -1)
+        rows = np.where((self.latbin >= y1.min()) & (self.latbin <= y1.max()))[0]
+        y = self.latbin[rows][:, None]
+
+        crosses = (y1 > y) != (y2 > y)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            x_cross = np.where(crosses, x1 + (y - y1) * (x2 - x1) / (y2 - y1), np.inf)
+        x_cross.sort(axis=1)
+        x_from, x_to = x_cross[:, 0::2], x_cross[:, 1::2]
+        r, k = np.nonzero(np.isfinite(x_to))
+        rows, x_from, x_to = rows[r], x_from[r, k], x_to[r, k]
+        n = self.numbin[rows]
+
+        col_from = self.first_col(rows, np.floor((x_from + 180.0) / 360.0 * n).astype(np.int64),
+                                  lambda r, c: self.clon(r, c) >= x_from[:, None])
+        col_to = self.first_col(rows, np.floor((x_to + 180.0) / 360.0 * n).astype(np.int64),
+                                lambda r, c: self.clon(r, c) >= x_to[:, None]) - 1
+        ranges = self.to_ranges(rows, col_from, col_to)
+
+        return ranges[np.argsort(ranges[:, 0], kind='stable')]
+
+    def rows(self, ranges):
+        """
+        Grid row of each range
+        """
+        return np.searchsorted(self.basebin, ranges[:, 0], side='right') - 1
+
+    def ranges(self, region):
+        """
+        Bin ranges of a lake region ({'bbox': [...]} or {'polygon': [...]}), sorted
+        """
+        if 'bbox' in region:
+            return self.bbox_ranges(region['bbox'])
+
+        return self.polygon_ranges(region['polygon'])
+
+
+def ranges_filter(ranges, field='bin_num'):
+    """
+    Arrow filter expression selecting the bin ranges: the overall span (skips files and row
+    groups by their statistics) and the ranges themselves
+    """
+    b = pds.field(field)
+    if len(ranges) == 0:
+        return b < 0
+    span = (b >= int(ranges[0, 0])) & (b <= int(ranges[-1, 1]))
+
+    return span & reduce(operator.or_, [(b >= int(lo)) & (b <= int(hi)) for lo, hi in ranges])
+
+
+class SortedBins:
+    """
+    Index of a table by bin number: rows sorted by bin_num once, then the rows of any region
+    (bin ranges) are found by binary search, in time proportional to the result size
+    """
+
+    def __init__(self, bin_num):
+        bin_num = np.asarray(bin_num)
+        self.order = np.argsort(bin_num, kind='stable')
+        # same type as the ranges, so that lookups do not convert the whole array
+        self.bin_num = bin_num[self.order].astype(np.int64)
+
+    def lookup(self, ranges):
+        """
+        Positions (in the original table) of the rows in the bin ranges
+        """
+        return self.order[isin.ranges_to_index(self.bin_num, ranges)]
@@ -0,0 +1,172 @@
+import os
+import datetime
+import functools
+import threading
+import http.server
+import numpy as np
+import pandas as pd
+import xarray as xr
+import netCDF4
+from utils.isin import isin_grid
+from utils.lakes import LAKES, region_bbox
+
+# bounding box of the contiguous US (lon_min, lat_min, lon_max, lat_max)
+CONUS = (-125.0, 24.0, -66.0, 50.0)
+
+BIN_DATA_TYPE = np.dtype([('sum', 'f4'), ('sum_squared', 'f4')], align=True)
+CI_VARS = ['CI_stumpf', 'CI_cyano', 'CI_noncyano', 'MCI_stumpf']
+
+
+def bin_types(nrows):
+    """
+    BinIndex and BinList struct types; bin numbers are 64-bit on grids with more than 2**32 bins
+    """
+    _, numbin, _ = isin_grid(nrows)
+    num = 'u8' if numbin.sum() >= 2**32 else 'u4'
+    index_type = np.dtype([('start_num', num), ('begin', num),
+                           ('extent', 'u4'), ('max', 'u4')], align=True)
+    list_type = np.dtype([('bin_num', num), ('nobs', 'i2'), ('nscenes', 'i2'),
+                          ('weights', 'f4'), ('time_rec', 'f4')], align=True)
+
+    return index_type, list_type
+
+
+def lake_bboxes(registry=None, margin=0.05):
+    """
+    Bounding boxes of the registered lakes, widened by margin degrees: the area covered by a
+    lake-scale granule
+    """
+    registry = registry or LAKES
+    boxes = []
+    for region in registry.values():
+        lon_min, lat_min, lon_max, lat_max = region_bbox(region)
+        boxes.append((lon_min - margin, lat_min - margin, lon_max + margin, lat_max + margin))
+
+    return boxes
+
+
+def make_l3b_dataset(nrows=4320, bbox=CONUS, coverage=0.3, seed=0):
+    """
+    Build an in-memory dataset shaped like the "level-3_binned_data" group of a L3b_DAY_CYAN file:
+    BinIndex over all grid rows, and BinList/CI variables for a random share (coverage) of the
+    bins inside bbox (or inside any of a list of bboxes, e.g. lake_bboxes())
+    """
+    rng = np.random.default_rng(seed)
+    latbin, numbin, basebin = isin_grid(nrows)
+
+    bins = []
+    for box in ([bbox] if np.ndim(bbox) == 1 else bbox):
+        for r in np.where((latbin >= box[1]) & (latbin <= box[3]))[0]:
+            col_from = int((box[0] + 180.0) / 360.0 * numbin[r])
+            col_to = int((box[2] + 180.0) / 360.0 * numbin[r])
+            cols = np.arange(col_from, col_to)
+            bins.append(basebin[r] + cols[rng.random(cols.size) < coverage])
+    bins = np.unique(np.concatenate(bins))
+
+    index_type, list_type = bin_types(nrows)
+    bin_list = np.zeros(bins.size, dtype=list_type)
+    bin_list['bin_num'] = bins
+    bin_list['nobs'] = 1
+    bin_list['nscenes'] = 1
+    bin_list['weights'] = 1.0
+
+    bin_index = np.zeros(nrows, dtype=index_type)
+    bin_index['start_num'] = basebin
+    bin_index['max'] = numbin
+    row = np.searchsorted(basebin, bins, side='right') - 1
+    rows, first, extent = np.unique(row, return_index=True, return_counts=True)
+    bin_index['begin'][rows] = bins[first]
+    bin_index['extent'][rows] = extent
+
+    data_vars = {'BinList': ('binListDim', bin_list)}
+    for k in CI_VARS:
+        values = np.zeros(bins.size, dtype=BIN_DATA_TYPE)
+        values['sum'] = rng.lognormal(-8.0, 2.0, bins.size)
+        values['sum_squared'] = values['sum']**2
+        data_vars[k] = ('binListDim', values)
+    data_vars['BinIndex'] = ('binIndexDim', bin_index)
+
+    return xr.Dataset(data_vars)
+
+
+def write_l3b(ds, path):
+    """
+    Write a dataset built by make_l3b_dataset to a NetCDF file laid out like a L3b_DAY_CYAN
+    file: a "level-3_binned_data" group with the compound types of BinIndex, BinList and the
+    CI variables, readable by cyan_extract.open_L3B
+    """
+    with netCDF4.Dataset(path, 'w') as nc:
+        group = nc.createGroup('level-3_binned_data')
+        group.createDimension('binIndexDim', ds.sizes['binIndexDim'])
+        group.createDimension('binListDim', ds.sizes['binListDim'])
+        types = {'BinIndex': 'binIndexType', 'BinList': 'binListType'}
+        for name in ['BinIndex', 'BinList'] + CI_VARS:
+            values = ds[name].values
+            kind = group.createCompoundType(values.dtype, types.get(name, name + 'Type'))
+            group.createVariable(name, kind, ds[name].dims)[:] = values
+
+
+def write_granules(folder, date_from, days=10, nrows=4320, bbox=CONUS, coverage=0.3, seed=0):
+    """
+    Write one synthetic L3b_DAY_CYAN file per day from date_from (datetime.date), named as on
+    the NASA server (see cyan_extract.getL3Burl), so that a local HTTP server on folder can stand
+    in for it. Return the paths.
+    """
+    os.makedirs(folder, exist_ok=True)
+    paths = []
+    for i in range(days):
+        day = date_from + datetime.timedelta(days=i)
+        path = os.path.join(folder, day.strftime('L%Y%j.L3b_DAY_CYAN.nc'))
+        write_l3b(make_l3b_dataset(nrows, bbox, coverage, seed + i), path)
+        paths.append(path)
+
+    return paths
+
+
+class _QuietHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(folder):
+    """
+    Serve the files of folder over HTTP on a free local port, from a background thread.
+    Return the server (call shutdown() to stop it) and its base URL, to use as the base_url
+    of cyan_extract.extract_cyan.
+    """
+    handler = functools.partial(_QuietHandler, directory=folder)
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return server, f'http://127.0.0.1:{server.server_address[1]}/'
+
+
+def make_lake_data(npix=2000, ndays=2900, coverage=0.5, start='2016-05-01', lakes=None, seed=0):
+    """
+    Build an extracted dataset like getdata returns for one lake: a square of npix pixels observed
+    on a random share (coverage) of ndays days, with a seasonal log-normal CI_cyano.
+    With lakes (list of names), one such dataset per lake with a lake column.
+    """
+    if lakes is not None:
+        return pd.concat([make_lake_data(npix, ndays, coverage, start, seed=seed + i).assign(lake=lake)
+                          for i, lake in enumerate(lakes)], ignore_index=True)
+
+    rng = np.random.default_rng(seed)
+    side = int(np.ceil(np.sqrt(npix)))
+    clat = 43.1 + 0.0026 * (np.arange(npix) // side)
+    clon = -89.5 + 0.0036 * (np.arange(npix) % side)
+    dates = pd.date_range(start, periods=ndays)
+
+    day = rng.integers(0, ndays, int(npix * ndays * coverage))
+    pix = rng.integers(0, npix, day.size)
+    key = np.unique(day.astype(np.int64) * npix + pix)
+    day, pix = key // npix, key % npix
+    season = 1 + np.sin(2 * np.pi * (dates.dayofyear.values[day] - 80) / 365)
+    ci = rng.lognormal(-8.0, 1.5, day.size) * season + 1e-5
+
+    return pd.DataFrame({'bin_num': pix.astype(np.uint32),
+                         'CI_cyano': ci.astype(np.float32),
+                         'clat': clat[pix], 'clon': clon[pix],
+                         'north': clat[pix] + 0.0013, 'south': clat[pix] - 0.0013,
+                         'west': clon[pix] - 0.0018, 'east': clon[pix] + 0.0018,
+                         'date': dates[day]})
@@ -0,0 +1,124 @@
+import os
+import glob
+import json
+import datetime
+import pyarrow as pa
+import pyarrow.dataset as pds
+import pyarrow.parquet as pq
+
+# files are published with a delay: a missing file is only recorded as "no data" after this many days
+NODATA_GRACE_DAYS = 3
+
+
+class DatasetWriter:
+    """
+    Stream daily extracts into a Hive-partitioned parquet dataset:
+    <root>/year=YYYY/month=M[/lake=name]/YYYYMMDD.parquet
+
+    Each day is written to its own file as soon as it is processed, so memory stays at one
+    day of data and a failure late in a run keeps every day already written. File names are
+    derived from the date, so rerunning a day replaces it and later runs append new days.
+    """
+
+    def __init__(self, root, partition_by_lake=False, row_group_size=None, compression='snappy'):
+        self.root = root
+        self.partition_by_lake = partition_by_lake
+        self.row_group_size = row_group_size
+        self.compression = compression
+        self.rows = 0
+        self.files = 0
+        os.makedirs(root, exist_ok=True)
+
+    def partition_dir(self, day, lake=None):
+        path = os.path.join(self.root, f'year={day.year}', f'month={day.month}')
+        if lake is not None:
+            path = os.path.join(path, f'lake={lake}')
+
+        return path
+
+    def max_dates(self):
+        """
+        Latest date already in the dataset, per lake ({None: date} if not partitioned by lake)
+        """
+        if not glob.glob(os.path.join(self.root, 'year=*', 'month=*', '**', '*.parquet'),
+                         recursive=True):
+            return {}
+
+        columns = ['date', 'lake'] if self.partition_by_lake else ['date']
+        dataset = pds.dataset(self.root, format='parquet', partitioning='hive')
+        df = dataset.to_table(columns=columns).to_pandas()
+        if not self.partition_by_lake:
+            return {None: df['date'].max()}
+
+        return df.groupby('lake', observed=True)['date'].max().to_dict()
+
+    def write_table(self, table, path):
+        """
+        Write table to path atomically: write to a hidden temporary file, then rename it
+        """
+        if table.num_rows == 0:
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = os.path.join(os.path.dirname(path), '.' + os.path.basename(path) + '.tmp')
+        pq.write_table(table, tmp, row_group_size=self.row_group_size,
+                       compression=self.compression)
+        os.replace(tmp, path)
+        self.rows += table.num_rows
+        self.files += 1
+
+    def write_day(self, df, day):
+        """
+        Write one day of data (DataFrame or Arrow table) to its partition(s)
+        """
+        table = df if isinstance(df, pa.Table) else pa.Table.from_pandas(df, preserve_index=False)
+        fn = day.strftime('%Y%m%d') + '.parquet'
+
+        if not self.partition_by_lake:
+            self.write_table(table, os.path.join(self.partition_dir(day), fn))
+            return
+
+        lakes = table.column('lake').to_pandas()
+        table = table.drop_columns(['lake'])
+        for lake in lakes.unique():
+            part = table.filter(pa.array((lakes == lake).values))
+            self.write_table(part, os.path.join(self.partition_dir(day, lake), fn))
+
+
+class IngestState:
+    """
+    Days known to have nothing to ingest, kept in a JSON file so that scheduled runs do not
+    request them again: 'nodata' days have no file on the server, 'empty' days have a file
+    without any bins for a lake
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.state = {'nodata': [], 'empty': {}}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.state = json.load(f)
+        self.nodata = set(self.state['nodata'])
+        self.empty = {lake: set(days) for lake, days in self.state['empty'].items()}
+
+    def is_nodata(self, day):
+        return day.isoformat() in self.nodata
+
+    def is_empty(self, lake, day):
+        return day.isoformat() in self.empty.get(str(lake), ())
+
+    def add_nodata(self, day):
+        if (datetime.date.today() - day).days > NODATA_GRACE_DAYS:
+            self.nodata.add(day.isoformat())
+            self.save()
+
+    def add_empty(self, lake, day):
+        self.empty.setdefault(str(lake), set()).add(day.isoformat())
+        self.save()
+
+    def save(self):
+        self.state = {'nodata': sorted(self.nodata),
+                      'empty': {lake: sorted(days) for lake, days in self.empty.items()}}
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.state, f, indent=1)
+        os.replace(tmp, self.path)